@@ -0,0 +1,184 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Callable, Dict, List, Optional
+
+from . import metrics
+from .utils import format_log_message
+from dotenv import load_dotenv
+# 加载.env文件中的环境变量
+load_dotenv()
+
+logger = logging.getLogger("my_logger")
+
+# 视为上游过载的状态码
+OVERLOAD_STATUS_CODES = (503, 504)
+# 短期/基线延迟的指数移动平均系数
+SHORT_LATENCY_ALPHA = 0.3
+BASELINE_LATENCY_ALPHA = 0.02
+# 两次降低并发上限的最小间隔(秒)，同一时刻的多个503只降低一次
+DECREASE_INTERVAL = 2.0
+
+
+def _load_settings():
+    global ADAPTIVE_LIMIT_ENABLED, ADAPTIVE_LIMIT_MIN, ADAPTIVE_LIMIT_MAX, ADAPTIVE_LIMIT_BACKOFF, ADAPTIVE_LIMIT_LATENCY_TOLERANCE
+    # 是否根据上游的503与延迟自动调整每个模型的并发上限
+    ADAPTIVE_LIMIT_ENABLED = os.environ.get("ADAPTIVE_LIMIT_ENABLED", "true").lower() == "true"
+    # 并发上限的下限
+    ADAPTIVE_LIMIT_MIN = max(1, int(os.environ.get("ADAPTIVE_LIMIT_MIN", 1)))
+    # 并发上限的上限(也是初始值)，实际放行数量同时受单模型最大并发限制
+    ADAPTIVE_LIMIT_MAX = max(ADAPTIVE_LIMIT_MIN, int(os.environ.get("ADAPTIVE_LIMIT_MAX", 32)))
+    # 上游过载时并发上限乘以该系数
+    ADAPTIVE_LIMIT_BACKOFF = float(os.environ.get("ADAPTIVE_LIMIT_BACKOFF", 0.7))
+    # 首字节延迟超过基线的倍数时视为延迟膨胀
+    ADAPTIVE_LIMIT_LATENCY_TOLERANCE = float(os.environ.get("ADAPTIVE_LIMIT_LATENCY_TOLERANCE", 2.0))
+
+
+_load_settings()
+
+
+class ModelLimit:
+    """单个模型的 AIMD 并发上限
+
+    上游返回503/504时按 ADAPTIVE_LIMIT_BACKOFF 乘性减小；首字节延迟的短期均值超过基线的
+    ADAPTIVE_LIMIT_LATENCY_TOLERANCE 倍时小幅减小；请求正常且并发上限被实际使用时，
+    每个成功请求增加 1/limit，即每轮约加 1。
+    """
+
+    def __init__(self, model: str):
+        self.model = model
+        self.limit = float(ADAPTIVE_LIMIT_MAX)
+        self.short_latency: Optional[float] = None
+        self.baseline_latency: Optional[float] = None
+        self.last_decrease = 0.0
+        self.overloads = 0
+        self.decreases = 0
+
+    @property
+    def value(self) -> int:
+        return max(ADAPTIVE_LIMIT_MIN, min(int(self.limit), ADAPTIVE_LIMIT_MAX))
+
+    def _decrease(self, factor: float, cause: str) -> bool:
+        now = time.monotonic()
+        if now - self.last_decrease < DECREASE_INTERVAL:
+            return False
+        self.last_decrease = now
+        self.limit = max(float(ADAPTIVE_LIMIT_MIN), min(self.limit, ADAPTIVE_LIMIT_MAX) * factor)
+        self.decreases += 1
+        metrics.adaptive_limit_decreases_total.inc(self.model, cause)
+        return True
+
+    def on_sample(self, overloaded: bool, latency: Optional[float], in_flight: int) -> Optional[str]:
+        """记录一次上游调用的结果，并发上限变化时返回原因"""
+        if overloaded:
+            self.overloads += 1
+            return "overload" if self._decrease(ADAPTIVE_LIMIT_BACKOFF, "overload") else None
+        if latency is not None:
+            if self.short_latency is None:
+                self.short_latency = self.baseline_latency = latency
+            else:
+                self.short_latency += SHORT_LATENCY_ALPHA * (latency - self.short_latency)
+                # 基线缓慢跟随，持续的延迟变化最终会被当作新的基线
+                self.baseline_latency += BASELINE_LATENCY_ALPHA * (latency - self.baseline_latency)
+            if self.short_latency > self.baseline_latency * ADAPTIVE_LIMIT_LATENCY_TOLERANCE:
+                return "latency" if self._decrease(0.9, "latency") else None
+        # 只在并发上限被实际使用时增长，避免空闲时无限增大
+        if in_flight * 2 >= self.value and self.limit < ADAPTIVE_LIMIT_MAX:
+            previous = self.value
+            self.limit = min(float(ADAPTIVE_LIMIT_MAX), self.limit + 1 / max(self.limit, 1.0))
+            if self.value > previous:
+                return "increase"
+        return None
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.value,
+            "short_latency_ms": round(self.short_latency * 1000, 1) if self.short_latency is not None else None,
+            "baseline_latency_ms": round(self.baseline_latency * 1000, 1) if self.baseline_latency is not None else None,
+            "overloads": self.overloads,
+            "decreases": self.decreases,
+        }
+
+
+class AdaptiveLimits:
+    """按基础模型(去掉思考预算后缀)维护自适应并发上限，由准入控制按该上限放行请求"""
+
+    def __init__(self):
+        self._limits: Dict[str, ModelLimit] = {}
+        self._listeners: List[Callable[[str], None]] = []
+        self._in_flight: Callable[[str], int] = lambda model: 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def start(self, loop: Optional[asyncio.AbstractEventLoop] = None):
+        """在事件循环线程中调用，线程池中记录的结果会转到该事件循环中处理"""
+        self._loop = loop or asyncio.get_running_loop()
+
+    def on_change(self, listener: Callable[[str], None]):
+        """注册并发上限变化时的回调，参数为模型名"""
+        self._listeners.append(listener)
+
+    def set_in_flight_source(self, source: Callable[[str], int]):
+        self._in_flight = source
+
+    def _get(self, model: str) -> ModelLimit:
+        limit = self._limits.get(model)
+        if limit is None:
+            limit = self._limits[model] = ModelLimit(model)
+        return limit
+
+    def limit(self, model: str) -> Optional[int]:
+        """模型当前的并发上限，未启用时返回 None"""
+        if not ADAPTIVE_LIMIT_ENABLED:
+            return None
+        limit = self._limits.get(model)
+        return limit.value if limit is not None else ADAPTIVE_LIMIT_MAX
+
+    def record(self, model: str, status_code: int, latency: Optional[float] = None):
+        """记录上游响应: status_code 为上游状态码，latency 为首字节延迟(秒)，非流式请求不传"""
+        if not ADAPTIVE_LIMIT_ENABLED:
+            return
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # 在事件循环之外调用时转到事件循环中处理，避免与准入控制并发修改状态
+            if self._loop is not None and not self._loop.is_closed():
+                self._loop.call_soon_threadsafe(self.record, model, status_code, latency)
+            return
+        state = self._get(model)
+        previous = state.value
+        change = state.on_sample(status_code in OVERLOAD_STATUS_CODES, latency if status_code == 200 else None, self._in_flight(model))
+        if change is None:
+            return
+        if change != "increase":
+            log_msg = format_log_message('WARNING', f"模型并发上限 {previous} → {state.value} ({'上游过载' if change == 'overload' else '延迟升高'})",
+                                         extra={'request_type': 'adaptive_limit', 'model': model})
+            logger.warning(log_msg)
+        for listener in self._listeners:
+            listener(model)
+
+    def current_limits(self) -> Dict[tuple, float]:
+        if not ADAPTIVE_LIMIT_ENABLED:
+            return {}
+        return {(model,): limit.value for model, limit in self._limits.items()}
+
+    def stats(self) -> dict:
+        return {
+            "enabled": ADAPTIVE_LIMIT_ENABLED,
+            "min": ADAPTIVE_LIMIT_MIN,
+            "max": ADAPTIVE_LIMIT_MAX,
+            "models": {model: limit.stats() for model, limit in self._limits.items()},
+        }
+
+
+# 全局自适应并发上限
+adaptive_limits = AdaptiveLimits()
+metrics.adaptive_concurrency_limit.set_callback(adaptive_limits.current_limits)
+
+
+def reload_adaptive_limits():
+    """根据环境变量重新加载自适应并发配置"""
+    _load_settings()
+    for model in list(adaptive_limits._limits):
+        for listener in adaptive_limits._listeners:
+            listener(model)
@@ -0,0 +1,277 @@
+import os
+import math
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+from typing import Dict, List, Optional
+
+from fastapi import HTTPException, Response, status
+
+from . import metrics
+from .adaptive_limit import adaptive_limits
+from .utils import format_log_message
+from dotenv import load_dotenv
+# 加载.env文件中的环境变量
+load_dotenv()
+
+logger = logging.getLogger("my_logger")
+
+# 优先级名称与数值，数值越小越优先
+PRIORITIES = {"high": 0, "normal": 1, "low": 2}
+PRIORITY_NAMES = tuple(PRIORITIES)
+DEFAULT_PRIORITY = PRIORITIES["normal"]
+# 服务时间的指数移动平均系数
+SERVICE_TIME_ALPHA = 0.2
+
+
+def _parse_model_priorities(value: str) -> Dict[str, int]:
+    """解析 "模型:优先级,模型:优先级" 格式的配置"""
+    result = {}
+    for item in value.split(","):
+        model, _, priority = item.strip().partition(":")
+        if model and priority.strip() in PRIORITIES:
+            result[model] = PRIORITIES[priority.strip()]
+    return result
+
+
+def _load_settings():
+    global ADMISSION_MAX_IN_FLIGHT, ADMISSION_QUEUE_SIZE, ADMISSION_MAX_WAIT, ADMISSION_MODEL_PRIORITIES
+    # 每个上游模型同时进行的请求数上限，超过时排队，0 表示不限制
+    ADMISSION_MAX_IN_FLIGHT = int(os.environ.get("ADMISSION_MAX_IN_FLIGHT", 32))
+    # 每个模型每个优先级的排队长度上限
+    ADMISSION_QUEUE_SIZE = int(os.environ.get("ADMISSION_QUEUE_SIZE", 100))
+    # 最长排队时间(秒)，预计等待时间超过该值时直接拒绝
+    ADMISSION_MAX_WAIT = float(os.environ.get("ADMISSION_MAX_WAIT", 30))
+    # 按模型设置的默认优先级，例如 gemini-2.5-pro:high,gemini-2.0-flash:low
+    ADMISSION_MODEL_PRIORITIES = _parse_model_priorities(os.environ.get("ADMISSION_MODEL_PRIORITIES", ""))
+
+
+_load_settings()
+
+
+class Slot:
+    """已获准进入的请求，处理结束后必须调用 release()"""
+
+    __slots__ = ('_gate', '_controller', 'priority', 'admitted_at', '_released')
+
+    def __init__(self, controller: Optional["AdmissionController"], gate: Optional["_ModelGate"], priority: int):
+        self._controller = controller
+        self._gate = gate
+        self.priority = priority
+        self.admitted_at = time.monotonic()
+        self._released = False
+
+    def release(self):
+        if self._released:
+            return
+        self._released = True
+        if self._gate is not None:
+            self._controller._release(self._gate, time.monotonic() - self.admitted_at)
+
+
+
+class SlotResponse(Response):
+    """包装流式响应，响应发送结束后释放名额
+
+    在ASGI层面释放，而不是在响应体生成器的 finally 中释放: 客户端在开始输出前断开时生成器不会启动，
+    其 finally 也不会执行，名额会一直被占用。
+    """
+
+    def __init__(self, response: Response, slot: Slot):
+        self.response = response
+        self.slot = slot
+        self.status_code = response.status_code
+        self.raw_headers = response.raw_headers
+        self.background = response.background
+
+    async def __call__(self, scope, receive, send):
+        # FastAPI 会把后台任务设置在外层的响应上
+        self.response.background = self.background
+        try:
+            await self.response(scope, receive, send)
+        finally:
+            self.slot.release()
+
+
+class _ModelGate:
+    def __init__(self, model: str):
+        self.model = model
+        self.in_flight = 0
+        # 等待队列: [优先级, 截止时间, 序号, future]，同一优先级内截止时间早的先出队
+        self.waiters: List[list] = []
+        self.queued = [0] * len(PRIORITIES)
+        self.service_time: Optional[float] = None
+
+    @property
+    def limit(self) -> int:
+        """固定的单模型最大并发与自适应并发上限中较小的一个"""
+        adaptive = adaptive_limits.limit(self.model)
+        return ADMISSION_MAX_IN_FLIGHT if adaptive is None else min(adaptive, ADMISSION_MAX_IN_FLIGHT)
+
+
+class AdmissionController:
+    """按上游模型限制并发的准入控制
+
+    每个模型同时进行的请求数超过并发上限(ADMISSION_MAX_IN_FLIGHT 与自适应上限中较小的一个)时，
+    新请求按优先级排队，同一优先级内截止时间早的先获准。根据平均服务时间预计排队时间，超过截止时间的请求
+    直接以 503 + Retry-After 拒绝，而不是进入重试循环消耗密钥。
+    所有方法都在事件循环中调用，无需加锁。
+    """
+
+    def __init__(self):
+        self._gates: Dict[str, _ModelGate] = {}
+        self._seq = itertools.count()
+        self.admitted = 0
+        self.queued_total = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    def resolve_priority(self, access_key_priority: Optional[str], model: str, header: Optional[str]) -> int:
+        """优先级依次取自访问密钥、模型配置；请求头 X-Priority 只能降低优先级"""
+        if access_key_priority in PRIORITIES:
+            priority = PRIORITIES[access_key_priority]
+        else:
+            priority = ADMISSION_MODEL_PRIORITIES.get(model, DEFAULT_PRIORITY)
+        header = (header or "").strip().lower()
+        if header in PRIORITIES:
+            priority = max(priority, PRIORITIES[header])
+        return priority
+
+    def _gate(self, model: str) -> _ModelGate:
+        gate = self._gates.get(model)
+        if gate is None:
+            gate = self._gates[model] = _ModelGate(model)
+        return gate
+
+    @staticmethod
+    def estimate_wait(gate: _ModelGate, priority: int) -> Optional[float]:
+        """预计排队时间: 排在前面的请求数 / 并发上限 * 平均服务时间，没有历史数据时返回 None"""
+        if gate.service_time is None:
+            return None
+        ahead = sum(gate.queued[:priority + 1])
+        return (ahead + 1) / gate.limit * gate.service_time
+
+    def _reject(self, gate: _ModelGate, priority: int, reason: str, retry_after: float, detail: str):
+        self.rejected += 1
+        metrics.admission_rejections_total.inc(reason, PRIORITY_NAMES[priority])
+        retry_after = max(1, math.ceil(retry_after))
+        log_msg = format_log_message('WARNING', f"{detail}，{retry_after} 秒后重试",
+                                     extra={'request_type': 'admission', 'model': gate.model, 'status_code': 503})
+        logger.warning(log_msg)
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=detail,
+                            headers={"Retry-After": str(retry_after)})
+
+    async def acquire(self, model: str, priority: int = DEFAULT_PRIORITY, timeout: Optional[float] = None) -> Slot:
+        """获取模型的处理名额，需要排队时等待；无法在截止时间内获准时抛出 503"""
+        if ADMISSION_MAX_IN_FLIGHT <= 0:
+            return Slot(None, None, priority)
+        gate = self._gate(model)
+        # 清理队首已超时或已断开的等待者
+        while gate.waiters and gate.waiters[0][3].done():
+            heapq.heappop(gate.waiters)
+        if gate.in_flight < gate.limit and not gate.waiters:
+            metrics.admission_wait.observe(0.0, PRIORITY_NAMES[priority])
+            return self._admit(gate, priority)
+
+        max_wait = min(timeout, ADMISSION_MAX_WAIT) if timeout and timeout > 0 else ADMISSION_MAX_WAIT
+        estimate = self.estimate_wait(gate, priority)
+        if gate.queued[priority] >= ADMISSION_QUEUE_SIZE:
+            self._reject(gate, priority, "queue_full", estimate or gate.service_time or 1, "请求排队已满")
+        if estimate is not None and estimate > max_wait:
+            self._reject(gate, priority, "deadline", estimate, f"预计排队 {estimate:.1f}s 超过最长等待时间")
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        enqueued_at = time.monotonic()
+        entry = [priority, enqueued_at + max_wait, next(self._seq), future]
+        heapq.heappush(gate.waiters, entry)
+        gate.queued[priority] += 1
+        self.queued_total += 1
+        try:
+            slot = await asyncio.wait_for(future, max_wait)
+        except asyncio.TimeoutError:
+            gate.queued[priority] -= 1
+            self.timed_out += 1
+            self._reject(gate, priority, "timeout", gate.service_time or max_wait, f"排队超过 {max_wait:.0f}s")
+        except asyncio.CancelledError:
+            # 客户端断开: 已获准时归还名额，否则从队列中移除
+            if future.done() and not future.cancelled():
+                future.result().release()
+            else:
+                gate.queued[priority] -= 1
+            raise
+        metrics.admission_wait.observe(time.monotonic() - enqueued_at, PRIORITY_NAMES[priority])
+        return slot
+
+    def _admit(self, gate: _ModelGate, priority: int) -> Slot:
+        gate.in_flight += 1
+        self.admitted += 1
+        return Slot(self, gate, priority)
+
+    def _release(self, gate: _ModelGate, service_time: float):
+        gate.in_flight -= 1
+        if gate.service_time is None:
+            gate.service_time = service_time
+        else:
+            gate.service_time += SERVICE_TIME_ALPHA * (service_time - gate.service_time)
+        self._dispatch(gate)
+
+    def _dispatch(self, gate: _ModelGate):
+        """按优先级与截止时间依次放行，跳过已超时或已断开的等待者"""
+        limit = gate.limit if ADMISSION_MAX_IN_FLIGHT > 0 else math.inf
+        while gate.waiters and gate.in_flight < limit:
+            priority, _, _, future = heapq.heappop(gate.waiters)
+            if future.done():
+                continue
+            gate.queued[priority] -= 1
+            future.set_result(self._admit(gate, priority))
+
+    def in_flight(self, model: str) -> int:
+        gate = self._gates.get(model)
+        return gate.in_flight if gate is not None else 0
+
+    def on_limit_change(self, model: str):
+        """自适应并发上限变化后放行排队的请求"""
+        gate = self._gates.get(model)
+        if gate is not None:
+            self._dispatch(gate)
+
+    def queue_depth(self) -> Dict[tuple, float]:
+        return {(gate.model, PRIORITY_NAMES[priority]): count
+                for gate in self._gates.values() for priority, count in enumerate(gate.queued)}
+
+    def stats(self) -> dict:
+        return {
+            "max_in_flight": ADMISSION_MAX_IN_FLIGHT,
+            "queue_size": ADMISSION_QUEUE_SIZE,
+            "max_wait": ADMISSION_MAX_WAIT,
+            "admitted": self.admitted,
+            "queued": self.queued_total,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "models": {
+                gate.model: {
+                    "limit": gate.limit,
+                    "in_flight": gate.in_flight,
+                    "queued": dict(zip(PRIORITY_NAMES, gate.queued)),
+                    "service_time": round(gate.service_time, 3) if gate.service_time is not None else None,
+                }
+                for gate in self._gates.values()
+            },
+        }
+
+
+# 全局准入控制器
+admission_controller = AdmissionController()
+metrics.admission_queue_depth.set_callback(admission_controller.queue_depth)
+adaptive_limits.set_in_flight_source(admission_controller.in_flight)
+adaptive_limits.on_change(admission_controller.on_limit_change)
+
+
+def reload_admission_settings():
+    """根据环境变量重新加载准入控制配置，并发上限调大后立即放行排队的请求"""
+    _load_settings()
+    for gate in list(admission_controller._gates.values()):
+        admission_controller._dispatch(gate)
@@ -0,0 +1,171 @@
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from . import metrics
+from dotenv import load_dotenv
+# 加载.env文件中的环境变量
+load_dotenv()
+
+
+def _load_settings():
+    global AUTH_CACHE_TTL, AUTH_NEGATIVE_TTL, AUTH_CACHE_SIZE, AUTH_FAILURE_LIMIT
+    # 鉴权结果的缓存时间(秒)，访问密钥被管理界面修改时立即失效
+    AUTH_CACHE_TTL = float(os.environ.get("AUTH_CACHE_TTL", 60))
+    # 无效令牌的缓存时间(秒)，也是按IP统计鉴权失败次数的时间窗口
+    AUTH_NEGATIVE_TTL = float(os.environ.get("AUTH_NEGATIVE_TTL", 60))
+    # 缓存的令牌数量上限(有效与无效分别计算)，超出时淘汰最久未使用的
+    AUTH_CACHE_SIZE = max(1, int(os.environ.get("AUTH_CACHE_SIZE", 10000)))
+    # 同一IP在时间窗口内鉴权失败超过该次数后直接返回429，0 表示不限制
+    AUTH_FAILURE_LIMIT = int(os.environ.get("AUTH_FAILURE_LIMIT", 20))
+
+
+_load_settings()
+
+
+def token_hash(token: str) -> bytes:
+    """缓存只保存令牌的哈希，超长的随机令牌也只占用固定大小的内存"""
+    return hashlib.blake2b(token.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+
+
+class AuthDecision:
+    """预先计算的鉴权结果
+
+    kind 为 password(管理密码)、access_key(有效的访问密钥) 或 inactive(已失效的访问密钥)。
+    访问密钥只缓存不常变化的字段，使用次数与token用量在每次请求时读取最新值。
+    """
+
+    __slots__ = ('kind', 'expires_at', 'usage_limit', 'token_limit', 'reset_daily', 'cached_until')
+
+    def __init__(self, kind: str, key_data: Optional[dict] = None):
+        key_data = key_data or {}
+        self.kind = kind
+        self.expires_at = key_data.get("expires_at")
+        self.usage_limit = key_data.get("usage_limit")
+        self.token_limit = key_data.get("token_limit")
+        self.reset_daily = bool(key_data.get("reset_daily"))
+        self.cached_until = time.monotonic() + AUTH_CACHE_TTL
+
+
+class AuthCache:
+    """鉴权结果缓存
+
+    有效令牌按哈希缓存预先计算的鉴权结果，请求时不再构建 AccessKey 模型；
+    无效令牌进入负缓存，重复出现时不再查找与记录日志；按IP统计鉴权失败次数，
+    短时间内失败过多的IP直接返回429，不再读取请求体，抵御暴力尝试。
+    修改字典的操作都很短，加锁保证管理接口与每日重置线程中的失效操作安全。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._decisions: "OrderedDict[bytes, AuthDecision]" = OrderedDict()
+        self._rejected: "OrderedDict[bytes, float]" = OrderedDict()
+        # IP -> (时间窗口开始时间, 失败次数)
+        self._failures: Dict[str, Tuple[float, int]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.throttled_requests = 0
+
+    def get(self, token: str) -> Optional[AuthDecision]:
+        digest = token_hash(token)
+        decision = self._decisions.get(digest)
+        if decision is None or decision.cached_until < time.monotonic():
+            self.misses += 1
+            return None
+        self.hits += 1
+        return decision
+
+    def put(self, token: str, decision: AuthDecision):
+        digest = token_hash(token)
+        with self._lock:
+            self._decisions[digest] = decision
+            self._decisions.move_to_end(digest)
+            while len(self._decisions) > AUTH_CACHE_SIZE:
+                self._decisions.popitem(last=False)
+
+    def is_rejected(self, token: str) -> bool:
+        """令牌最近已被确认无效"""
+        expire_at = self._rejected.get(token_hash(token))
+        if expire_at is None or expire_at < time.monotonic():
+            return False
+        self.negative_hits += 1
+        return True
+
+    def reject(self, token: str):
+        digest = token_hash(token)
+        with self._lock:
+            self._rejected[digest] = time.monotonic() + AUTH_NEGATIVE_TTL
+            self._rejected.move_to_end(digest)
+            while len(self._rejected) > AUTH_CACHE_SIZE:
+                self._rejected.popitem(last=False)
+
+    def invalidate(self, token: Optional[str] = None):
+        """访问密钥变化后使缓存失效，不传令牌时清空全部"""
+        with self._lock:
+            if token is None:
+                self._decisions.clear()
+                self._rejected.clear()
+            else:
+                digest = token_hash(token)
+                self._decisions.pop(digest, None)
+                self._rejected.pop(digest, None)
+
+    def record_failure(self, ip: str) -> int:
+        """记录一次鉴权失败，返回该IP在当前时间窗口内的失败次数"""
+        now = time.monotonic()
+        with self._lock:
+            started, count = self._failures.get(ip, (now, 0))
+            if now - started >= AUTH_NEGATIVE_TTL:
+                started, count = now, 0
+            self._failures[ip] = (started, count + 1)
+            if len(self._failures) > AUTH_CACHE_SIZE:
+                # 清理已过期的时间窗口
+                self._failures = {key: value for key, value in self._failures.items() if now - value[0] < AUTH_NEGATIVE_TTL}
+        metrics.auth_rejections_total.inc("invalid")
+        return count + 1
+
+    def clear_failures(self, ip: str):
+        self._failures.pop(ip, None)
+
+    def throttled(self, ip: str) -> Optional[float]:
+        """IP鉴权失败次数过多时返回剩余的等待秒数"""
+        if AUTH_FAILURE_LIMIT <= 0:
+            return None
+        entry = self._failures.get(ip)
+        if entry is None or entry[1] < AUTH_FAILURE_LIMIT:
+            return None
+        remaining = AUTH_NEGATIVE_TTL - (time.monotonic() - entry[0])
+        if remaining <= 0:
+            return None
+        self.throttled_requests += 1
+        metrics.auth_rejections_total.inc("throttled")
+        return remaining
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "ttl": AUTH_CACHE_TTL,
+            "negative_ttl": AUTH_NEGATIVE_TTL,
+            "failure_limit": AUTH_FAILURE_LIMIT,
+            "cached": len(self._decisions),
+            "rejected_cached": len(self._rejected),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0,
+            "negative_hits": self.negative_hits,
+            "throttled": self.throttled_requests,
+        }
+
+
+# 全局鉴权缓存
+auth_cache = AuthCache()
+
+
+def reload_auth_cache():
+    """根据环境变量重新加载鉴权缓存配置，并清空已缓存的结果"""
+    _load_settings()
+    auth_cache.invalidate()
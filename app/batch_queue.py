@@ -0,0 +1,588 @@
+import os
+import json
+import time
+import uuid
+import random
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import threading
+from email.parser import BytesParser
+from email.policy import default as email_policy
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import httpx
+from fastapi import HTTPException, status
+
+from . import metrics
+from .sysinfo import sysinfo_sampler
+from .utils import GeminiAPIError, GeminiServiceUnavailableError, format_log_message
+from dotenv import load_dotenv
+# 加载.env文件中的环境变量
+load_dotenv()
+
+logger = logging.getLogger("my_logger")
+
+# 目前只支持聊天补全
+SUPPORTED_ENDPOINTS = ("/v1/chat/completions",)
+# 与OpenAI一致的单个批处理任务最大请求数
+MAX_BATCH_REQUESTS = 50000
+# 完成窗口，超时未处理的请求标记为 expired
+COMPLETION_WINDOWS = {"24h": 24 * 3600}
+# 重试的退避时间(秒)，实际等待时间为 BACKOFF_BASE * 2^(attempts-1)，最多 BACKOFF_MAX
+BACKOFF_BASE = 5
+BACKOFF_MAX = 300
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    purpose TEXT NOT NULL,
+    bytes INTEGER NOT NULL,
+    created_at INTEGER NOT NULL,
+    content BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS batches (
+    id TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    endpoint TEXT NOT NULL,
+    input_file_id TEXT NOT NULL,
+    completion_window TEXT NOT NULL,
+    status TEXT NOT NULL,
+    output_file_id TEXT,
+    error_file_id TEXT,
+    metadata TEXT,
+    created_at INTEGER NOT NULL,
+    in_progress_at INTEGER,
+    expires_at INTEGER,
+    finalizing_at INTEGER,
+    completed_at INTEGER,
+    expired_at INTEGER,
+    cancelling_at INTEGER,
+    cancelled_at INTEGER
+);
+CREATE TABLE IF NOT EXISTS batch_items (
+    batch_id TEXT NOT NULL,
+    line INTEGER NOT NULL,
+    custom_id TEXT NOT NULL,
+    body TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    not_before REAL NOT NULL DEFAULT 0,
+    result TEXT,
+    PRIMARY KEY (batch_id, line)
+);
+CREATE INDEX IF NOT EXISTS idx_batch_items_status ON batch_items (status, batch_id);
+"""
+
+
+def _load_settings():
+    global BATCH_DB_FILE, BATCH_CONCURRENCY, BATCH_MAX_INTERACTIVE, BATCH_MAX_ATTEMPTS, BATCH_KEY_COOLDOWN, BATCH_MAX_FILE_MB
+    # 批处理任务与文件的SQLite数据库路径
+    BATCH_DB_FILE = os.environ.get("BATCH_DB_FILE", "app/batch_queue.db")
+    # 批处理同时进行的上游请求数上限，实际不超过可用密钥数
+    BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", 4))
+    # 处理中的交互请求超过该数量时暂停派发批处理请求
+    BATCH_MAX_INTERACTIVE = int(os.environ.get("BATCH_MAX_INTERACTIVE", 2))
+    # 单个请求遇到429/5xx时的最大尝试次数
+    BATCH_MAX_ATTEMPTS = int(os.environ.get("BATCH_MAX_ATTEMPTS", 5))
+    # 密钥返回429后批处理暂停使用该密钥的时间(秒)
+    BATCH_KEY_COOLDOWN = float(os.environ.get("BATCH_KEY_COOLDOWN", 60))
+    # 上传文件的最大大小(MB)
+    BATCH_MAX_FILE_MB = float(os.environ.get("BATCH_MAX_FILE_MB", 100))
+
+
+_load_settings()
+
+
+def _new_id(prefix: str) -> str:
+    return f"{prefix}-{uuid.uuid4().hex[:24]}" if prefix == "file" else f"{prefix}_{uuid.uuid4().hex[:24]}"
+
+
+def _error_status(error: Exception) -> int:
+    if isinstance(error, (GeminiAPIError, GeminiServiceUnavailableError)):
+        return error.status_code
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code
+    if isinstance(error, httpx.HTTPError):
+        return 502
+    if isinstance(error, (ValueError, TypeError, HTTPException)):
+        return getattr(error, "status_code", 400)
+    return 500
+
+
+def owner_of(token: Optional[str], client_ip: str) -> str:
+    """文件与任务按调用方隔离: 使用访问密钥/密码的哈希，没有令牌时(IP白名单)使用客户端IP"""
+    return hashlib.sha256((token or f"ip:{client_ip}").encode("utf-8")).hexdigest()[:32]
+
+
+def parse_upload(content_type: str, body: bytes, params) -> Tuple[str, str, bytes]:
+    """解析上传的文件，返回 (文件名, purpose, 内容)
+
+    支持OpenAI SDK使用的 multipart/form-data，使用标准库解析以避免额外依赖；
+    也支持直接上传JSONL内容，此时 purpose 与 filename 通过查询参数传入。
+    """
+    if not content_type.startswith("multipart/form-data"):
+        return params.get("filename", "upload.jsonl"), params.get("purpose", "batch"), body
+    message = BytesParser(policy=email_policy).parsebytes(b"Content-Type: " + content_type.encode("latin-1") + b"\r\n\r\n" + body)
+    filename, purpose, content = "upload.jsonl", params.get("purpose", ""), None
+    for part in message.iter_parts():
+        name = part.get_param("name", header="content-disposition")
+        if name == "file":
+            filename = part.get_filename() or filename
+            content = part.get_payload(decode=True)
+        elif name == "purpose":
+            purpose = part.get_content().strip()
+    if content is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="缺少 file 字段")
+    return filename, purpose, content
+
+
+def parse_batch_input(content: bytes, endpoint: str) -> List[Tuple[int, str, dict]]:
+    """校验并解析JSONL输入文件，返回 [(行号, custom_id, body)]"""
+    items = []
+    seen = set()
+    for line_no, raw in enumerate(content.decode("utf-8").splitlines(), start=1):
+        if not raw.strip():
+            continue
+        try:
+            request = json.loads(raw)
+        except json.JSONDecodeError as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"第 {line_no} 行不是有效的JSON: {e}")
+        if not isinstance(request, dict):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"第 {line_no} 行必须是JSON对象")
+        custom_id = request.get("custom_id")
+        if not isinstance(custom_id, str) or not custom_id:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"第 {line_no} 行缺少 custom_id")
+        if custom_id in seen:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"第 {line_no} 行的 custom_id 重复: {custom_id}")
+        if request.get("method", "POST").upper() != "POST" or request.get("url", endpoint) != endpoint:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"第 {line_no} 行的 method/url 必须为 POST {endpoint}")
+        if not isinstance(request.get("body"), dict):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"第 {line_no} 行缺少 body")
+        seen.add(custom_id)
+        items.append((line_no, custom_id, request["body"]))
+    if not items:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="输入文件中没有请求")
+    if len(items) > MAX_BATCH_REQUESTS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"单个批处理任务最多 {MAX_BATCH_REQUESTS} 个请求")
+    return items
+
+
+class BatchQueue:
+    """离线批处理任务队列
+
+    上传的文件、任务与每个请求的状态都保存在SQLite中，服务重启后未完成的请求会重新排队。
+    后台调度任务只使用空闲的处理能力: 交互请求较多时暂停派发，并发数不超过可用密钥数，
+    返回429的密钥会暂停使用一段时间。数据库操作都在线程池中执行，避免阻塞事件循环。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._db_file: Optional[str] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._worker_task: Optional[asyncio.Task] = None
+        self._running: Dict[Tuple[str, int], asyncio.Task] = {}
+        self._key_cooldown: Dict[str, float] = {}
+        self._get_key_manager: Optional[Callable[[], Any]] = None
+        self._run_item: Optional[Callable[[dict, str], Awaitable[dict]]] = None
+        self.paused = False
+
+    # ---- 数据库 ----
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None or self._db_file != BATCH_DB_FILE:
+            if self._conn is not None:
+                self._conn.close()
+            directory = os.path.dirname(BATCH_DB_FILE)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(BATCH_DB_FILE, check_same_thread=False)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(SCHEMA)
+            self._db_file = BATCH_DB_FILE
+        return self._conn
+
+    def _execute(self, func: Callable[[sqlite3.Connection], Any]):
+        with self._lock:
+            conn = self._db()
+            with conn:
+                return func(conn)
+
+    async def _call(self, func: Callable[[sqlite3.Connection], Any]):
+        return await asyncio.to_thread(self._execute, func)
+
+    # ---- 文件 ----
+
+    @staticmethod
+    def _file_object(row) -> dict:
+        return {
+            "id": row["id"],
+            "object": "file",
+            "bytes": row["bytes"],
+            "created_at": row["created_at"],
+            "filename": row["filename"],
+            "purpose": row["purpose"],
+        }
+
+    def _insert_file(self, conn, owner: str, filename: str, purpose: str, content: bytes) -> dict:
+        file_id = _new_id("file")
+        conn.execute("INSERT INTO files (id, owner, filename, purpose, bytes, created_at, content) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     (file_id, owner, filename, purpose, len(content), int(time.time()), content))
+        return {"id": file_id, "bytes": len(content), "created_at": int(time.time()), "filename": filename, "purpose": purpose}
+
+    async def create_file(self, owner: str, filename: str, purpose: str, content: bytes) -> dict:
+        if purpose != "batch":
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="目前只支持 purpose=batch 的文件")
+        if len(content) > BATCH_MAX_FILE_MB * 1024 * 1024:
+            raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=f"文件大小超过 {BATCH_MAX_FILE_MB:g}MB")
+        row = await self._call(lambda conn: self._insert_file(conn, owner, filename, purpose, content))
+        return dict(row, object="file")
+
+    def _get_file_row(self, conn, owner: str, file_id: str, with_content: bool = False):
+        columns = "*" if with_content else "id, owner, filename, purpose, bytes, created_at"
+        row = conn.execute(f"SELECT {columns} FROM files WHERE id = ? AND owner = ?", (file_id, owner)).fetchone()
+        if row is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"文件不存在: {file_id}")
+        return row
+
+    async def get_file(self, owner: str, file_id: str) -> dict:
+        return self._file_object(await self._call(lambda conn: self._get_file_row(conn, owner, file_id)))
+
+    async def get_file_content(self, owner: str, file_id: str) -> bytes:
+        row = await self._call(lambda conn: self._get_file_row(conn, owner, file_id, with_content=True))
+        return bytes(row["content"])
+
+    async def list_files(self, owner: str, purpose: Optional[str] = None) -> dict:
+        def query(conn):
+            sql = "SELECT id, owner, filename, purpose, bytes, created_at FROM files WHERE owner = ?"
+            params: list = [owner]
+            if purpose:
+                sql += " AND purpose = ?"
+                params.append(purpose)
+            return conn.execute(sql + " ORDER BY created_at DESC", params).fetchall()
+        return {"object": "list", "data": [self._file_object(row) for row in await self._call(query)]}
+
+    async def delete_file(self, owner: str, file_id: str) -> dict:
+        def delete(conn):
+            self._get_file_row(conn, owner, file_id)
+            conn.execute("DELETE FROM files WHERE id = ?", (file_id,))
+        await self._call(delete)
+        return {"id": file_id, "object": "file", "deleted": True}
+
+    # ---- 批处理任务 ----
+
+    @staticmethod
+    def _request_counts(conn, batch_id: str) -> dict:
+        counts = {"total": 0, "completed": 0, "failed": 0}
+        for row in conn.execute("SELECT status, COUNT(*) AS n FROM batch_items WHERE batch_id = ? GROUP BY status", (batch_id,)):
+            counts["total"] += row["n"]
+            if row["status"] == "completed":
+                counts["completed"] += row["n"]
+            elif row["status"] in ("failed", "expired", "cancelled"):
+                counts["failed"] += row["n"]
+        return counts
+
+    def _batch_object(self, conn, row) -> dict:
+        return {
+            "id": row["id"],
+            "object": "batch",
+            "endpoint": row["endpoint"],
+            "errors": None,
+            "input_file_id": row["input_file_id"],
+            "completion_window": row["completion_window"],
+            "status": row["status"],
+            "output_file_id": row["output_file_id"],
+            "error_file_id": row["error_file_id"],
+            "created_at": row["created_at"],
+            "in_progress_at": row["in_progress_at"],
+            "expires_at": row["expires_at"],
+            "finalizing_at": row["finalizing_at"],
+            "completed_at": row["completed_at"],
+            "failed_at": None,
+            "expired_at": row["expired_at"],
+            "cancelling_at": row["cancelling_at"],
+            "cancelled_at": row["cancelled_at"],
+            "request_counts": self._request_counts(conn, row["id"]),
+            "metadata": json.loads(row["metadata"]) if row["metadata"] else None,
+        }
+
+    def _get_batch_row(self, conn, owner: Optional[str], batch_id: str):
+        if owner is None:
+            row = conn.execute("SELECT * FROM batches WHERE id = ?", (batch_id,)).fetchone()
+        else:
+            row = conn.execute("SELECT * FROM batches WHERE id = ? AND owner = ?", (batch_id, owner)).fetchone()
+        if row is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"批处理任务不存在: {batch_id}")
+        return row
+
+    async def create_batch(self, owner: str, input_file_id: str, endpoint: str, completion_window: str = "24h",
+                           metadata: Optional[dict] = None) -> dict:
+        if endpoint not in SUPPORTED_ENDPOINTS:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"不支持的 endpoint: {endpoint}")
+        if completion_window not in COMPLETION_WINDOWS:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"不支持的 completion_window: {completion_window}")
+
+        def create(conn):
+            content = bytes(self._get_file_row(conn, owner, input_file_id, with_content=True)["content"])
+            items = parse_batch_input(content, endpoint)
+            batch_id = _new_id("batch")
+            now = int(time.time())
+            # 输入文件在创建时即完成校验，任务直接进入 in_progress
+            conn.execute(
+                "INSERT INTO batches (id, owner, endpoint, input_file_id, completion_window, status, metadata, created_at, in_progress_at, expires_at) "
+                "VALUES (?, ?, ?, ?, ?, 'in_progress', ?, ?, ?, ?)",
+                (batch_id, owner, endpoint, input_file_id, completion_window, json.dumps(metadata) if metadata else None,
+                 now, now, now + COMPLETION_WINDOWS[completion_window]))
+            conn.executemany(
+                "INSERT INTO batch_items (batch_id, line, custom_id, body, status) VALUES (?, ?, ?, ?, 'pending')",
+                [(batch_id, line_no, custom_id, json.dumps(body, ensure_ascii=False)) for line_no, custom_id, body in items])
+            return self._batch_object(conn, self._get_batch_row(conn, owner, batch_id))
+
+        batch = await self._call(create)
+        log_msg = format_log_message('INFO', f"创建批处理任务 {batch['id']}，共 {batch['request_counts']['total']} 个请求",
+                                     extra={'request_type': 'batch'})
+        logger.info(log_msg)
+        self._wake()
+        return batch
+
+    async def get_batch(self, owner: str, batch_id: str) -> dict:
+        return await self._call(lambda conn: self._batch_object(conn, self._get_batch_row(conn, owner, batch_id)))
+
+    async def list_batches(self, owner: str, limit: int = 20, after: Optional[str] = None) -> dict:
+        limit = max(1, min(limit, 100))
+
+        def query(conn):
+            sql = "SELECT * FROM batches WHERE owner = ?"
+            params: list = [owner]
+            if after:
+                sql += " AND created_at <= (SELECT created_at FROM batches WHERE id = ?) AND id != ?"
+                params += [after, after]
+            rows = conn.execute(sql + " ORDER BY created_at DESC, id DESC LIMIT ?", params + [limit + 1]).fetchall()
+            return [self._batch_object(conn, row) for row in rows]
+
+        batches = await self._call(query)
+        data = batches[:limit]
+        return {
+            "object": "list",
+            "data": data,
+            "first_id": data[0]["id"] if data else None,
+            "last_id": data[-1]["id"] if data else None,
+            "has_more": len(batches) > limit,
+        }
+
+    async def cancel_batch(self, owner: str, batch_id: str) -> dict:
+        def cancel(conn):
+            row = self._get_batch_row(conn, owner, batch_id)
+            if row["status"] in ("in_progress", "validating"):
+                conn.execute("UPDATE batches SET status = 'cancelling', cancelling_at = ? WHERE id = ?", (int(time.time()), batch_id))
+                conn.execute("UPDATE batch_items SET status = 'cancelled' WHERE batch_id = ? AND status = 'pending'", (batch_id,))
+            elif row["status"] not in ("cancelling", "cancelled"):
+                raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"状态为 {row['status']} 的任务无法取消")
+            return self._batch_object(conn, self._get_batch_row(conn, owner, batch_id))
+
+        batch = await self._call(cancel)
+        # 正在进行的请求直接取消，结束后由调度任务生成结果文件
+        for (item_batch_id, _), task in list(self._running.items()):
+            if item_batch_id == batch_id:
+                task.cancel()
+        self._wake()
+        return batch
+
+    # ---- 调度 ----
+
+    def start(self, get_key_manager: Callable[[], Any], run_item: Callable[[dict, str], Awaitable[dict]]):
+        """在事件循环中启动后台调度任务，run_item(body, api_key) 以非流式方式执行单个请求并返回响应体"""
+        self._get_key_manager = get_key_manager
+        self._run_item = run_item
+        if self._worker_task is not None and not self._worker_task.done():
+            return
+        self._wakeup = asyncio.Event()
+        self._worker_task = asyncio.create_task(self._worker())
+
+    def _wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _capacity(self) -> int:
+        """当前可以同时进行的批处理请求数"""
+        key_manager = self._get_key_manager() if self._get_key_manager else None
+        if key_manager is None or not key_manager.api_keys:
+            return 0
+        # 为交互请求让路
+        self.paused = sysinfo_sampler.in_flight > BATCH_MAX_INTERACTIVE
+        if self.paused:
+            return 0
+        now = time.monotonic()
+        idle_keys = sum(1 for key in key_manager.api_keys if self._key_cooldown.get(key, 0) <= now)
+        return min(BATCH_CONCURRENCY, idle_keys)
+
+    def _lease_key(self) -> Optional[str]:
+        key_manager = self._get_key_manager()
+        now = time.monotonic()
+        for _ in range(len(key_manager.api_keys)):
+            key = key_manager.lease_keys(1)[0]
+            if self._key_cooldown.get(key, 0) <= now:
+                return key
+        return None
+
+    def _recover(self, conn):
+        """服务重启后，上次未完成的请求重新排队"""
+        return conn.execute("UPDATE batch_items SET status = 'pending' WHERE status = 'running'").rowcount
+
+    def _claim(self, conn, limit: int) -> List[sqlite3.Row]:
+        rows = conn.execute(
+            "SELECT i.batch_id, i.line, i.custom_id, i.body, i.attempts FROM batch_items i "
+            "JOIN batches b ON b.id = i.batch_id "
+            "WHERE i.status = 'pending' AND i.not_before <= ? AND b.status = 'in_progress' "
+            "ORDER BY b.created_at, i.line LIMIT ?", (time.time(), limit)).fetchall()
+        conn.executemany("UPDATE batch_items SET status = 'running' WHERE batch_id = ? AND line = ?",
+                         [(row["batch_id"], row["line"]) for row in rows])
+        return rows
+
+    async def _worker(self):
+        recovered = await self._call(self._recover)
+        if recovered:
+            log_msg = format_log_message('INFO', f"恢复 {recovered} 个未完成的批处理请求", extra={'request_type': 'batch'})
+            logger.info(log_msg)
+        while True:
+            try:
+                await self._call(self._finalize_ready)
+                free = self._capacity() - len(self._running)
+                rows = await self._call(lambda conn: self._claim(conn, free)) if free > 0 else []
+                for row in rows:
+                    api_key = self._lease_key()
+                    if api_key is None:
+                        await self._call(lambda conn, row=row: conn.execute(
+                            "UPDATE batch_items SET status = 'pending' WHERE batch_id = ? AND line = ?", (row["batch_id"], row["line"])))
+                        continue
+                    task_key = (row["batch_id"], row["line"])
+                    self._running[task_key] = asyncio.create_task(self._process(row, api_key))
+            except Exception as e:
+                logger.error(format_log_message('ERROR', f"批处理调度失败: {e}", extra={'request_type': 'batch'}))
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=1)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _process(self, row, api_key: str):
+        batch_id, line = row["batch_id"], row["line"]
+        attempts = row["attempts"] + 1
+        try:
+            body = await self._run_item(json.loads(row["body"]), api_key)
+            result = {"status_code": 200, "body": body}
+            await self._call(lambda conn: self._store_result(conn, batch_id, line, "completed", attempts, result))
+            metrics.batch_requests_total.inc("completed")
+        except asyncio.CancelledError:
+            # 任务被取消时标记为 cancelled，服务关闭时重新排队
+            await self._call(lambda conn: conn.execute(
+                "UPDATE batch_items SET status = CASE WHEN (SELECT status FROM batches WHERE id = ?) = 'cancelling' "
+                "THEN 'cancelled' ELSE 'pending' END WHERE batch_id = ? AND line = ?", (batch_id, batch_id, line)))
+            raise
+        except Exception as e:
+            status_code = _error_status(e)
+            message = getattr(e, "message", None) or getattr(e, "detail", None) or str(e)
+            if status_code == 429:
+                self._key_cooldown[api_key] = time.monotonic() + BATCH_KEY_COOLDOWN
+            if (status_code == 429 or status_code >= 500) and attempts < BATCH_MAX_ATTEMPTS:
+                delay = min(BACKOFF_BASE * 2 ** (attempts - 1), BACKOFF_MAX) * random.uniform(0.5, 1)
+                await self._call(lambda conn: conn.execute(
+                    "UPDATE batch_items SET status = 'pending', attempts = ?, not_before = ? WHERE batch_id = ? AND line = ?",
+                    (attempts, time.time() + delay, batch_id, line)))
+                metrics.batch_requests_total.inc("retried")
+            else:
+                result = {"status_code": status_code, "error": {"code": str(status_code), "message": str(message)}}
+                await self._call(lambda conn: self._store_result(conn, batch_id, line, "failed", attempts, result))
+                metrics.batch_requests_total.inc("failed")
+                log_msg = format_log_message('WARNING', f"批处理请求失败 {batch_id}#{row['custom_id']}: {message}",
+                                             extra={'key': api_key[:10], 'request_type': 'batch', 'status_code': status_code})
+                logger.warning(log_msg)
+        finally:
+            self._running.pop((batch_id, line), None)
+            self._wake()
+
+    @staticmethod
+    def _store_result(conn, batch_id: str, line: int, item_status: str, attempts: int, result: dict):
+        conn.execute("UPDATE batch_items SET status = ?, attempts = ?, result = ? WHERE batch_id = ? AND line = ?",
+                     (item_status, attempts, json.dumps(result, ensure_ascii=False), batch_id, line))
+
+    def _finalize_ready(self, conn):
+        """生成已结束任务的结果文件: 全部请求完成、已取消或已超过完成窗口"""
+        now = int(time.time())
+        for row in conn.execute("SELECT * FROM batches WHERE status = 'in_progress' AND expires_at <= ?", (now,)).fetchall():
+            conn.execute("UPDATE batch_items SET status = 'expired' WHERE batch_id = ? AND status = 'pending'", (row["id"],))
+        rows = conn.execute("SELECT * FROM batches WHERE status IN ('in_progress', 'cancelling')").fetchall()
+        for row in rows:
+            unfinished = conn.execute("SELECT COUNT(*) FROM batch_items WHERE batch_id = ? AND status IN ('pending', 'running')",
+                                      (row["id"],)).fetchone()[0]
+            if unfinished:
+                continue
+            self._write_results(conn, row, now)
+
+    def _write_results(self, conn, row, now: int):
+        batch_id = row["id"]
+        output_lines, error_lines = [], []
+        for item in conn.execute("SELECT line, custom_id, status, result FROM batch_items WHERE batch_id = ? ORDER BY line", (batch_id,)):
+            request_id = f"batch_req_{batch_id[6:]}_{item['line']}"
+            if item["status"] == "completed":
+                result = json.loads(item["result"])
+                output_lines.append({"id": request_id, "custom_id": item["custom_id"],
+                                     "response": {"status_code": 200, "request_id": request_id, "body": result["body"]}, "error": None})
+            elif item["status"] == "failed":
+                result = json.loads(item["result"])
+                error_lines.append({"id": request_id, "custom_id": item["custom_id"],
+                                    "response": {"status_code": result["status_code"], "request_id": request_id, "body": {"error": result["error"]}},
+                                    "error": None})
+            else:
+                code = "batch_expired" if item["status"] == "expired" else "batch_cancelled"
+                message = "请求未在完成窗口内处理" if item["status"] == "expired" else "批处理任务已取消"
+                error_lines.append({"id": request_id, "custom_id": item["custom_id"], "response": None,
+                                    "error": {"code": code, "message": message}})
+
+        def to_file(lines, name):
+            if not lines:
+                return None
+            content = "".join(json.dumps(line, ensure_ascii=False) + "\n" for line in lines).encode("utf-8")
+            return self._insert_file(conn, row["owner"], f"{batch_id}_{name}.jsonl", f"batch_{name}", content)["id"]
+
+        output_file_id = to_file(output_lines, "output")
+        error_file_id = to_file(error_lines, "error")
+        if row["status"] == "cancelling":
+            final_status, time_column = "cancelled", "cancelled_at"
+        elif row["expires_at"] <= now:
+            final_status, time_column = "expired", "expired_at"
+        else:
+            final_status, time_column = "completed", "completed_at"
+        conn.execute(f"UPDATE batches SET status = ?, output_file_id = ?, error_file_id = ?, finalizing_at = ?, {time_column} = ? WHERE id = ?",
+                     (final_status, output_file_id, error_file_id, now, now, batch_id))
+        log_msg = format_log_message('INFO', f"批处理任务 {batch_id} 已结束: {final_status}，成功 {len(output_lines)}，失败 {len(error_lines)}",
+                                     extra={'request_type': 'batch'})
+        logger.info(log_msg)
+
+    def pending_count(self) -> int:
+        return self._execute(lambda conn: conn.execute("SELECT COUNT(*) FROM batch_items WHERE status = 'pending'").fetchone()[0])
+
+    def stats(self) -> dict:
+        return {
+            "running": len(self._running),
+            "pending": self.pending_count(),
+            "paused": self.paused,
+            "cooling_keys": sum(1 for until in self._key_cooldown.values() if until > time.monotonic()),
+            "concurrency": BATCH_CONCURRENCY,
+            "max_interactive": BATCH_MAX_INTERACTIVE,
+        }
+
+
+# 全局批处理队列
+batch_queue = BatchQueue()
+
+
+def reload_batch_settings():
+    """根据环境变量重新加载批处理配置"""
+    _load_settings()
+    batch_queue._wake()
@@ -0,0 +1,248 @@
+import os
+import zlib
+import asyncio
+from typing import Dict, Optional
+
+from dotenv import load_dotenv
+# 加载.env文件中的环境变量
+load_dotenv()
+
+try:
+    import brotli
+except ImportError:  # 未安装 brotli 时只使用gzip
+    brotli = None
+
+# gzip压缩级别与brotli质量，动态内容取速度与压缩率的折中
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4
+# 超过该字节数的数据块在线程中压缩，避免大文件(如批处理结果)阻塞事件循环
+THREAD_MIN_BYTES = 256 * 1024
+# 可以压缩的内容类型，图片、视频等已压缩的内容不再压缩
+COMPRESSIBLE_TYPES = ("text/", "application/json", "application/javascript", "application/x-ndjson",
+                      "application/jsonl", "application/xml", "image/svg+xml")
+
+
+def _load_settings():
+    global RESPONSE_COMPRESSION_ENABLED, RESPONSE_COMPRESSION_MIN_BYTES, RESPONSE_COMPRESSION_SSE
+    # 是否按客户端的 Accept-Encoding 压缩响应(gzip/br)
+    RESPONSE_COMPRESSION_ENABLED = os.environ.get("RESPONSE_COMPRESSION_ENABLED", "true").lower() == "true"
+    # 小于该字节数的响应不压缩
+    RESPONSE_COMPRESSION_MIN_BYTES = int(os.environ.get("RESPONSE_COMPRESSION_MIN_BYTES", 1024))
+    # 是否压缩流式(SSE)响应，每个数据块压缩后立即刷新，不会延迟输出
+    RESPONSE_COMPRESSION_SSE = os.environ.get("RESPONSE_COMPRESSION_SSE", "false").lower() == "true"
+
+
+_load_settings()
+
+
+def parse_accept_encoding(header: str) -> Dict[str, float]:
+    """解析 Accept-Encoding，返回 {编码: q值}"""
+    result = {}
+    for item in header.split(","):
+        name, _, params = item.strip().partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        result[name] = quality
+    return result
+
+
+def accepts_encoding(header: str, encoding: str) -> bool:
+    """客户端是否接受指定的编码(可以是多个编码的组合，如 "gzip, br")"""
+    accepted = parse_accept_encoding(header or "")
+    wildcard = accepted.get("*", 0.0)
+    return all(accepted.get(name.strip().lower(), wildcard) > 0 for name in encoding.split(",") if name.strip())
+
+
+def choose_encoding(header: str) -> Optional[str]:
+    """按q值选择支持的压缩编码，q值相同时优先br"""
+    accepted = parse_accept_encoding(header or "")
+    wildcard = accepted.get("*", 0.0)
+    best, best_quality = None, 0.0
+    for encoding in (("br",) if brotli is not None else ()) + ("gzip",):
+        quality = accepted.get(encoding, wildcard)
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def _compressible(content_type: str) -> bool:
+    content_type = content_type.lower()
+    if content_type.startswith("text/event-stream"):
+        return RESPONSE_COMPRESSION_SSE
+    return content_type.startswith(COMPRESSIBLE_TYPES) or "+json" in content_type
+
+
+class _Compressor:
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == "br":
+            self._brotli = brotli.Compressor(quality=BROTLI_QUALITY)
+        else:
+            self._zlib = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes, flush: bool = False) -> bytes:
+        """压缩数据块，flush 为 True 时输出目前为止的全部数据，客户端可以立即解压"""
+        if self.encoding == "br":
+            output = self._brotli.process(data)
+            return output + self._brotli.flush() if flush else output
+        output = self._zlib.compress(data)
+        return output + self._zlib.flush(zlib.Z_SYNC_FLUSH) if flush else output
+
+    def finish(self, data: bytes = b"") -> bytes:
+        if self.encoding == "br":
+            return self._brotli.process(data) + self._brotli.finish()
+        return self._zlib.compress(data) + self._zlib.flush()
+
+
+class CompressionStats:
+    def __init__(self):
+        self.responses = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def stats(self) -> dict:
+        return {
+            "enabled": RESPONSE_COMPRESSION_ENABLED,
+            "min_bytes": RESPONSE_COMPRESSION_MIN_BYTES,
+            "sse": RESPONSE_COMPRESSION_SSE,
+            "brotli": brotli is not None,
+            "responses": self.responses,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "ratio": round(self.bytes_out / self.bytes_in, 4) if self.bytes_in else 0,
+        }
+
+
+# 全局压缩统计
+compression_stats = CompressionStats()
+
+
+class CompressionMiddleware:
+    """按 Accept-Encoding 协商的gzip/brotli响应压缩(纯ASGI中间件)
+
+    普通响应整体小于 RESPONSE_COMPRESSION_MIN_BYTES 时不压缩；流式响应逐块压缩，
+    SSE 的每个数据块压缩后立即刷新，不会因为压缩而延迟输出。已带有 Content-Encoding 的响应
+    (如通用代理直接转发的上游压缩数据)与图片等不可压缩的内容原样输出。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not RESPONSE_COMPRESSION_ENABLED or scope.get("method") == "HEAD":
+            await self.app(scope, receive, send)
+            return
+        accept_encoding = b""
+        for name, value in scope["headers"]:
+            if name == b"accept-encoding":
+                accept_encoding = value
+                break
+        encoding = choose_encoding(accept_encoding.decode("latin-1"))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        await self.app(scope, receive, _CompressingSender(send, encoding).send)
+
+
+class _CompressingSender:
+    def __init__(self, send, encoding: str):
+        self._send = send
+        self._encoding = encoding
+        self._start: Optional[dict] = None
+        self._compressor: Optional[_Compressor] = None
+        self._passthrough = False
+        self._flush_chunks = False
+
+    async def send(self, message):
+        message_type = message["type"]
+        if message_type == "http.response.start":
+            self._start = message
+            return
+        if message_type != "http.response.body" or self._passthrough:
+            await self._flush_start()
+            await self._send(message)
+            return
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+
+        if self._compressor is None:
+            if not self._should_compress(body, more_body):
+                self._passthrough = True
+                await self._flush_start()
+                await self._send(message)
+                return
+            self._compressor = _Compressor(self._encoding)
+            compression_stats.responses += 1
+            headers = []
+            for name, value in self._start["headers"]:
+                if name == b"content-length":
+                    continue
+                if name == b"etag" and not value.startswith(b"W/"):
+                    # 压缩后的字节与原始内容不同，强ETag改为弱ETag
+                    value = b"W/" + value
+                headers.append((name, value))
+            headers.append((b"content-encoding", self._encoding.encode()))
+            headers.append((b"vary", b"Accept-Encoding"))
+            if not more_body:
+                # 完整的响应体一次压缩，可以给出准确的 Content-Length
+                compressed = await self._run(self._compressor.finish, body)
+                headers.append((b"content-length", str(len(compressed)).encode()))
+                self._record(body, compressed)
+                await self._send(dict(self._start, headers=headers))
+                self._start = None
+                await self._send({"type": "http.response.body", "body": compressed})
+                return
+            await self._send(dict(self._start, headers=headers))
+            self._start = None
+
+        if more_body:
+            compressed = await self._run(self._compressor.compress, body, self._flush_chunks)
+        else:
+            compressed = await self._run(self._compressor.finish, body)
+        self._record(body, compressed)
+        if compressed or not more_body:
+            await self._send({"type": "http.response.body", "body": compressed, "more_body": more_body})
+
+    def _should_compress(self, body: bytes, more_body: bool) -> bool:
+        content_type = ""
+        for name, value in self._start["headers"]:
+            if name == b"content-encoding":
+                return False
+            if name == b"content-type":
+                content_type = value.decode("latin-1")
+        if self._start.get("status") in (204, 304) or not _compressible(content_type):
+            return False
+        if more_body:
+            # 流式响应: SSE 逐块刷新，其余按压缩器的缓冲输出
+            self._flush_chunks = content_type.lower().startswith("text/event-stream")
+            return True
+        return len(body) >= RESPONSE_COMPRESSION_MIN_BYTES
+
+    @staticmethod
+    async def _run(func, data: bytes, *args) -> bytes:
+        if len(data) >= THREAD_MIN_BYTES:
+            return await asyncio.to_thread(func, data, *args)
+        return func(data, *args)
+
+    async def _flush_start(self):
+        if self._start is not None:
+            start, self._start = self._start, None
+            await self._send(start)
+
+    @staticmethod
+    def _record(body: bytes, compressed: bytes):
+        compression_stats.bytes_in += len(body)
+        compression_stats.bytes_out += len(compressed)
+
+
+def reload_compression_settings():
+    """根据环境变量重新加载响应压缩配置"""
+    _load_settings()
@@ -75,6 +75,43 @@ def save_access_keys():
         finally:
             save_access_keys_lock.release()
 
+# 延迟保存: 短时间内的多次修改合并为一次写入
+ACCESS_KEYS_SAVE_DELAY = 1.0
+_save_later_lock = threading.Lock()
+_save_later_timer = None
+
+def _save_access_keys_now():
+    """在后台线程中保存访问密钥，先在锁内生成快照，避免写入时字典被修改"""
+    global _save_later_timer
+    with _save_later_lock:
+        _save_later_timer = None
+    with access_keys_lock:
+        data = json.dumps(access_keys, indent=4, ensure_ascii=False)
+    with save_access_keys_lock:
+        with open(ACCESS_KEYS_FILE, 'w', encoding='utf-8') as f:
+            f.write(data)
+
+def save_access_keys_later():
+    """
+    在后台线程中异步保存访问密钥，不阻塞请求处理。
+    调用时可以持有 access_keys_lock。
+    """
+    global _save_later_timer
+    with _save_later_lock:
+        if _save_later_timer is not None:
+            return
+        _save_later_timer = threading.Timer(ACCESS_KEYS_SAVE_DELAY, _save_access_keys_now)
+        _save_later_timer.daemon = True
+        _save_later_timer.start()
+
+def flush_access_keys():
+    """立即写入尚未保存的修改(服务关闭时调用)"""
+    with _save_later_lock:
+        timer = _save_later_timer
+    if timer is not None:
+        timer.cancel()
+        _save_access_keys_now()
+
 def get_access_keys():
     """返回当前的访问密钥"""
     return access_keys
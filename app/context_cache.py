@@ -0,0 +1,231 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional, List, Tuple
+
+import requests
+
+from .hashing import structured_digest
+
+logger = logging.getLogger('my_logger')
+from dotenv import load_dotenv
+# 加载.env文件中的环境变量
+load_dotenv()
+
+
+@dataclass
+class ContextCacheEntry:
+    """上游 cachedContents 句柄"""
+    name: str
+    expire_at: float
+    token_count: int = 0
+
+
+def _load_settings():
+    global CONTEXT_CACHE_ENABLED, CONTEXT_CACHE_MIN_CHARS, CONTEXT_CACHE_MIN_REPEATS, CONTEXT_CACHE_TTL_SECONDS
+    # 是否启用Gemini上下文缓存(默认关闭)
+    CONTEXT_CACHE_ENABLED = os.environ.get('CONTEXT_CACHE_ENABLED', 'false').lower() == 'true'
+    # 可缓存前缀的最小字符数，低于Gemini的最小缓存token数时创建会失败
+    CONTEXT_CACHE_MIN_CHARS = int(os.environ.get('CONTEXT_CACHE_MIN_CHARS', 16384))
+    # 相同前缀出现多少次后才创建上游缓存
+    CONTEXT_CACHE_MIN_REPEATS = int(os.environ.get('CONTEXT_CACHE_MIN_REPEATS', 2))
+    CONTEXT_CACHE_TTL_SECONDS = int(os.environ.get('CONTEXT_CACHE_TTL_SECONDS', 600))
+
+
+_load_settings()
+
+# 缓存到期前预留的时间(秒)，避免使用即将过期的句柄
+EXPIRY_MARGIN_SECONDS = 30
+# 记录前缀出现次数的最大数量
+MAX_TRACKED_PREFIXES = 1024
+
+
+def _content_chars(contents, system_instruction=None) -> int:
+    total = 0
+    for content in list(contents) + ([system_instruction] if system_instruction else []):
+        for part in content.get('parts', []):
+            if 'text' in part:
+                total += len(part['text'] or '')
+            elif 'inline_data' in part:
+                total += len(part['inline_data'].get('data', ''))
+    return total
+
+
+def _has_system_text(system_instruction) -> bool:
+    if not system_instruction:
+        return False
+    return any(part.get('text') for part in system_instruction.get('parts', []))
+
+
+def _split_candidates(contents, system_instruction) -> List[Tuple[list, list]]:
+    """返回可缓存的前缀候选 [(缓存的contents, 剩余的contents)]，按前缀从长到短排列
+
+    1. 对话历史: 除最后一轮用户消息外的所有contents(重新生成或重试时重复出现)
+    2. 开头部分: 第一条content中的第一个part(合并到第一条消息中的长系统提示词)
+    """
+    candidates = []
+    if len(contents) >= 2:
+        candidates.append((contents[:-1], contents[-1:]))
+    if contents and len(contents[0].get('parts', [])) >= 1:
+        first = contents[0]
+        rest_parts = first['parts'][1:]
+        rest = ([{"role": first['role'], "parts": rest_parts}] if rest_parts else []) + contents[1:]
+        if rest:
+            candidates.append(([{"role": first['role'], "parts": first['parts'][:1]}], rest))
+    return candidates
+
+
+def _digest(model: str, cached_contents, system_instruction) -> str:
+    return structured_digest({"model": model, "contents": cached_contents, "system_instruction": system_instruction})
+
+
+class ContextCacheManager:
+    """管理上游Gemini上下文缓存(cachedContents)
+
+    同一模型下重复出现的长前缀(系统提示词或对话历史)达到次数阈值后，在后台线程中
+    为当前API密钥创建上游缓存，之后的请求只发送剩余的contents并引用缓存句柄。
+    上游缓存属于各自的API密钥，因此按 (api_key, model, 前缀哈希) 分别管理。
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._seen = OrderedDict()
+        self._creating = set()
+        self._failed = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.created = 0
+        self.failures = 0
+        self.invalidations = 0
+        self.cached_tokens = 0
+
+    def prepare(self, base_url: str, api_key: str, model: str, contents, system_instruction):
+        """为请求选择可用的上游缓存
+
+        Returns:
+            tuple: (contents, system_instruction, cached_content_name)，
+            未命中缓存时原样返回contents与system_instruction，cached_content_name为None
+        """
+        if not CONTEXT_CACHE_ENABLED:
+            return contents, system_instruction, None
+        system = system_instruction if _has_system_text(system_instruction) else None
+        candidates = []
+        for cached_contents, rest in _split_candidates(contents, system):
+            if _content_chars(cached_contents, system) >= CONTEXT_CACHE_MIN_CHARS:
+                candidates.append((_digest(model, cached_contents, system), cached_contents, rest))
+        if not candidates:
+            return contents, system_instruction, None
+
+        now = time.time()
+        to_create = None
+        with self._lock:
+            for digest, _, rest in candidates:
+                entry = self._entries.get((api_key, model, digest))
+                if entry is None:
+                    continue
+                if entry.expire_at - EXPIRY_MARGIN_SECONDS > now:
+                    self.hits += 1
+                    return rest, None, entry.name
+                del self._entries[(api_key, model, digest)]
+
+            for digest, cached_contents, _ in candidates:
+                count = self._seen.pop((model, digest), 0) + 1
+                self._seen[(model, digest)] = count
+                while len(self._seen) > MAX_TRACKED_PREFIXES:
+                    self._seen.popitem(last=False)
+                key = (api_key, model, digest)
+                failed_until = self._failed.get((model, digest))
+                if failed_until is not None and failed_until <= now:
+                    del self._failed[(model, digest)]
+                    failed_until = None
+                if to_create is None and count >= CONTEXT_CACHE_MIN_REPEATS \
+                        and key not in self._creating and failed_until is None:
+                    self._creating.add(key)
+                    to_create = (key, cached_contents)
+
+        if to_create is not None:
+            key, cached_contents = to_create
+            threading.Thread(target=self._create, args=(base_url, key, cached_contents, system), daemon=True).start()
+        return contents, system_instruction, None
+
+    def _create(self, base_url: str, key, cached_contents, system_instruction):
+        api_key, model, digest = key
+        body = {
+            "model": f"models/{model}",
+            "contents": cached_contents,
+            "ttl": f"{CONTEXT_CACHE_TTL_SECONDS}s",
+        }
+        if system_instruction:
+            body["systemInstruction"] = system_instruction
+        try:
+            response = requests.post(f"{base_url}/v1beta/cachedContents?key={api_key}", json=body, timeout=60)
+            response.raise_for_status()
+            data = response.json()
+            entry = ContextCacheEntry(
+                name=data['name'],
+                expire_at=time.time() + CONTEXT_CACHE_TTL_SECONDS,
+                token_count=data.get('usageMetadata', {}).get('totalTokenCount', 0),
+            )
+            with self._lock:
+                self._entries[key] = entry
+                self.created += 1
+            logger.info(f"已创建上下文缓存: {entry.name} 模型: {model} token数: {entry.token_count}")
+        except Exception as e:
+            with self._lock:
+                self.failures += 1
+                now = time.time()
+                # 清理已过期的失败记录，不再出现的前缀也不会一直占用内存
+                for failed_key in [failed_key for failed_key, until in self._failed.items() if until <= now]:
+                    del self._failed[failed_key]
+                # 创建失败(例如低于最小token数)的前缀在一个TTL内不再尝试
+                self._failed[(model, digest)] = now + CONTEXT_CACHE_TTL_SECONDS
+            logger.warning(f"创建上下文缓存失败: 模型: {model} 错误: {e}")
+        finally:
+            with self._lock:
+                self._creating.discard(key)
+
+    def invalidate(self, api_key: str, name: str):
+        """使用缓存句柄的请求失败时移除该句柄，重试时不再引用"""
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if key[0] == api_key and entry.name == name:
+                    del self._entries[key]
+                    self.invalidations += 1
+
+    def record_usage(self, cached_token_count: Optional[int]):
+        if cached_token_count:
+            with self._lock:
+                self.cached_tokens += cached_token_count
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._seen.clear()
+            self._failed.clear()
+
+    def stats(self) -> dict:
+        return {
+            "enabled": CONTEXT_CACHE_ENABLED,
+            "entries": len(self._entries),
+            "tracked_prefixes": len(self._seen),
+            "failed_prefixes": len(self._failed),
+            "hits": self.hits,
+            "created": self.created,
+            "failures": self.failures,
+            "invalidations": self.invalidations,
+            "cached_tokens": self.cached_tokens,
+        }
+
+
+# 全局上下文缓存管理实例
+context_cache = ContextCacheManager()
+
+
+def reload_context_cache():
+    """根据环境变量重新加载上下文缓存配置"""
+    _load_settings()
+    if not CONTEXT_CACHE_ENABLED:
+        context_cache.clear()
@@ -0,0 +1,195 @@
+import os
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from . import metrics
+from .model_registry import PrefixTrie
+from .usage import MARKDOWN_IMAGE, estimate_content_tokens, estimate_prompt_tokens
+from .utils import format_log_message
+from dotenv import load_dotenv
+# 加载.env文件中的环境变量
+load_dotenv()
+
+logger = logging.getLogger("my_logger")
+
+# 可用的裁剪步骤: images 去掉较早消息中的图片，oldest 丢弃最早的对话轮次，placeholder 丢弃最早的轮次并留下省略说明
+TRIM_STEPS = ("images", "oldest", "placeholder")
+# 未从模型列表获取到窗口大小时，按模型名前缀使用的默认输入token上限
+DEFAULT_WINDOWS = {
+    "gemini-1.5-pro": 2097152,
+    "gemini-1.5-flash": 1048576,
+    "gemini-2": 1048576,
+    "gemini-2.0-flash-preview-image-generation": 32768,
+    "gemini-2.5-flash-image": 32768,
+    "gemma-3": 131072,
+}
+IMAGE_PLACEHOLDER = "[image]"
+
+
+def _parse_windows(value: str) -> Dict[str, int]:
+    """解析 "模型:token数,模型:token数" 格式的配置"""
+    result = {}
+    for item in value.split(","):
+        model, _, tokens = item.strip().partition(":")
+        if model and tokens.strip().isdigit():
+            result[model] = int(tokens.strip())
+    return result
+
+
+def _load_settings():
+    global CONTEXT_TRIM_STRATEGY, CONTEXT_WINDOW_TOKENS, CONTEXT_WINDOW_SAFETY
+    # 超出上下文窗口时依次执行的裁剪步骤，留空表示不裁剪，超出时直接返回400
+    CONTEXT_TRIM_STRATEGY = [step for step in (item.strip() for item in os.environ.get("CONTEXT_TRIM_STRATEGY", "images,oldest").split(",")) if step in TRIM_STEPS]
+    # 按模型名前缀覆盖输入token上限，例如 gemini-2.0-flash:1048576
+    CONTEXT_WINDOW_TOKENS = _parse_windows(os.environ.get("CONTEXT_WINDOW_TOKENS", ""))
+    # 估算值只允许使用窗口的该比例，为本地估算的误差留出余量
+    CONTEXT_WINDOW_SAFETY = min(1.0, max(0.1, float(os.environ.get("CONTEXT_WINDOW_SAFETY", 0.9))))
+
+
+_load_settings()
+
+
+class ContextWindowExceeded(Exception):
+    """裁剪后仍超出模型的上下文窗口"""
+
+    def __init__(self, message: str):
+        super().__init__(message)
+        self.message = message
+
+
+class ContextWindow:
+    """模型上下文窗口的本地检查与裁剪
+
+    在消息转换之后、请求上游之前按本地估算的token数检查请求大小，超出时按 CONTEXT_TRIM_STRATEGY 裁剪，
+    避免上游返回400后还在多个密钥之间重试。最后一条content(当前的用户消息)与系统提示词不会被裁剪。
+    """
+
+    def __init__(self):
+        # 从模型列表获取的 inputTokenLimit
+        self._discovered: Dict[str, int] = {}
+        self._defaults = PrefixTrie(DEFAULT_WINDOWS)
+        self._overrides = PrefixTrie()
+        self._override_values: Dict[str, int] = {}
+        self.checked = 0
+        self.trimmed = 0
+        self.rejected = 0
+        self.apply_settings()
+
+    def apply_settings(self):
+        self._override_values = dict(CONTEXT_WINDOW_TOKENS)
+        self._overrides = PrefixTrie(self._override_values)
+
+    def update_limits(self, limits: Dict[str, int]):
+        """记录模型列表中的 inputTokenLimit"""
+        self._discovered.update({model: limit for model, limit in limits.items() if limit})
+
+    def limit(self, model: str) -> Optional[int]:
+        """模型的输入token上限，未知模型返回 None"""
+        prefix = self._overrides.longest_prefix(model)
+        if prefix is not None:
+            return self._override_values[prefix]
+        if model in self._discovered:
+            return self._discovered[model]
+        prefix = self._defaults.longest_prefix(model)
+        return DEFAULT_WINDOWS[prefix] if prefix is not None else None
+
+    def fit(self, model: str, contents: List[dict], system_instruction: Optional[dict] = None) -> Tuple[List[dict], int]:
+        """检查并在需要时裁剪contents
+
+        Returns:
+            tuple: (裁剪后的contents, 估算的输入token数)
+
+        Raises:
+            ContextWindowExceeded: 按策略裁剪后仍超出上下文窗口
+        """
+        self.checked += 1
+        window = self.limit(model)
+        sizes = [estimate_content_tokens(content) for content in contents]
+        system_tokens = estimate_prompt_tokens((), system_instruction)
+        total = system_tokens + sum(sizes)
+        if window is None:
+            return contents, total
+        budget = int(window * CONTEXT_WINDOW_SAFETY)
+        if total <= budget:
+            return contents, total
+
+        original = total
+        applied = []
+        for step in CONTEXT_TRIM_STRATEGY:
+            if total <= budget:
+                break
+            if step == "images":
+                contents, sizes = self._drop_images(contents, sizes, total - budget)
+            else:
+                contents, sizes = self._drop_oldest(contents, sizes, total - budget, step == "placeholder")
+            new_total = system_tokens + sum(sizes)
+            if new_total < total:
+                applied.append(step)
+                metrics.context_trims_total.inc(model, step)
+            total = new_total
+
+        if total > budget:
+            self.rejected += 1
+            raise ContextWindowExceeded(f"请求超出模型的上下文长度(估算 {total} tokens，上限 {budget} tokens)")
+        self.trimmed += 1
+        log_msg = format_log_message('WARNING', f"请求超出上下文窗口，已裁剪({','.join(applied)}): {original} → {total} tokens",
+                                     extra={'request_type': 'context_window', 'model': model})
+        logger.warning(log_msg)
+        return contents, total
+
+    @staticmethod
+    def _drop_images(contents: List[dict], sizes: List[int], excess: int) -> Tuple[List[dict], List[int]]:
+        """从最早的消息开始，把图片与历史Markdown图片替换为 [image] 标记"""
+        contents, sizes = list(contents), list(sizes)
+        for index in range(len(contents) - 1):
+            if excess <= 0:
+                break
+            parts = []
+            for part in contents[index]["parts"]:
+                if "inline_data" in part:
+                    part = {"text": IMAGE_PLACEHOLDER}
+                elif part.get("text") and "![" in part["text"]:
+                    # 历史消息中的Markdown图片不再由 filter_markdown_images_async 提交
+                    part = {"text": MARKDOWN_IMAGE.sub(IMAGE_PLACEHOLDER, part["text"])}
+                parts.append(part)
+            content = {"role": contents[index]["role"], "parts": parts}
+            size = estimate_content_tokens(content)
+            excess -= sizes[index] - size
+            contents[index], sizes[index] = content, size
+        return contents, sizes
+
+    @staticmethod
+    def _drop_oldest(contents: List[dict], sizes: List[int], excess: int, placeholder: bool) -> Tuple[List[dict], List[int]]:
+        """丢弃最早的对话轮次，保留的部分从用户消息开始"""
+        dropped = 0
+        while dropped < len(contents) - 1 and (excess > 0 or contents[dropped]["role"] != "user"):
+            excess -= sizes[dropped]
+            dropped += 1
+        if not dropped:
+            return contents, sizes
+        contents, sizes = list(contents[dropped:]), list(sizes[dropped:])
+        if placeholder and contents[0]["role"] == "user":
+            note = {"text": f"[前面的 {dropped} 条消息因超出上下文长度已省略]"}
+            contents[0] = {"role": "user", "parts": [note] + list(contents[0]["parts"])}
+            sizes[0] += estimate_content_tokens({"parts": [note]})
+        return contents, sizes
+
+    def stats(self) -> dict:
+        return {
+            "strategy": CONTEXT_TRIM_STRATEGY,
+            "safety": CONTEXT_WINDOW_SAFETY,
+            "discovered_models": len(self._discovered),
+            "checked": self.checked,
+            "trimmed": self.trimmed,
+            "rejected": self.rejected,
+        }
+
+
+# 全局上下文窗口检查
+context_window = ContextWindow()
+
+
+def reload_context_window():
+    """根据环境变量重新加载上下文窗口配置"""
+    _load_settings()
+    context_window.apply_settings()
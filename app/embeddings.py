@@ -0,0 +1,153 @@
+import os
+import math
+import base64
+import asyncio
+import logging
+from array import array
+from typing import List, Optional, Tuple
+
+import httpx
+from fastapi import HTTPException, status
+
+from . import metrics
+from .gemini import GeminiClient
+from .models import EmbeddingRequest
+from .utils import GeminiAPIError, format_log_message
+from dotenv import load_dotenv
+# 加载.env文件中的环境变量
+load_dotenv()
+
+logger = logging.getLogger("my_logger")
+
+# batchEmbedContents 单次请求最多包含的输入数量
+UPSTREAM_MAX_BATCH = 100
+# OpenAI 的嵌入模型名映射为默认的Gemini嵌入模型
+OPENAI_EMBEDDING_MODELS = ("text-embedding-3-small", "text-embedding-3-large", "text-embedding-ada-002")
+
+
+def _load_settings():
+    global EMBEDDING_DEFAULT_MODEL, EMBEDDING_BATCH_SIZE, EMBEDDING_BATCH_MAX_CHARS, EMBEDDING_CONCURRENCY, EMBEDDING_MAX_RETRIES
+    # OpenAI 模型名对应的Gemini嵌入模型
+    EMBEDDING_DEFAULT_MODEL = os.environ.get("EMBEDDING_DEFAULT_MODEL", "gemini-embedding-001")
+    # 每个上游批次的最大输入数量
+    EMBEDDING_BATCH_SIZE = max(1, min(int(os.environ.get("EMBEDDING_BATCH_SIZE", UPSTREAM_MAX_BATCH)), UPSTREAM_MAX_BATCH))
+    # 每个上游批次的最大字符数，避免单个请求体过大
+    EMBEDDING_BATCH_MAX_CHARS = int(os.environ.get("EMBEDDING_BATCH_MAX_CHARS", 400000))
+    # 同时进行的上游批次数量
+    EMBEDDING_CONCURRENCY = max(1, int(os.environ.get("EMBEDDING_CONCURRENCY", 4)))
+    # 单个批次遇到429/5xx时换密钥重试的次数
+    EMBEDDING_MAX_RETRIES = int(os.environ.get("EMBEDDING_MAX_RETRIES", 3))
+
+
+_load_settings()
+
+
+def resolve_model(model: str) -> str:
+    model = model.replace("models/", "", 1)
+    return EMBEDDING_DEFAULT_MODEL if model in OPENAI_EMBEDDING_MODELS else model
+
+
+def normalize_input(value) -> List[str]:
+    """把 input 统一为字符串列表；Gemini 不支持 token 数组输入"""
+    if isinstance(value, str):
+        return [value]
+    if value and not all(isinstance(item, str) for item in value):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="不支持 token 数组形式的 input，请直接传入文本")
+    if not value:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="input 不能为空")
+    if any(not item for item in value):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="input 中不能包含空字符串")
+    return list(value)
+
+
+def pack_batches(texts: List[str], max_size: int, max_chars: int) -> List[Tuple[int, int]]:
+    """把输入切分为连续的批次，返回 [(起始下标, 结束下标)]
+
+    先按数量上限计算批次数并平均分配，避免最后一个批次过小；
+    再按字符数上限切分过长的批次。超长的单个输入单独成批。
+    """
+    count = len(texts)
+    batch_count = math.ceil(count / max_size)
+    target = math.ceil(count / batch_count)
+    batches = []
+    start = 0
+    chars = 0
+    for index, text in enumerate(texts):
+        if index > start and (index - start >= target or chars + len(text) > max_chars):
+            batches.append((start, index))
+            start, chars = index, 0
+        chars += len(text)
+    batches.append((start, count))
+    return batches
+
+
+def encode_embedding(values: List[float], encoding_format: str):
+    if encoding_format == "base64":
+        # 与OpenAI一致: little-endian float32
+        return base64.b64encode(array("f", values).tobytes()).decode("ascii")
+    return values
+
+
+async def _embed_batch(client: httpx.AsyncClient, key_manager, api_key: str, model: str, texts: List[str], dimensions: Optional[int], client_ip: str):
+    for attempt in range(EMBEDDING_MAX_RETRIES + 1):
+        try:
+            return await GeminiClient.batch_embed_contents(client, api_key, model, texts, dimensions)
+        except (GeminiAPIError, httpx.TransportError) as e:
+            status_code = getattr(e, "status_code", 503)
+            retryable = status_code == 429 or status_code >= 500
+            if not retryable or attempt >= EMBEDDING_MAX_RETRIES:
+                raise
+            metrics.retries_total.inc("429" if status_code == 429 else "503")
+            log_msg = format_log_message('WARNING', f"嵌入批次请求失败[{status_code}]，更换密钥重试: {e}",
+                                         extra={'ip': client_ip, 'key': api_key[:10], 'request_type': 'embeddings', 'model': model, 'status_code': status_code})
+            logger.warning(log_msg)
+            api_key = key_manager.lease_keys(1)[0]
+
+
+async def create_embeddings(request: EmbeddingRequest, key_manager, client_ip: str) -> dict:
+    """把输入切分为多个批次，使用不同的密钥并发请求 batchEmbedContents，按原顺序合并结果"""
+    if not key_manager.api_keys:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="没有可用的 API 密钥")
+    texts = normalize_input(request.input)
+    model = resolve_model(request.model)
+    batches = pack_batches(texts, EMBEDDING_BATCH_SIZE, EMBEDDING_BATCH_MAX_CHARS)
+    keys = key_manager.lease_keys(min(len(batches), EMBEDDING_CONCURRENCY))
+    log_msg = format_log_message('INFO', f"嵌入请求: {len(texts)} 条输入，拆分为 {len(batches)} 个批次，使用 {len(keys)} 个密钥",
+                                 extra={'ip': client_ip, 'request_type': 'embeddings', 'model': model})
+    logger.info(log_msg)
+    semaphore = asyncio.Semaphore(EMBEDDING_CONCURRENCY)
+
+    async with httpx.AsyncClient() as client:
+        async def run(index, start, end):
+            async with semaphore:
+                return await _embed_batch(client, key_manager, keys[index % len(keys)], model, texts[start:end], request.dimensions, client_ip)
+
+        tasks = [asyncio.create_task(run(index, start, end)) for index, (start, end) in enumerate(batches)]
+        try:
+            results = await asyncio.gather(*tasks)
+        except GeminiAPIError as e:
+            raise HTTPException(status_code=e.status_code if 400 <= e.status_code < 600 else 502, detail=e.message)
+        except httpx.TransportError as e:
+            raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail=f"上游连接失败: {e}")
+        finally:
+            # 任一批次失败或客户端断开时取消其余批次
+            for task in tasks:
+                task.cancel()
+
+    data = []
+    for vectors in results:
+        for values in vectors:
+            data.append({"object": "embedding", "index": len(data), "embedding": encode_embedding(values, request.encoding_format)})
+    # Gemini 不返回嵌入的token数，按约4个字符1个token估算
+    prompt_tokens = sum(len(text) for text in texts) // 4 or 1
+    return {
+        "object": "list",
+        "data": data,
+        "model": request.model,
+        "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens},
+    }
+
+
+def reload_embedding_settings():
+    """根据环境变量重新加载嵌入配置"""
+    _load_settings()
@@ -1,15 +1,25 @@
 from math import log
-import requests
 import json
 import os
 import re
+import asyncio
 from app.models import ChatCompletionRequest, Message  # 相对导入
 from dataclasses import dataclass
 from typing import Optional, Dict, Any, List
 import httpx
+import time
 import logging
 import datetime
 from .utils import GeminiAPIError
+from .media_cache import get_history_image, fetch_history_images
+from .message_cache import ConversionState, message_digest, message_prefix_cache
+from .context_cache import context_cache
+from . import metrics
+from .tracing import span, record_span, now_ns, traced
+from .model_registry import model_registry
+from .adaptive_limit import adaptive_limits
+from .context_window import context_window
+from .request_body import dumps_json
 from .models import Thought
 logger = logging.getLogger('my_logger')
 from dotenv import load_dotenv
@@ -30,6 +40,7 @@ class ResponseWrapper:
         self._prompt_token_count = self._extract_prompt_token_count()
         self._candidates_token_count = self._extract_candidates_token_count()
         self._total_token_count = self._extract_total_token_count()
+        self._cached_content_token_count = self._extract_cached_content_token_count()
         self._thoughts = self._extract_thoughts()
         self._json_dumps = json.dumps(self._data, indent=4, ensure_ascii=False)
 
@@ -80,6 +91,12 @@ class ResponseWrapper:
         except (KeyError):
             return None
 
+    def _extract_cached_content_token_count(self) -> Optional[int]:
+        try:
+            return self._data['usageMetadata'].get('cachedContentTokenCount')
+        except (KeyError):
+            return None
+
     @property
     def text(self) -> str:
         return self._text
@@ -100,6 +117,14 @@ class ResponseWrapper:
     def total_token_count(self) -> Optional[int]:
         return self._total_token_count
 
+    @property
+    def cached_content_token_count(self) -> Optional[int]:
+        return self._cached_content_token_count
+
+    @property
+    def usage_metadata(self) -> Dict[str, Any]:
+        return self._data.get('usageMetadata') or {}
+
     @property
     def thoughts(self) -> Optional[str]:
         return self._thoughts
@@ -157,8 +182,8 @@ class GeminiClient:
     
     @staticmethod
     def _parse_model_name_and_budget(model_name: str):
-        # 验证model_name是否以thinkingModels中的模型开头
-        if not any(model_name.startswith(m) for m in GeminiClient.thinkingModels):
+        # 验证model_name是否以thinkingModels中的模型开头(前缀树匹配)
+        if model_registry.thinking_prefix(model_name) is None:
             return None, None
             
         # 验证model_name不能包含image
@@ -201,67 +226,69 @@ class GeminiClient:
         # logger.info(f"_parse_model_name_and_budget model_name: {model_name}, base_model: {base_model}, thinking_budget: {thinking_budget}")
         return base_model, thinking_budget
 
+    @staticmethod
+    def upstream_model(model_name: str) -> str:
+        """实际请求的上游模型名(去掉思考预算后缀)，用于按模型的准入控制与并发上限"""
+        return GeminiClient._parse_model_name_and_budget(model_name)[0] or model_name
+
     # 过滤Markdown格式的图片
-    def filter_markdown_images(self, content):
-        import re
+    async def filter_markdown_images_async(self, content):
         if isinstance(content, list):
-            first_image_item_processed = False
-            for item in reversed(content):
-                if isinstance(item, dict) and 'parts' in item:
-                    # 只处理AI模型parts中text的Markdown图片
-                    if 'model' in item['role']:
-                        for part in reversed(item['parts']):
-                            if 'text' in part and '![' in part['text']:
-                                # 提取Markdown所有图片URL
-                                matches = re.finditer(r'!\[.*?\]\((.*?)\)', part['text'])
-                                for match in matches:
-                                    image_url = match.group(1)
-                                    # 根据配置决定是否下载图片
-                                    is_really = True if self.HISTORY_IMAGE_SUBMIT_TYPE == 'all' \
-                                        or (self.HISTORY_IMAGE_SUBMIT_TYPE == 'last' and not first_image_item_processed) else False
-                                    # 调用方法获取base64数据并添加到parts , is_really 是否真的下载图片
-                                    inline_data = self.get_inline_data_base64_images(image_url, is_really)
-                                    item['parts'].append(inline_data)
-                                if matches:
-                                    # 替换Markdown图片标记
-                                    part['text'] = re.sub(r'!\[.*?\]\(.*?\)', '[image]', part['text'])
-                                    first_image_item_processed = True
-
-            return content
+            pending_images = self._collect_markdown_images(content)
+            if not pending_images:
+                return content
+            # 并发获取所有需要真实提交的历史图片
+            urls = [image_url for _, image_url, is_really in pending_images if is_really]
+            with span("history_images", images=len(urls)):
+                images = await fetch_history_images(urls, self.storage)
+            for item, image_url, is_really in pending_images:
+                mime_type, base64_data = images.get(image_url, (None, None)) if is_really else (None, None)
+                item['parts'].append(self._inline_image_part(mime_type, base64_data))
         return content
 
+    def _collect_markdown_images(self, content):
+        """提取AI模型消息中的Markdown图片并替换为[image]标记
+
+        Returns:
+            list: [(消息item, 图片URL, 是否真的提交图片)]，顺序与原有处理顺序一致
+        """
+        pending_images = []
+        first_image_item_processed = False
+        for item in reversed(content):
+            if isinstance(item, dict) and 'parts' in item:
+                # 只处理AI模型parts中text的Markdown图片
+                if 'model' in item['role']:
+                    for part in reversed(item['parts']):
+                        if 'text' in part and '![' in part['text']:
+                            # 提取Markdown所有图片URL
+                            for match in re.finditer(r'!\[.*?\]\((.*?)\)', part['text']):
+                                # 根据配置决定是否提交图片
+                                is_really = True if self.HISTORY_IMAGE_SUBMIT_TYPE == 'all' \
+                                    or (self.HISTORY_IMAGE_SUBMIT_TYPE == 'last' and not first_image_item_processed) else False
+                                pending_images.append((item, match.group(1), is_really))
+                            # 替换Markdown图片标记
+                            part['text'] = re.sub(r'!\[.*?\]\(.*?\)', '[image]', part['text'])
+                            first_image_item_processed = True
+        return pending_images
+
     #根据 Markdown格式的图片 返回 base64 格式的图片  is_really 是否真的下载图片
     def get_inline_data_base64_images(self, markdown_image, is_really=True):
         # logger.info(f"下载请求中的图片: {markdown_image} is_really: {is_really}")
-        # 检查是否为内存存储，并尝试从内存中获取图片
-        if is_really and hasattr(self.storage, 'get_image'):
-            try:
-                # 从URL中提取文件名
-                image_name = markdown_image.split('/')[-1]
-                # logger.info(f"尝试从内存中获取图片: {image_name}")
-                base64_data,mime_type = self.storage.get_image(image_name)
-                # logger.info(f"内存中图片的MIME类型: {mime_type} 图片的大小: {len(base64_data)}")
-                if base64_data:
-                    return {
-                        "inline_data": {
-                            "mime_type": mime_type,
-                            "data": base64_data
-                        }
-                    }
-            except Exception:
-                pass
-
-        # 如果不是内存存储或从内存获取失败，则尝试下载
+        # 优先从本服务存储或历史图片缓存中获取，均未命中时才下载
         if is_really:
-            from app.utils import download_image_to_base64
-            mime_type, base64_data = download_image_to_base64(markdown_image)
-            if mime_type and base64_data:
-                return {
-                    "inline_data": {
-                        "mime_type": mime_type,
-                        "data": base64_data
-                    }
+            mime_type, base64_data = get_history_image(markdown_image, self.storage)
+            return self._inline_image_part(mime_type, base64_data)
+        return self._inline_image_part(None, None)
+
+    @staticmethod
+    def _inline_image_part(mime_type, base64_data):
+        if mime_type and base64_data:
+            return {
+                "inline_data": {
+                    "mime_type": mime_type,
+                    "data": base64_data
                 }
+            }
         # 如果下载失败，或不需要下载，返回默认无效图片
         return {
             "inline_data": {
@@ -279,14 +306,15 @@ class GeminiClient:
         "gemini-2.5-flash-image-preview"
     ]
 
+    @traced("image_save")
     def _save_image(self, mime_type: str, base64_data: str) -> str:
         # 直接使用初始化时创建的存储服务实例
         # 保存图片并返回URL
         return self.storage.save_image(mime_type, base64_data)
 
-    async def stream_chat(self, request: ChatCompletionRequest, contents, safety_settings, system_instruction, callback):
+    async def stream_chat(self, request: ChatCompletionRequest, contents, safety_settings, system_instruction, callback, on_usage=None):
         # 需要过滤contents 消息中的Markdown格式的图片、
-        contents = self.filter_markdown_images(contents);
+        contents = await self.filter_markdown_images_async(contents)
         # 此处根据 request.model 来判断是否是图片生成模型
         isImageModel = request.model in self.imageModels or "image" in request.model
 
@@ -299,6 +327,13 @@ class GeminiClient:
         if thinking_model is not None:
             base_model = thinking_model
 
+        # 长前缀命中上游上下文缓存时只发送剩余的contents
+        cached_content = None
+        if not isImageModel:
+            with span("context_cache"):
+                contents, system_instruction, cached_content = context_cache.prepare(
+                    self.BASE_URL, self.api_key, base_model, contents, system_instruction)
+
         url = f"{self.BASE_URL}/v1beta/models/{base_model}:streamGenerateContent?key={self.api_key}&alt=sse"
         headers = {
             "Content-Type": "application/json",
@@ -312,6 +347,8 @@ class GeminiClient:
             },
             "safetySettings": safety_settings
         }
+        if cached_content:
+            data["cachedContent"] = cached_content
         if system_instruction and not isImageModel:
             data["system_instruction"] = system_instruction
         # 思考模型需要设置思维预算
@@ -335,14 +372,39 @@ class GeminiClient:
                 data["generationConfig"]["thinkingConfig"]["thinkingBudget"] = google_config["thinking_budget"]
             
         # logger.info(f"请求数据: {json.dumps(data, ensure_ascii=False)}")
+        try:
+            response_wrapper = await self._stream_request(url, headers, data, callback, base_model, on_usage)
+        except (GeminiAPIError, httpx.HTTPError):
+            # 缓存句柄可能已过期或被删除，移除后重试时不再引用
+            if cached_content:
+                context_cache.invalidate(self.api_key, cached_content)
+            raise
+        context_cache.record_usage(response_wrapper.cached_content_token_count)
+        return response_wrapper
+
+    async def _stream_request(self, url, headers, data, callback, base_model, on_usage=None):
+        request_start = now_ns()
+        # now_ns 在未开启追踪时为0，自适应并发单独计时
+        started = time.monotonic()
+        first_line_at = None
+        chunks = 0
         async with httpx.AsyncClient() as client:
-            async with client.stream("POST", url, headers=headers, json=data, timeout=600) as response:
+            async with client.stream("POST", url, headers=headers, content=dumps_json(data), timeout=600) as response:
+                record_span("upstream_connect", request_start, status_code=response.status_code)
+                metrics.upstream_responses.inc(self.api_key[:10], base_model, str(response.status_code))
+                if response.status_code != 200:
+                    adaptive_limits.record(base_model, response.status_code)
                 buffer = b""
                 full_response_data = {}
                 try:
                     async for line in response.aiter_lines():
                         if not line.strip():
                             continue
+                        if first_line_at is None:
+                            first_line_at = now_ns()
+                            record_span("upstream_ttfb", request_start, first_line_at)
+                            adaptive_limits.record(base_model, 200, time.monotonic() - started)
+                        chunks += 1
                         if line.startswith("data: "):
                             line = line[len("data: "):]
                         buffer += line.encode('utf-8')
@@ -374,6 +436,9 @@ class GeminiClient:
 
                             if 'usageMetadata' in json_data:
                                 full_response_data['usageMetadata'] = json_data['usageMetadata']
+                                # 每个数据块的用量是累计值，先于文本回调上报
+                                if on_usage is not None:
+                                    on_usage(json_data['usageMetadata'])
 
                             if 'candidates' in json_data and json_data['candidates']:
                                 candidate = json_data['candidates'][0]
@@ -396,7 +461,8 @@ class GeminiClient:
                                                         base64_data = inline_data['data']
                                                         upload_start_time = datetime.datetime.now()
                                                         logger.info(f"生成的图片数据: {mime_type}--{len(base64_data)}")
-                                                        image_url = self._save_image(mime_type, base64_data)
+                                                        # 在线程中保存，客户端断开时可以立即取消而不阻塞事件循环
+                                                        image_url = await asyncio.to_thread(self._save_image, mime_type, base64_data)
                                                         upload_end_time = datetime.datetime.now()
                                                         upload_duration = (upload_end_time - upload_start_time).total_seconds()
                                                         logger.info(f"图片上传耗时: {upload_duration:.2f}秒")
@@ -424,13 +490,16 @@ class GeminiClient:
                             raise e
                 except Exception as e:
                     raise e
-                
+                finally:
+                    if first_line_at is not None:
+                        record_span("upstream_stream", first_line_at, chunks=chunks)
+
                 return ResponseWrapper(full_response_data)
 
 
-    def complete_chat(self, request: ChatCompletionRequest, contents, safety_settings, system_instruction):
+    async def complete_chat(self, request: ChatCompletionRequest, contents, safety_settings, system_instruction):
         # 需要过滤contents 消息中的Markdown格式的图片、
-        contents = self.filter_markdown_images(contents);
+        contents = await self.filter_markdown_images_async(contents)
         # 此处根据 request.model 来判断是否是图片生成模型
         isImageModel = request.model in self.imageModels
 
@@ -442,6 +511,12 @@ class GeminiClient:
         if thinking_model is not None:
             base_model = thinking_model
 
+        cached_content = None
+        if not isImageModel:
+            with span("context_cache"):
+                contents, system_instruction, cached_content = context_cache.prepare(
+                    self.BASE_URL, self.api_key, base_model, contents, system_instruction)
+
         url = f"{self.BASE_URL}/v1beta/models/{base_model}:generateContent?key={self.api_key}"
         headers = {
             "Content-Type": "application/json",
@@ -455,6 +530,8 @@ class GeminiClient:
             },
             "safetySettings": safety_settings
         }
+        if cached_content:
+            data["cachedContent"] = cached_content
         if system_instruction and not isImageModel:
             data["system_instruction"] = system_instruction
         if thinking_budget is not None:
@@ -476,8 +553,24 @@ class GeminiClient:
                 data["generationConfig"]["thinkingConfig"]["thinkingBudget"] = google_config["thinking_budget"]
 
         # logger.info(f"请求数据: {json.dumps(data, ensure_ascii=False)}")
-        response = requests.post(url, headers=headers, json=data)
-        response.raise_for_status()
+        try:
+            # 使用异步请求，客户端断开取消任务时立即关闭上游连接
+            with span("upstream_request", model=base_model) as upstream_span:
+                async with httpx.AsyncClient() as client:
+                    async with client.stream("POST", url, headers=headers, content=dumps_json(data), timeout=600) as response:
+                        headers_at = now_ns()
+                        await response.aread()
+            if upstream_span is not None:
+                # 收到响应头的耗时
+                record_span("upstream_ttfb", upstream_span.start_ns, headers_at)
+            metrics.upstream_responses.inc(self.api_key[:10], base_model, str(response.status_code))
+            # 非流式请求的耗时包含完整生成时间，不作为延迟样本
+            adaptive_limits.record(base_model, response.status_code)
+            response.raise_for_status()
+        except httpx.HTTPError:
+            if cached_content:
+                context_cache.invalidate(self.api_key, cached_content)
+            raise
         response_data = response.json()
         # logger.info(f"响应数据: {json.dumps(response_data, ensure_ascii=False)}")
                 # 检查响应中的错误
@@ -499,7 +592,7 @@ class GeminiClient:
                             upload_start_time = datetime.datetime.now()
                             logger.info(f"生成的图片数据: {mime_type}--{len(base64_data)}")
                             # 保存图片并获取HTTP URL
-                            image_url = self._save_image(mime_type, base64_data)
+                            image_url = await asyncio.to_thread(self._save_image, mime_type, base64_data)
                             # 计算上传耗时
                             upload_end_time = datetime.datetime.now()
                             upload_duration = (upload_end_time - upload_start_time).total_seconds()
@@ -515,14 +608,80 @@ class GeminiClient:
                                 # 如果没有找到文本部分，添加一个新的文本部分
                                 parts.append({"text": f"![]({image_url})"})
         
-        return ResponseWrapper(response_data)
-
-    def convert_messages(self, messages, use_system_prompt=False):
-        gemini_history = []
-        errors = []
-        system_instruction_text = ""
-        is_system_phase = use_system_prompt
-        for i, message in enumerate(messages):
+        response_wrapper = ResponseWrapper(response_data)
+        context_cache.record_usage(response_wrapper.cached_content_token_count)
+        return response_wrapper
+
+    @classmethod
+    async def batch_embed_contents(cls, client: httpx.AsyncClient, api_key: str, model: str, texts: List[str], dimensions: Optional[int] = None) -> List[List[float]]:
+        """调用 batchEmbedContents，返回与 texts 顺序一致的向量"""
+        url = f"{cls.BASE_URL}/v1beta/models/{model}:batchEmbedContents?key={api_key}"
+        requests_data = []
+        for text in texts:
+            item = {"model": f"models/{model}", "content": {"parts": [{"text": text}]}}
+            if dimensions:
+                item["outputDimensionality"] = dimensions
+            requests_data.append(item)
+        response = await client.post(url, json={"requests": requests_data}, timeout=120)
+        metrics.upstream_responses.inc(api_key[:10], model, str(response.status_code))
+        if response.status_code != 200:
+            try:
+                message = response.json().get("error", {}).get("message", response.text)
+            except ValueError:
+                message = response.text
+            raise GeminiAPIError(f"模型的响应异常:{message}", response.status_code, {})
+        embeddings = response.json().get("embeddings", [])
+        if len(embeddings) != len(texts):
+            raise GeminiAPIError(f"返回的向量数量({len(embeddings)})与输入数量({len(texts)})不一致", 502, {})
+        return [embedding.get("values", []) for embedding in embeddings]
+
+    @classmethod
+    def convert_messages(cls, messages, use_system_prompt=False):
+        """将OpenAI格式的消息转换为Gemini的contents与system_instruction
+
+        按消息的链式哈希缓存已转换前缀的快照，命中最长前缀后只转换新增的尾部消息。
+        返回的contents中每个part都是新的字典，可以被后续处理修改；
+        inline_data 中的base64图片数据只引用不复制。
+        """
+        digests = []
+        digest = b'system' if use_system_prompt else b'plain'
+        for message in messages:
+            digest = message_digest(digest, message)
+            digests.append(digest)
+
+        state, reused = ConversionState(is_system_phase=use_system_prompt), 0
+        for index in range(len(digests) - 1, -1, -1):
+            cached = message_prefix_cache.get(digests[index])
+            if cached is not None:
+                state, reused = cached, index + 1
+                break
+        message_prefix_cache.record(reused)
+
+        if reused < len(messages):
+            state = cls._convert_message_range(state, messages[reused:])
+            message_prefix_cache.put(digests[-1], state)
+
+        if state.errors:
+            return list(state.errors)
+        gemini_history = [{"role": role, "parts": [dict(part) for part in parts]} for role, parts in state.history]
+        return gemini_history, {"parts": [{"text": state.system_instruction_text}]}
+
+    @staticmethod
+    def _convert_message_range(state, messages):
+        """从快照开始继续转换消息，返回新的不可变快照"""
+        gemini_history = list(state.history)
+        errors = list(state.errors)
+        system_instruction_text = state.system_instruction_text
+        is_system_phase = state.is_system_phase
+
+        def append_parts(role_to_use, parts):
+            # 相同角色的连续消息合并到同一个content中
+            if gemini_history and gemini_history[-1][0] == role_to_use:
+                gemini_history[-1] = (role_to_use, gemini_history[-1][1] + parts)
+            else:
+                gemini_history.append((role_to_use, parts))
+
+        for message in messages:
             role = message.role
             content = message.content
 
@@ -543,11 +702,7 @@ class GeminiClient:
                         errors.append(f"Invalid role: {role}")
                         continue
 
-                    if gemini_history and gemini_history[-1]['role'] == role_to_use:
-                        gemini_history[-1]['parts'].append({"text": content})
-                    else:
-                        gemini_history.append(
-                            {"role": role_to_use, "parts": [{"text": content}]})
+                    append_parts(role_to_use, ({"text": content},))
             elif isinstance(content, list):
                 parts = []
                 for item in content:
@@ -557,7 +712,11 @@ class GeminiClient:
                         image_data = item.get('image_url', {}).get('url', '')
                         if image_data.startswith('data:image/'):
                             try:
-                                mime_type, base64_data = image_data.split(';')[0].split(':')[1], image_data.split(',')[1]
+                                # 只切分一次data URI，base64数据直接引用原字符串切片
+                                header, separator, base64_data = image_data.partition(',')
+                                if not separator:
+                                    raise ValueError(image_data)
+                                mime_type = header.split(';', 1)[0].split(':', 1)[1]
                                 parts.append({
                                     "inline_data": {
                                         "mime_type": mime_type,
@@ -579,37 +738,36 @@ class GeminiClient:
                     else:
                         errors.append(f"Invalid role: {role}")
                         continue
-                    if gemini_history and gemini_history[-1]['role'] == role_to_use:
-                        gemini_history[-1]['parts'].extend(parts)
-                    else:
-                        gemini_history.append(
-                            {"role": role_to_use, "parts": parts})
-        if errors:
-            return errors
-        else:
-            return gemini_history, {"parts": [{"text": system_instruction_text}]}
+                    append_parts(role_to_use, tuple(parts))
+
+        return ConversionState(tuple(gemini_history), tuple(errors), system_instruction_text, is_system_phase)
 
 
     def merge_model():
-        # 合并所有模型
-        models = []
-        models.extend(GeminiClient.GEMINI_MODELS)
-        models.extend(GeminiClient.EXTENDED_MODELS)
-        models.extend(GeminiClient.EXTRA_MODELS)
-        return models
-    
+        # 合并所有模型(Gemini模型、扩展模型与自定义模型)
+        model_registry.update(extended_models=GeminiClient.EXTENDED_MODELS, extra_models=GeminiClient.EXTRA_MODELS)
+        return model_registry.models
+
     @staticmethod
     async def list_available_models(api_key) -> list:
+        """获取指定API密钥可用的Gemini模型(不含 models/ 前缀)"""
         url = "{}/v1beta/models?key={}".format(GeminiClient.BASE_URL,api_key)
         async with httpx.AsyncClient() as client:
-            response = await client.get(url)
+            response = await client.get(url, timeout=30)
             response.raise_for_status()
             data = response.json()
-            models = [model["name"] for model in data.get("models", [])]
-            # 初始化Gemini模型列表
-            GeminiClient.GEMINI_MODELS = list(models)
-            # 合并扩展模型
-            models.extend(GeminiClient.EXTENDED_MODELS)
-            # 自定义模型列表
-            models.extend(GeminiClient.EXTRA_MODELS)
-            return models
+            models = {model["name"].replace("models/", "", 1): model.get("inputTokenLimit") for model in data.get("models", [])}
+            # 记录各模型的输入token上限，用于请求前的上下文窗口检查
+            context_window.update_limits(models)
+            return list(models)
+
+
+def _sync_available_models(models):
+    GeminiClient.GEMINI_MODELS = list(model_registry.gemini_models)
+    GeminiClient.AVAILABLE_MODELS = models
+
+
+# 模型列表由注册表统一维护，AVAILABLE_MODELS 与注册表保持同步
+model_registry.on_update(_sync_available_models)
+model_registry.set_thinking_models(GeminiClient.thinkingModels)
+model_registry.update(extended_models=GeminiClient.EXTENDED_MODELS, extra_models=GeminiClient.EXTRA_MODELS)
@@ -11,6 +11,8 @@ logger = logging.getLogger('my_logger')
 HOST_IMAGE_URL = os.environ.get('HOST_URL', 'https://generativelanguage.googleapis.com')
 # 导入全局图片存储实例
 from app.main import global_image_storage as storage
+# 与聊天接口使用相同的上游地址(PROXY_URL)
+from app.gemini import GeminiClient
 
 def gemini_image_request_converter(method, headers, request_json: Dict[str, Any]):
     """
@@ -90,7 +92,7 @@ def gemini_image_request_converter(method, headers, request_json: Dict[str, Any]
         if auth_header.startswith('Bearer '):
             api_key = auth_header[7:]  # 去掉'Bearer '前缀
         # 构建Gemini API URL
-        gemini_url = f"https://generativelanguage.googleapis.com/v1beta/models/{model}:predict?key={api_key}"
+        gemini_url = f"{GeminiClient.BASE_URL}/v1beta/models/{model}:predict?key={api_key}"
         # 发送请求到Gemini API
         response = requests.request(
             method='POST',  # 固定使用POST方法
@@ -239,7 +241,7 @@ def gemini_veo_request_converter(method, headers, request_json: Dict[str, Any]):
             api_key = auth_header[7:]
 
         # Step 1: Start the long-running prediction job
-        long_running_url = f"https://generativelanguage.googleapis.com/v1beta/models/{model}:predictLongRunning?key={api_key}"
+        long_running_url = f"{GeminiClient.BASE_URL}/v1beta/models/{model}:predictLongRunning?key={api_key}"
         initial_response = requests.post(long_running_url, headers={'Content-Type': 'application/json'}, data=new_request_body)
 
         if initial_response.status_code != 200:
@@ -255,7 +257,7 @@ def gemini_veo_request_converter(method, headers, request_json: Dict[str, Any]):
         # 记录任务开始时间
         start_time = time.time()
         # Step 2: Poll for the result
-        status_url = f"https://generativelanguage.googleapis.com/v1beta/{op_name}?key={api_key}"
+        status_url = f"{GeminiClient.BASE_URL}/v1beta/{op_name}?key={api_key}"
         while True:
             status_response = requests.get(status_url)
             if status_response.status_code != 200:
@@ -0,0 +1,41 @@
+import hashlib
+
+# 超过该长度的字符串(如base64图片)单独计算摘要后再并入，不参与整体的序列化
+LARGE_STRING_CHARS = 64 * 1024
+
+
+def update_hash(h, value):
+    """把JSON结构的值逐项写入哈希对象
+
+    与先 json.dumps 再整体编码相比，不会为包含多MB内联图片的contents构建一个巨大的规范化字符串；
+    每个值带有类型标记与长度前缀，不同的结构不会得到相同的输入。字典按键排序，结果与键的顺序无关。
+    """
+    if isinstance(value, str):
+        if len(value) >= LARGE_STRING_CHARS:
+            h.update(b'H')
+            h.update(hashlib.blake2b(value.encode('utf-8', 'surrogatepass'), digest_size=32).digest())
+        else:
+            h.update(b's%d:' % len(value))
+            h.update(value.encode('utf-8', 'surrogatepass'))
+    elif isinstance(value, dict):
+        h.update(b'd%d:' % len(value))
+        for key in sorted(value, key=str):
+            update_hash(h, str(key))
+            update_hash(h, value[key])
+    elif isinstance(value, (list, tuple)):
+        h.update(b'l%d:' % len(value))
+        for item in value:
+            update_hash(h, item)
+    elif value is None or isinstance(value, (bool, int, float)):
+        h.update(b'n')
+        h.update(repr(value).encode('ascii'))
+        h.update(b';')
+    else:
+        update_hash(h, str(value))
+
+
+def structured_digest(value) -> str:
+    """JSON结构的值的sha256摘要(十六进制)"""
+    h = hashlib.sha256()
+    update_hash(h, value)
+    return h.hexdigest()
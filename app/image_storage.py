@@ -3,19 +3,38 @@ import base64
 import uuid
 from datetime import datetime
 import time
+import functools
 import logging
 from abc import ABC, abstractmethod
 from typing import Optional
+from . import metrics
 
 logger = logging.getLogger('my_logger')
 from dotenv import load_dotenv
 # 加载.env文件中的环境变量
 load_dotenv()
 
+def _timed_save(save_image, storage_name):
+    @functools.wraps(save_image)
+    def wrapper(self, *args, **kwargs):
+        start_time = time.monotonic()
+        try:
+            return save_image(self, *args, **kwargs)
+        finally:
+            metrics.storage_save_duration.observe(time.monotonic() - start_time, storage_name)
+    return wrapper
+
+
 # 抽象基类
 class ImageStorage(ABC):
     """图片存储的抽象基类，定义了存储图片的接口"""
     
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # 为所有存储实现的 save_image 统计保存耗时
+        if 'save_image' in cls.__dict__:
+            cls.save_image = _timed_save(cls.save_image, cls.__name__)
+
     @abstractmethod
     def save_image(self, mime_type: str, base64_data: str) -> str:
         """保存图片并返回可访问的URL"""
@@ -0,0 +1,101 @@
+import asyncio
+import threading
+from collections import deque
+from typing import Any, List, Optional, Tuple
+
+# 保留的历史日志数量，新连接的客户端会先收到这些日志
+LOG_HISTORY_SIZE = 1000
+# 每个订阅者的缓冲队列大小，队列满时跳过新日志而不是阻塞写日志的线程
+SUBSCRIBER_QUEUE_SIZE = 1000
+
+
+class LogSubscriber:
+    """单个订阅者(例如一个websocket连接)，拥有独立的有界队列与读取位置"""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, maxsize: int):
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        # 已投递给客户端的最后一个序号
+        self.cursor = 0
+        self.skipped = 0
+
+    def _put(self, seq: int, item: Any):
+        # 只在订阅者所在的事件循环中调用
+        try:
+            self.queue.put_nowait((seq, item))
+        except asyncio.QueueFull:
+            self.skipped += 1
+
+    async def get(self) -> Tuple[int, Any, int]:
+        """等待下一条日志
+
+        Returns:
+            tuple: (序号, 日志内容, 与上一条日志之间被跳过的数量)
+        """
+        while True:
+            seq, item = await self.queue.get()
+            if seq <= self.cursor:
+                continue
+            gap = seq - self.cursor - 1
+            self.cursor = seq
+            return seq, item, gap
+
+
+class LogBus:
+    """日志发布/订阅总线
+
+    日志可以在任意线程中发布，每条日志带有递增序号。订阅者通过各自事件循环的
+    call_soon_threadsafe 接收日志，空闲时没有任何轮询开销；处理不过来的订阅者会跳过日志，
+    跳过的数量可以通过序号差得知。
+    """
+
+    def __init__(self, history_size: int = LOG_HISTORY_SIZE, queue_size: int = SUBSCRIBER_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._history: deque = deque(maxlen=history_size)
+        self._seq = 0
+        self._subscribers: List[LogSubscriber] = []
+        self._lock = threading.Lock()
+
+    def publish(self, item: Any) -> int:
+        with self._lock:
+            self._seq += 1
+            seq = self._seq
+            self._history.append((seq, item))
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.loop.call_soon_threadsafe(subscriber._put, seq, item)
+            except RuntimeError:
+                # 事件循环已关闭
+                self.unsubscribe(subscriber)
+        return seq
+
+    def subscribe(self, loop: Optional[asyncio.AbstractEventLoop] = None) -> Tuple[LogSubscriber, List[Tuple[int, Any]]]:
+        """注册订阅者
+
+        Returns:
+            tuple: (订阅者, 当前的历史日志[(序号, 日志内容)])，历史日志与后续推送的日志之间不会重复或遗漏
+        """
+        subscriber = LogSubscriber(loop or asyncio.get_running_loop(), self.queue_size)
+        with self._lock:
+            backlog = list(self._history)
+            subscriber.cursor = self._seq
+            self._subscribers.append(subscriber)
+        return subscriber, backlog
+
+    def unsubscribe(self, subscriber: LogSubscriber):
+        with self._lock:
+            if subscriber in self._subscribers:
+                self._subscribers.remove(subscriber)
+
+    def recent(self) -> List[Tuple[int, Any]]:
+        with self._lock:
+            return list(self._history)
+
+    @property
+    def subscriber_count(self) -> int:
+        return len(self._subscribers)
+
+
+# 全局日志总线实例
+log_bus = LogBus()
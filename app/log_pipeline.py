@@ -0,0 +1,194 @@
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import random
+import logging
+import threading
+from datetime import datetime
+from logging.handlers import QueueHandler
+from typing import Optional
+
+from .log_bus import log_bus
+from dotenv import load_dotenv
+# 加载.env文件中的环境变量
+load_dotenv()
+
+LOG_FORMAT_DEBUG = '%(asctime)s-%(levelname)s-[%(ip)s]-[%(key)s]-%(request_type)s-[%(model)s]-%(status_code)s: %(message)s-%(error_message)s'
+LOG_FORMAT_NORMAL = '%(asctime)s-%(levelname)s-[%(ip)s]-[%(key)s]-%(request_type)s-[%(model)s]-%(status_code)s: %(message)s'
+# 文本格式中使用的字段
+TEXT_FIELDS = ('ip', 'key', 'request_type', 'model', 'status_code', 'error_message')
+# 单次写入的最大日志条数
+BATCH_SIZE = 256
+
+
+def _load_settings():
+    global DEBUG, LOG_LEVEL, LOG_OUTPUT_FORMAT, LOG_SUCCESS_SAMPLE_RATE
+    DEBUG = os.environ.get("DEBUG", "false").lower() == "true"
+    # 日志级别，低于该级别的日志在格式化之前就被丢弃
+    LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+    # 控制台日志格式: text(与原有格式一致) 或 json(每行一条JSON)
+    LOG_OUTPUT_FORMAT = os.environ.get("LOG_OUTPUT_FORMAT", "text").lower()
+    # 成功请求日志的采样比例(0-1)，高并发时可以降低以减少日志量
+    LOG_SUCCESS_SAMPLE_RATE = float(os.environ.get("LOG_SUCCESS_SAMPLE_RATE", 1))
+
+
+_load_settings()
+
+
+def _level_number() -> int:
+    level = logging.getLevelName(LOG_LEVEL)
+    return level if isinstance(level, int) else logging.INFO
+
+
+class LogEvent:
+    """结构化日志事件
+
+    创建时只记录时间戳与字段，文本在后台线程中写出时才格式化。
+    str(event) 返回与原有 format_log_message 相同格式的文本。
+    """
+    __slots__ = ('created', 'level', 'message', 'extra', '_text')
+
+    def __init__(self, level: str, message, extra: Optional[dict] = None, created: Optional[float] = None):
+        self.created = created or time.time()
+        self.level = level
+        self.message = message
+        # 调用方之后可能修改extra，这里保存一份浅拷贝
+        self.extra = dict(extra) if extra else {}
+        self._text = None
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            log_values = {name: self.extra.get(name, 'N/A') for name in TEXT_FIELDS}
+            log_values['error_message'] = self.extra.get('error_message', '')
+            log_values['asctime'] = datetime.fromtimestamp(self.created).strftime("%Y-%m-%d %H:%M:%S")
+            log_values['levelname'] = self.level
+            log_values['message'] = self.message
+            log_format = LOG_FORMAT_DEBUG if DEBUG else LOG_FORMAT_NORMAL
+            self._text = log_format % log_values
+        return self._text
+
+    def __str__(self) -> str:
+        return self.text
+
+    def to_dict(self) -> dict:
+        data = {
+            "ts": datetime.fromtimestamp(self.created).isoformat(timespec='milliseconds'),
+            "level": self.level,
+            "message": str(self.message),
+        }
+        for name, value in self.extra.items():
+            data.setdefault(name, value if isinstance(value, (int, float, bool, type(None))) else str(value))
+        return data
+
+    @property
+    def is_success(self) -> bool:
+        return self.level == 'INFO' and str(self.extra.get('status_code')) == '200'
+
+
+class SuccessSampleFilter(logging.Filter):
+    """按 LOG_SUCCESS_SAMPLE_RATE 对成功请求日志采样，其它日志全部保留"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if LOG_SUCCESS_SAMPLE_RATE >= 1:
+            return True
+        msg = record.msg
+        if isinstance(msg, LogEvent) and msg.is_success:
+            return random.random() < LOG_SUCCESS_SAMPLE_RATE
+        return True
+
+
+class DeferredQueueHandler(QueueHandler):
+    """只把日志记录放入队列，不在调用线程(事件循环)中格式化"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def record_to_event(record: logging.LogRecord) -> LogEvent:
+    msg = record.msg
+    if isinstance(msg, LogEvent) and not record.args:
+        event = msg
+    else:
+        event = LogEvent(record.levelname, record.getMessage(), created=record.created)
+    if record.exc_info:
+        event.message = f"{event.message}\n{logging.Formatter().formatException(record.exc_info)}"
+        event._text = None
+    return event
+
+
+class BatchingLogListener:
+    """后台日志写入线程
+
+    从队列中批量取出日志，一次写入控制台，并把结构化日志发布到日志总线供 /ws/logs 使用。
+    """
+    _STOP = object()
+
+    def __init__(self, log_queue: queue.SimpleQueue, stream=None):
+        self.queue = log_queue
+        self.stream = stream or sys.stderr
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None and self._thread.is_alive():
+            self.queue.put(self._STOP)
+            self._thread.join(timeout=5)
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = self._STOP in batch
+            self._write([record for record in batch if record is not self._STOP])
+            if stop:
+                return
+
+    def _write(self, records):
+        lines = []
+        for record in records:
+            try:
+                event = record_to_event(record)
+                data = event.to_dict()
+                data['text'] = event.text
+                lines.append(json.dumps(data, ensure_ascii=False) if LOG_OUTPUT_FORMAT == 'json' else event.text)
+                log_bus.publish(data)
+            except Exception as e:
+                lines.append(f"日志格式化失败: {e}")
+        if not lines:
+            return
+        try:
+            self.stream.write("\n".join(lines) + "\n")
+            self.stream.flush()
+        except Exception:
+            pass
+
+
+def setup_log_pipeline(logger: logging.Logger) -> BatchingLogListener:
+    """为logger配置队列处理器与后台写入线程"""
+    log_queue = queue.SimpleQueue()
+    handler = DeferredQueueHandler(log_queue)
+    handler.addFilter(SuccessSampleFilter())
+    logger.addHandler(handler)
+    logger.setLevel(_level_number())
+    listener = BatchingLogListener(log_queue)
+    listener.start()
+    # 退出时写完队列中剩余的日志
+    atexit.register(listener.stop)
+    return listener
+
+
+def reload_log_settings(logger: logging.Logger):
+    """根据环境变量重新加载日志级别、输出格式与采样比例"""
+    _load_settings()
+    logger.setLevel(_level_number())
@@ -0,0 +1,252 @@
+import os
+import sys
+import time
+import asyncio
+import logging
+import threading
+import traceback
+from collections import deque, defaultdict
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from . import metrics
+from .utils import format_log_message
+from dotenv import load_dotenv
+# 加载.env文件中的环境变量
+load_dotenv()
+
+logger = logging.getLogger("my_logger")
+
+# 保留的慢回调记录数量
+SLOW_EVENT_HISTORY_SIZE = 50
+
+
+def _load_settings():
+    global LOOP_MONITOR_ENABLED, LOOP_MONITOR_INTERVAL, SLOW_CALLBACK_THRESHOLD_MS, PROFILER_INTERVAL_MS, PROFILER_MAX_SECONDS
+    # 是否启用事件循环监控
+    LOOP_MONITOR_ENABLED = os.environ.get("LOOP_MONITOR_ENABLED", "true").lower() == "true"
+    # 心跳间隔(秒)
+    LOOP_MONITOR_INTERVAL = float(os.environ.get("LOOP_MONITOR_INTERVAL", 0.1))
+    # 事件循环被阻塞超过该时长(毫秒)时记录调用栈
+    SLOW_CALLBACK_THRESHOLD_MS = float(os.environ.get("SLOW_CALLBACK_THRESHOLD_MS", 100))
+    # 采样分析器的采样间隔(毫秒)
+    PROFILER_INTERVAL_MS = float(os.environ.get("PROFILER_INTERVAL_MS", 5))
+    # 采样分析器单次最长运行时间(秒)，超时自动停止
+    PROFILER_MAX_SECONDS = float(os.environ.get("PROFILER_MAX_SECONDS", 60))
+
+
+_load_settings()
+
+
+def _format_frame(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+def fold_stack(frame) -> str:
+    """把调用栈转换为火焰图使用的折叠格式(从栈底到栈顶，以分号分隔)"""
+    names = []
+    while frame is not None:
+        names.append(_format_frame(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class LoopMonitor:
+    """事件循环延迟与慢回调监控
+
+    事件循环中按固定间隔运行心跳回调，心跳的实际执行时间与预期时间之差即为循环延迟。
+    后台看门狗线程发现心跳超过阈值未更新时，说明事件循环正被同步代码阻塞，
+    此时通过 sys._current_frames() 抓取事件循环线程的调用栈。
+    """
+
+    def __init__(self):
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._handle: Optional[asyncio.TimerHandle] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._last_beat = time.monotonic()
+        self._expected = 0.0
+        # 当前正在进行的阻塞事件(看门狗已记录但心跳尚未恢复)
+        self._stall: Optional[Dict[str, Any]] = None
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.slow_callbacks = 0
+        self.slow_events: deque = deque(maxlen=SLOW_EVENT_HISTORY_SIZE)
+
+    @property
+    def running(self) -> bool:
+        return self._loop is not None
+
+    def start(self, loop: Optional[asyncio.AbstractEventLoop] = None):
+        """在事件循环线程中调用"""
+        if self.running or not LOOP_MONITOR_ENABLED:
+            return
+        self._loop = loop or asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._stop = threading.Event()
+        self._last_beat = time.monotonic()
+        self._schedule()
+        self._watchdog = threading.Thread(target=self._watch, args=(self._stop,), name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+
+    def stop(self):
+        if not self.running:
+            return
+        self._stop.set()
+        if self._handle is not None:
+            self._handle.cancel()
+        self._loop = None
+        self._handle = None
+
+    def _schedule(self):
+        self._expected = time.monotonic() + LOOP_MONITOR_INTERVAL
+        self._handle = self._loop.call_later(LOOP_MONITOR_INTERVAL, self._beat)
+
+    def _beat(self):
+        now = time.monotonic()
+        lag = max(now - self._expected, 0.0)
+        self.last_lag = lag
+        self.max_lag = max(self.max_lag, lag)
+        metrics.event_loop_lag.observe(lag)
+        with self._lock:
+            self._last_beat = now
+            stall, self._stall = self._stall, None
+        if stall is not None:
+            # 阻塞结束，记录实际阻塞时长
+            stall["blocked_ms"] = round(lag * 1000, 1)
+        if self._loop is not None:
+            self._schedule()
+
+    def _watch(self, stop: threading.Event):
+        while not stop.wait(min(LOOP_MONITOR_INTERVAL, SLOW_CALLBACK_THRESHOLD_MS / 2000)):
+            threshold = SLOW_CALLBACK_THRESHOLD_MS / 1000
+            with self._lock:
+                blocked = time.monotonic() - self._last_beat - LOOP_MONITOR_INTERVAL
+                if blocked < threshold or self._stall is not None:
+                    continue
+                frame = sys._current_frames().get(self._loop_thread_id)
+                event = {
+                    "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                    "blocked_ms": round(blocked * 1000, 1),
+                    "stack": "".join(traceback.format_stack(frame)) if frame is not None else "",
+                }
+                self._stall = event
+                self.slow_events.append(event)
+                self.slow_callbacks += 1
+            metrics.slow_callbacks_total.inc()
+            top = event["stack"].strip().splitlines()[-2:] if event["stack"] else []
+            log_msg = format_log_message('WARNING', f"事件循环被阻塞超过 {SLOW_CALLBACK_THRESHOLD_MS:.0f}ms: {' | '.join(line.strip() for line in top)}",
+                                         extra={'request_type': 'loop_monitor'})
+            logger.warning(log_msg)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.running,
+            "interval": LOOP_MONITOR_INTERVAL,
+            "slow_callback_threshold_ms": SLOW_CALLBACK_THRESHOLD_MS,
+            "last_lag_ms": round(self.last_lag * 1000, 2),
+            "max_lag_ms": round(self.max_lag * 1000, 2),
+            "slow_callbacks": self.slow_callbacks,
+            # 最近的慢回调，最新的在前
+            "recent_slow_callbacks": list(reversed(self.slow_events)),
+        }
+
+
+class SamplingProfiler:
+    """采样分析器
+
+    在后台线程中按固定间隔抓取事件循环线程(或所有线程)的调用栈并累计次数，
+    结果为火焰图工具(flamegraph.pl、speedscope 等)可以直接读取的折叠格式。
+    """
+
+    def __init__(self):
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._counts: Dict[str, int] = defaultdict(int)
+        self.samples = 0
+        self.started_at: Optional[float] = None
+        self.stopped_at: Optional[float] = None
+        self.all_threads = False
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, duration: Optional[float] = None, interval_ms: Optional[float] = None, all_threads: bool = False) -> bool:
+        """开始采样，已在运行时返回 False"""
+        with self._lock:
+            if self.running:
+                return False
+            self._counts = defaultdict(int)
+            self.samples = 0
+            self.all_threads = all_threads
+            self.started_at = time.time()
+            self.stopped_at = None
+            self._stop.clear()
+            duration = min(duration or PROFILER_MAX_SECONDS, PROFILER_MAX_SECONDS)
+            interval = (interval_ms or PROFILER_INTERVAL_MS) / 1000
+            self._thread = threading.Thread(target=self._run, args=(duration, interval), name="sampling-profiler", daemon=True)
+            self._thread.start()
+        return True
+
+    def stop(self):
+        self._stop.set()
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout=5)
+
+    def _run(self, duration: float, interval: float):
+        own_id = threading.get_ident()
+        # 未启用监控时，事件循环默认运行在主线程
+        target_id = loop_monitor._loop_thread_id or threading.main_thread().ident
+        deadline = time.monotonic() + duration
+        while not self._stop.wait(interval) and time.monotonic() < deadline:
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, frame in frames.items():
+                    if thread_id == own_id:
+                        continue
+                    if not self.all_threads and thread_id != target_id:
+                        continue
+                    self._counts[fold_stack(frame)] += 1
+                self.samples += 1
+        self.stopped_at = time.time()
+
+    def folded(self) -> str:
+        """返回折叠格式的采样结果，每行为 "栈;帧 次数" """
+        with self._lock:
+            items = sorted(self._counts.items(), key=lambda item: item[1], reverse=True)
+        return "\n".join(f"{stack} {count}" for stack, count in items)
+
+    def status(self) -> Dict[str, Any]:
+        end = self.stopped_at if self.stopped_at is not None else time.time()
+        return {
+            "running": self.running,
+            "samples": self.samples,
+            "unique_stacks": len(self._counts),
+            "all_threads": self.all_threads,
+            "elapsed": round(end - self.started_at, 1) if self.started_at else 0,
+            "max_seconds": PROFILER_MAX_SECONDS,
+        }
+
+
+# 全局事件循环监控与采样分析器实例
+loop_monitor = LoopMonitor()
+sampling_profiler = SamplingProfiler()
+
+
+def reload_loop_monitor():
+    """根据环境变量重新加载监控配置"""
+    _load_settings()
+    if loop_monitor.running and not LOOP_MONITOR_ENABLED:
+        loop_monitor.stop()
+    elif not loop_monitor.running and LOOP_MONITOR_ENABLED:
+        try:
+            loop_monitor.start()
+        except RuntimeError:
+            # 不在事件循环中调用时等待下次启动
+            pass
@@ -1,11 +1,13 @@
 from fastapi import FastAPI, HTTPException, Request, Depends, status, Body, WebSocket, WebSocketDisconnect
-from fastapi.responses import JSONResponse, StreamingResponse, HTMLResponse, FileResponse
+from fastapi.responses import JSONResponse, StreamingResponse, HTMLResponse, FileResponse, PlainTextResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi.middleware.cors import CORSMiddleware
-from .models import AccessKey, AccessKeyCreate, ChatCompletionRequest, ChatCompletionResponse, ErrorResponse, ModelList ,Thought
+from fastapi.exceptions import RequestValidationError
+from pydantic import ValidationError
+from .models import AccessKey, AccessKeyCreate, ChatCompletionRequest, ChatCompletionResponse, ErrorResponse, ModelList ,Thought, EmbeddingRequest
 from .gemini import GeminiClient, ResponseWrapper
-from .utils import handle_gemini_error, protect_from_abuse, APIKeyManager, test_api_key, format_log_message, generate_random_alphanumeric, get_client_ip,log_records,get_log_new,set_log_new,download_image_to_base64, GeminiServiceUnavailableError, GeminiAPIError
+from .utils import handle_gemini_error, protect_from_abuse, APIKeyManager, test_api_key, format_log_message, generate_random_alphanumeric, get_client_ip,download_image_to_base64, GeminiServiceUnavailableError, GeminiAPIError
 
 
 import os
@@ -22,8 +24,7 @@ import base64
 from dotenv import load_dotenv, set_key
 from jose import JWTError, jwt
 from datetime import timedelta
-import requests
-import psutil
+import httpx
 # 加载.env文件中的环境变量
 load_dotenv()
 
@@ -34,9 +35,8 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 1440
 logging.getLogger("uvicorn").disabled = True
 logging.getLogger("uvicorn.access").disabled = True
 
-# 配置 logger
+# 配置 logger (处理器与日志级别在 utils 中统一配置)
 logger = logging.getLogger("my_logger")
-logger.setLevel(logging.DEBUG)
 
 def translate_error(message: str) -> str:
     if "quota exceeded" in message.lower():
@@ -74,7 +74,7 @@ templates = Jinja2Templates(directory="app/templates")
 
 from .config_manager import (
     load_api_mappings, save_api_mappings, get_api_mappings,
-    load_access_keys, save_access_keys, get_access_keys, access_keys_lock,
+    load_access_keys, save_access_keys, save_access_keys_later, flush_access_keys, get_access_keys, access_keys_lock,
     load_gemini_api_keys, save_gemini_api_keys, get_gemini_api_keys,
     schedule_daily_reset
 )
@@ -85,17 +85,48 @@ app.mount("/images", StaticFiles(directory="app/images"), name="images")
 
 # 导入图片存储模块
 from .image_storage import get_image_storage, ImageStorage, MemoryImageStorage, LocalImageStorage
+from .media_cache import history_image_cache, reload_history_image_cache
+from .message_cache import message_prefix_cache, reload_message_prefix_cache
+from .context_cache import context_cache, reload_context_cache
+from . import metrics
+from .log_bus import log_bus
+from .log_pipeline import reload_log_settings
+from .sysinfo import sysinfo_sampler, InFlightMiddleware, reload_sysinfo_sampler
+from .loop_monitor import loop_monitor, sampling_profiler, reload_loop_monitor
+from .tracing import TracingMiddleware, span, traced, trace_exporter, reload_tracing
+from .model_registry import model_registry, reload_model_registry
+from .embeddings import create_embeddings, reload_embedding_settings
+from .batch_queue import batch_queue, owner_of, parse_upload, reload_batch_settings
+from .admission import admission_controller, reload_admission_settings, SlotResponse
+from .adaptive_limit import adaptive_limits, reload_adaptive_limits
+from .usage import usage_ledger, UsageEvent, TokenBudgetExceeded, reload_usage_settings
+from .context_window import context_window, ContextWindowExceeded, reload_context_window
+from .auth_cache import auth_cache, AuthDecision, reload_auth_cache
+from .ip_filter import IPMatcher, parse_ip_list
+from .request_body import BodySizeLimitMiddleware, request_body_limits, read_json_body, reload_request_body_settings
+from .compression import CompressionMiddleware, compression_stats, reload_compression_settings
+from .response_cache import response_cache, reload_response_cache, CachedResponse, build_cache_key, is_cacheable as is_response_cacheable
+from .request_coalescer import request_coalescer, reload_request_coalescer, should_coalesce, SubscriberTooSlow
+
+# 统计正在处理中的请求数量，供 /ws/sysinfo 与 /metrics 使用
+app.add_middleware(InFlightMiddleware)
+# 请求耗时分解追踪(Server-Timing 响应头与 OTLP 导出)
+app.add_middleware(TracingMiddleware)
+# 按路由限制请求体大小，超出时返回413
+app.add_middleware(BodySizeLimitMiddleware)
+# 按 Accept-Encoding 压缩响应，最后添加的中间件最先处理请求
+app.add_middleware(CompressionMiddleware)
 
 # 创建全局图片存储实例
 global_image_storage = get_image_storage()
 
-# IP授权池
-WHITELIST_IPS = os.environ.get("WHITELIST_IPS", "").split(",")
-authorized_ips = set(ip.strip() for ip in WHITELIST_IPS if ip.strip())
+# IP授权池(支持CIDR网段与IPv6)
+WHITELIST_IPS = parse_ip_list(os.environ.get("WHITELIST_IPS", ""))
+authorized_ips = IPMatcher("whitelist", WHITELIST_IPS)
 
-# IP黑名单
-BLACKLIST_IPS = os.environ.get("BLACKLIST_IPS", "").split(",")
-blacklisted_ips = set(ip.strip() for ip in BLACKLIST_IPS if ip.strip())
+# IP黑名单(支持CIDR网段与IPv6)
+BLACKLIST_IPS = parse_ip_list(os.environ.get("BLACKLIST_IPS", ""))
+blacklisted_ips = IPMatcher("blacklist", BLACKLIST_IPS)
 
 PASSWORD = os.environ.get("PASSWORD", "123")
 MAX_REQUESTS_PER_MINUTE = int(os.environ.get("MAX_REQUESTS_PER_MINUTE", "30"))
@@ -161,6 +192,20 @@ key_manager = None
 current_api_key = None
 
 
+def _api_key_pool_state():
+    if key_manager is None:
+        return {}
+    return {
+        ("configured",): len(key_manager.api_keys),
+        ("available",): len(key_manager.key_stack),
+    }
+
+
+metrics.api_keys.set_callback(_api_key_pool_state)
+metrics.in_flight_requests.set_callback(lambda: {(): sysinfo_sampler.in_flight})
+
+
+@traced("key_acquire")
 def switch_api_key():
     global current_api_key
     key = key_manager.get_available_key() # get_available_key 会处理栈的逻辑
@@ -204,13 +249,12 @@ async def reload_keys():
         log_msg = format_log_message('INFO', f"最大重试次数设置为：{len(key_manager.api_keys)}")
         logger.info(log_msg)
         if key_manager.api_keys:
-            try:
-                all_models = await GeminiClient.list_available_models(key_manager.api_keys[0])
-                GeminiClient.AVAILABLE_MODELS = [model.replace("models/", "") for model in all_models]
+            # 从多个抽样密钥获取模型列表并合并，之后由后台任务定期刷新
+            if await model_registry.discover(key_manager.api_keys, GeminiClient.list_available_models):
                 log_msg = format_log_message('INFO', "Available models loaded.")
                 logger.info(log_msg)
-            except Exception as e:
-                log_msg = format_log_message('ERROR', f"Failed to load models: {e}")
+            else:
+                log_msg = format_log_message('ERROR', "Failed to load models")
                 logger.error(log_msg)
     else:
         log_msg = format_log_message('ERROR', "No available API keys after reload.")
@@ -228,26 +272,36 @@ async def startup_event():
     key_manager = APIKeyManager(get_gemini_api_keys()) # 实例化 APIKeyManager，栈会在 __init__ 中初始化
     current_api_key = key_manager.get_available_key()
     schedule_daily_reset()
+    # 监控事件循环延迟与阻塞事件循环的同步调用
+    loop_monitor.start()
+    # 在事件循环之外记录的上游结果转到事件循环中调整并发上限
+    adaptive_limits.start()
     log_msg = format_log_message('INFO', "Starting Gemini API proxy...")
     logger.info(log_msg)
     await reload_keys()
+    model_registry.start_periodic_discovery(lambda: key_manager.api_keys, GeminiClient.list_available_models)
+    # 启动批处理任务调度，继续处理上次未完成的任务
+    batch_queue.start(lambda: key_manager, run_batch_item)
+    # 加载用量统计并定期保存
+    usage_ledger.start()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await usage_ledger.flush()
+    await asyncio.to_thread(flush_access_keys)
 
 
 def update_access_key_usage(token: str):
     if token.startswith("sk-"):
-        access_keys = get_access_keys()
-        key_data = access_keys.get(token)
-        if key_data:
-            key = AccessKey(**key_data)
-            if key.is_active and key.usage_limit is not None and key.usage_limit > 0:
-                with access_keys_lock:
-                    # Re-fetch to ensure atomicity
-                    key_data = access_keys.get(token)
-                    if key_data:
-                        key = AccessKey(**key_data)
-                        key.usage_count += 1
-                        access_keys[token] = key.dict()
-                        save_access_keys()
+        key_data = get_access_keys().get(token)
+        if key_data and key_data.get('is_active', True) and key_data.get('usage_limit') is not None and key_data['usage_limit'] > 0:
+            with access_keys_lock:
+                # 在锁内重新读取，保证计数原子性；文件在后台线程中合并写入
+                key_data = get_access_keys().get(token)
+                if key_data:
+                    key_data['usage_count'] = key_data.get('usage_count', 0) + 1
+                    save_access_keys_later()
 
 
 # 专门用于Admin后台的JWT Token验证
@@ -274,7 +328,50 @@ async def verify_jwt_token(request: Request):
             headers={"WWW-Authenticate": "Bearer"},
         )
 
+def deactivate_access_key(token: str):
+    """将访问密钥标记为失效，文件在后台线程中写入"""
+    with access_keys_lock:
+        key_data = get_access_keys().get(token)
+        if key_data:
+            key_data['is_active'] = False
+            save_access_keys_later()
+    auth_cache.invalidate(token)
+
+
+def resolve_auth_decision(token: str):
+    """根据访问密钥与管理密码计算鉴权结果，令牌无效时返回 None"""
+    if token.startswith("sk-"):
+        key_data = get_access_keys().get(token)
+        if key_data:
+            return AuthDecision("access_key" if key_data.get("is_active", True) else "inactive", key_data)
+    if token == PASSWORD:
+        return AuthDecision("password")
+    return None
+
+
+def check_access_key(token: str, decision: AuthDecision, client_ip: str):
+    """检查访问密钥的有效期与额度，使用次数与token用量每次读取最新值"""
+    if decision.kind == "inactive":
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Access key is lose efficacy")
+    if decision.expires_at and time.time() > decision.expires_at:
+        deactivate_access_key(token)
+        log_msg = format_log_message('INFO', f"IP: {client_ip} Access key {token} expired")
+        logger.info(log_msg)
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Access key expired")
+    if decision.usage_limit is not None and get_access_keys().get(token, {}).get('usage_count', 0) >= decision.usage_limit:
+        deactivate_access_key(token)
+        log_msg = format_log_message('INFO', f"IP: {client_ip} Access key {token} usage limit exceeded")
+        logger.info(log_msg)
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Access key usage limit exceeded")
+    if decision.token_limit and usage_ledger.tokens_used(token, decision.reset_daily) >= decision.token_limit:
+        # token额度按日重置时次日自动恢复，不修改密钥状态
+        log_msg = format_log_message('INFO', f"IP: {client_ip} Access key {token} token limit exceeded")
+        logger.info(log_msg)
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail="Access key token limit exceeded")
+
+
 # 校验密码逻辑
+@traced("auth")
 async def verify_password(request: Request):
     auth_header = request.headers.get("Authorization")
     client_ip = get_client_ip(request)
@@ -285,40 +382,20 @@ async def verify_password(request: Request):
         logger.warning(log_msg)
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Your IP address is blacklisted.")
 
-    if auth_header and auth_header.startswith("Bearer "):
-        token = auth_header.split(" ")[1]
-
-        # 访问密钥验证
-        if token.startswith("sk-"):
-            access_keys = get_access_keys()
-            key_data = access_keys.get(token)
-            if key_data:
-                key = AccessKey(**key_data)
-                if key.is_active:
-                    if key.expires_at and datetime.now().timestamp() > key.expires_at:
-                        # 更新有效状态
-                        with access_keys_lock:
-                            key.is_active = False
-                            access_keys[token] = key.dict()
-                            save_access_keys()
-                        log_msg = format_log_message('INFO', f"IP: {client_ip} Access key {token} expired")
-                        logger.info(log_msg)
-                        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Access key expired")
-                    if key.usage_limit is not None and key.usage_count >= key.usage_limit:
-                        # 更新有效状态
-                        with access_keys_lock:
-                            key.is_active = False
-                            access_keys[token] = key.dict()
-                            save_access_keys()
-                        log_msg = format_log_message('INFO', f"IP: {client_ip} Access key {token} usage limit exceeded")
-                        logger.info(log_msg)
-                        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Access key usage limit exceeded")
-                    return True
-                else:
-                    raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Access key is lose efficacy")
-
-        # 原始密码验证
-        if token == PASSWORD:
+    token = auth_header.split(" ")[1] if auth_header and auth_header.startswith("Bearer ") else None
+    known_invalid = False
+    if token:
+        # 鉴权结果按令牌哈希缓存，访问密钥被修改时失效；最近确认无效的令牌不再查找
+        decision = auth_cache.get(token)
+        if decision is None:
+            known_invalid = auth_cache.is_rejected(token)
+            if not known_invalid:
+                decision = resolve_auth_decision(token)
+                if decision is not None:
+                    auth_cache.put(token, decision)
+        if decision is not None:
+            if decision.kind != "password":
+                check_access_key(token, decision, client_ip)
             return True
 
     if not PASSWORD:
@@ -328,10 +405,16 @@ async def verify_password(request: Request):
     if client_ip in authorized_ips:
         return True
 
-    # 仅在其他验证方式失败时才尝试读取body
+    # 短时间内鉴权失败过多的IP不再读取请求体
+    retry_after = auth_cache.throttled(client_ip)
+    if retry_after is not None:
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail="Too many failed authentication attempts",
+                            headers={"Retry-After": str(max(1, int(retry_after)))})
+
+    # 仅在其他验证方式失败时才尝试读取body，解析结果与接口处理共用
     try:
-        body = await request.json()
-    except Exception:
+        body = await read_json_body(request)
+    except ValueError:
         body = None
 
     def verify_auth_command(text: str) -> bool:
@@ -339,12 +422,13 @@ async def verify_password(request: Request):
         auth_match = re.search(r'auth\s([^\s]+)', text.lower())
         if auth_match and auth_match.group(1) == PASSWORD:
             authorized_ips.add(client_ip)
+            auth_cache.clear_failures(client_ip)
             logger.info(format_log_message('INFO', f"IP {client_ip} Successfully authorized through the auth command.",
                                           extra={'ip': client_ip, 'method': 'AUTH_command'}))
             return True
         return False
 
-    if body and 'messages' in body:
+    if isinstance(body, dict) and 'messages' in body:
         messages = body['messages']
         if messages and isinstance(messages, list):
             last_message = messages[-1]
@@ -364,37 +448,153 @@ async def verify_password(request: Request):
     detail_message = "Unauthorized: Authentication required."
     if auth_header and not auth_header.startswith("Bearer "):
         detail_message = "Unauthorized: Invalid token type. Bearer token required."
-    
-    logger.warning(format_log_message('WARNING', f"Auth failed for IP {client_ip}: {detail_message}",
-                                     extra={'ip': client_ip, 'reason': 'All auth methods failed'}))
+
+    auth_cache.record_failure(client_ip)
+    if token and not known_invalid:
+        auth_cache.reject(token)
+    if not known_invalid:
+        # 重复出现的无效令牌不再记录日志
+        logger.warning(format_log_message('WARNING', f"Auth failed for IP {client_ip}: {detail_message}",
+                                         extra={'ip': client_ip, 'reason': 'All auth methods failed'}))
     raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=detail_message)
 
 
-async def process_request(chat_request: ChatCompletionRequest, http_request: Request, request_type: Literal['stream', 'non-stream'],token:str = None):
-    global current_api_key
-    
+async def parse_chat_request(http_request: Request) -> ChatCompletionRequest:
+    """解析聊天请求体，与 verify_password 共用同一次JSON解析(优先使用 orjson)"""
+    try:
+        body = await read_json_body(http_request)
+    except ValueError as e:
+        raise RequestValidationError([{"loc": ("body",), "msg": f"JSON解析失败: {e}", "type": "value_error.jsondecode"}])
+    if not isinstance(body, dict):
+        raise RequestValidationError([{"loc": ("body",), "msg": "请求体必须是JSON对象", "type": "type_error.dict"}])
+    try:
+        return ChatCompletionRequest(**body)
+    except ValidationError as e:
+        raise RequestValidationError(e.errors())
+
+
+def build_cached_completion(chat_request: ChatCompletionRequest, cached_response: CachedResponse) -> ChatCompletionResponse:
+    """使用缓存结果构建非流式响应"""
+    return ChatCompletionResponse(
+        id="chatcmpl-someid",
+        object="chat.completion",
+        created=int(time.time()),
+        model=chat_request.model,
+        choices=[{"index": 0, "message": {"role": "assistant", "content": cached_response.text}, "finish_reason": "stop"}],
+        usage={"prompt_tokens": cached_response.prompt_tokens, "completion_tokens": cached_response.completion_tokens, "total_tokens": cached_response.total_tokens}
+    )
+
+
+async def replay_cached_stream(chat_request: ChatCompletionRequest, cached_response: CachedResponse):
+    """将缓存结果按原始分块顺序以SSE格式重新输出"""
+    for kind, value in cached_response.events:
+        delta_key = "reasoning_content" if kind == 'reasoning' else "content"
+        formatted_chunk = {
+            "id": "chatcmpl-someid",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": chat_request.model,
+            "choices": [{"delta": {"role": "assistant", delta_key: value}, "index": 0, "finish_reason": None}]
+        }
+        yield f"data: {json.dumps(formatted_chunk)}\n\n"
+    final_chunk = {
+        "id": "chatcmpl-someid-final",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": chat_request.model,
+        "choices": [{"delta": {}, "index": 0, "finish_reason": "stop"}],
+        "usage": {
+            "prompt_tokens": cached_response.prompt_tokens,
+            "completion_tokens": cached_response.completion_tokens,
+            "total_tokens": cached_response.total_tokens
+        }
+    }
+    yield f"data: {json.dumps(final_chunk)}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+async def wait_for_disconnect(http_request: Request):
+    """等待客户端断开
+
+    请求体已读取完毕后，ASGI receive 只会在连接断开时返回 http.disconnect，
+    无需轮询即可在断开后立即得知。
+    """
+    while True:
+        message = await http_request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+def check_chat_request(chat_request: ChatCompletionRequest, http_request: Request, request_type: Literal['stream', 'non-stream']):
+    """限流与模型校验，在准入控制之前执行，被限流或模型无效的请求不占用排队名额"""
     client_ip = get_client_ip(http_request)
 
-    protect_from_abuse(
-        http_request, MAX_REQUESTS_PER_MINUTE, MAX_REQUESTS_PER_DAY_PER_IP)
+    with span("rate_limit"):
+        protect_from_abuse(
+            http_request, MAX_REQUESTS_PER_MINUTE, MAX_REQUESTS_PER_DAY_PER_IP)
     # 解析是否是自定义思考模型,不在所有模型列表中,但使其也可以访问
-    thinking_model, thinking_budget = GeminiClient._parse_model_name_and_budget(chat_request.model)
-    if chat_request.model not in GeminiClient.AVAILABLE_MODELS and not any(thinking_model.startswith(model) for model in GeminiClient.thinkingModels):
+    if not model_registry.is_valid(chat_request.model):
         error_msg = "无效的模型"
         extra_log = {'ip': client_ip, 'request_type': request_type, 'model': chat_request.model, 'status_code': 400, 'error_message': error_msg}
         log_msg = format_log_message('ERROR', error_msg, extra=extra_log)
         logger.error(log_msg)
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=error_msg)
 
+
+async def process_request(chat_request: ChatCompletionRequest, http_request: Request, request_type: Literal['stream', 'non-stream'],token:str = None):
+    global current_api_key
+    
+    client_ip = get_client_ip(http_request)
+
     key_manager.reset_tried_keys_for_request() # 在每次请求处理开始时重置 tried_keys 集合
 
-    contents, system_instruction = GeminiClient.convert_messages(
-        GeminiClient, chat_request.messages)
+    with span("convert_messages", messages=len(chat_request.messages)):
+        contents, system_instruction = GeminiClient.convert_messages(chat_request.messages)
+    # 按本地估算的token数检查模型的上下文窗口，超出时裁剪，仍超出则直接返回400而不请求上游
+    try:
+        contents, prompt_estimate = context_window.fit(GeminiClient.upstream_model(chat_request.model), contents, system_instruction)
+    except ContextWindowExceeded as e:
+        extra_log = {'ip': client_ip, 'request_type': request_type, 'model': chat_request.model, 'status_code': 400, 'error_message': e.message}
+        logger.error(format_log_message('ERROR', e.message, extra=extra_log))
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=e.message)
+
+    # 响应缓存与请求合并: 相同的确定性请求直接返回缓存结果或共享进行中的调用
+    cache_key = None
+    coalesce_key = None
+    access_key_data = get_access_keys().get(token) if token and token.startswith("sk-") else None
+    cacheable = is_response_cacheable(chat_request, access_key_data, GeminiClient.imageModels)
+    coalescable = should_coalesce(chat_request, GeminiClient.imageModels)
+    # 实时用量计量: 按上游返回的用量或本地估算记账，流式输出过程中即可判断token额度
+    meter = usage_ledger.meter(
+        token if access_key_data else None, chat_request.model, prompt_estimate,
+        access_key_data.get("token_limit") if access_key_data else None,
+        bool(access_key_data.get("reset_daily")) if access_key_data else False)
+
+    def record_success():
+        meter.finish()
+        if token:
+            update_access_key_usage(token)
+    if cacheable or coalescable:
+        request_key = build_cache_key(chat_request, contents, system_instruction)
+        cache_key = request_key if cacheable else None
+        coalesce_key = request_key if coalescable else None
+    if cache_key:
+        cached_response = response_cache.get(cache_key)
+        if cached_response is not None:
+            extra_log = {'ip': client_ip, 'key': 'cache', 'request_type': request_type, 'model': chat_request.model, 'status_code': 200}
+            log_msg = format_log_message('INFO', f"命中响应缓存, 【输入Token: {cached_response.prompt_tokens}】, 【输出Token: {cached_response.completion_tokens}】", extra=extra_log)
+            logger.info(log_msg)
+            metrics.requests_total.inc(chat_request.model, request_type, "200")
+            record_success()
+            if chat_request.stream:
+                return StreamingResponse(replay_cached_stream(chat_request, cached_response), media_type="text/event-stream")
+            return build_cached_completion(chat_request, cached_response)
 
     retry_attempts = len(key_manager.api_keys) if key_manager.api_keys else 1 # 重试次数等于密钥数量，至少尝试 1 次
     for attempt in range(1, retry_attempts + 1):
         if attempt == 1:
-            current_api_key = key_manager.get_available_key() # 每次循环开始都获取新的 key, 栈逻辑在 get_available_key 中处理
+            with span("key_acquire"):
+                current_api_key = key_manager.get_available_key() # 每次循环开始都获取新的 key, 栈逻辑在 get_available_key 中处理
         
         if current_api_key is None: # 检查是否获取到 API 密钥
             log_msg_no_key = format_log_message('WARNING', "没有可用的 API 密钥，跳过本次尝试", extra={'ip': client_ip, 'request_type': request_type, 'model': chat_request.model, 'status_code': 'N/A'})
@@ -412,32 +612,41 @@ async def process_request(chat_request: ChatCompletionRequest, http_request: Req
         try:
             if chat_request.stream:
                 async def stream_generator():
-                    queue = asyncio.Queue()
-                    
+                    # 相同的确定性请求共享同一个上游调用，未开启合并时flight仅供当前请求使用
+                    flight, is_leader = request_coalescer.join(f"stream:{coalesce_key}" if coalesce_key else None)
+
                     async def callback(chunk):
-                        await queue.put(chunk)
+                        # 唯一的订阅者缓冲已满时在此等待，上游的读取随之暂停
+                        await flight.send(chunk)
+
+                    def on_usage(usage_metadata):
+                        # 用量与额度由每个订阅者各自记账，一个访问密钥额度用完不影响合并的其他请求
+                        flight.publish(UsageEvent(usage_metadata=usage_metadata))
 
                     async def stream_task():
                         nonlocal gemini_client
                         isSuccess = False
                         try:
                             for streamAttempt in range(1, retry_attempts + 1):
+                                flight.publish(UsageEvent(api_key=current_api_key))
                                 try:
                                     response_wrapper = await gemini_client.stream_chat(
                                         chat_request, contents,
                                         safety_settings_g2 if 'gemini-2.0-flash-exp' in chat_request.model else safety_settings,
                                         system_instruction,
-                                        callback
+                                        callback,
+                                        on_usage
                                     )
                                     if not response_wrapper.text and streamAttempt < GEMINI_EMPTY_RESPONSE_RETRIES+1:
                                         extra_log = {'ip': client_ip, 'key': current_api_key[:10], 'request_type': request_type, 'model': chat_request.model, 'status_code': 504}
                                         handle_gemini_error(GeminiServiceUnavailableError("Gemini返回内容为空",504,extra_log), current_api_key, key_manager, client_ip)
+                                        metrics.retries_total.inc("empty")
                                         switch_api_key()
                                         gemini_client = GeminiClient(current_api_key, storage=global_image_storage)
                                         await asyncio.sleep(GEMINI_RETRY_DELAY)
                                         continue
                                     else:
-                                        await queue.put(response_wrapper)
+                                        flight.publish(response_wrapper)
                                         isSuccess = True
                                         break
                                 except GeminiAPIError as e:
@@ -445,6 +654,7 @@ async def process_request(chat_request: ChatCompletionRequest, http_request: Req
                                     if status_code == 503 and streamAttempt < GEMINI_503_RETRIES + 1:
                                         extra_log = {'ip': client_ip, 'key': current_api_key[:10], 'request_type': request_type, 'model': chat_request.model, 'status_code': 503}
                                         handle_gemini_error(GeminiAPIError("Gemini返回503错误,模型超载",503,extra_log), current_api_key, key_manager, client_ip)
+                                        metrics.retries_total.inc("503")
                                         switch_api_key()
                                         gemini_client = GeminiClient(current_api_key, storage=global_image_storage)
                                         await asyncio.sleep(GEMINI_RETRY_DELAY)
@@ -452,31 +662,58 @@ async def process_request(chat_request: ChatCompletionRequest, http_request: Req
                                     elif status_code == 429 and streamAttempt < GEMINI_429_RETRIES + 1:
                                         extra_log = {'ip': client_ip, 'key': current_api_key[:10], 'request_type': request_type, 'model': chat_request.model, 'status_code': 429}
                                         handle_gemini_error(GeminiAPIError("Gemini返回429错误,密钥配额已用尽或其他原因", 429, extra_log), current_api_key, key_manager, client_ip)
+                                        metrics.retries_total.inc("429")
                                         switch_api_key()
                                         gemini_client = GeminiClient(current_api_key, storage=global_image_storage)
                                         await asyncio.sleep(GEMINI_RETRY_DELAY)
                                         continue
                                     else:
-                                        await queue.put(e)
+                                        flight.publish(e)
                                         break
 
                             if not isSuccess:
                                 raise GeminiAPIError(f"服务异常,请稍后重试",500,{})
 
                         except Exception as e:
-                            await queue.put(e)
+                            flight.publish(e)
                         finally:
-                            await queue.put(None)
+                            flight.publish(None)
 
-                    task = asyncio.create_task(stream_task())
-                    
+                    if is_leader:
+                        flight.start(stream_task())
+                    else:
+                        extra_log_follow = {'ip': client_ip, 'key': 'N/A', 'request_type': 'stream', 'model': chat_request.model, 'status_code': 'N/A'}
+                        logger.info(format_log_message('INFO', "合并到进行中的相同请求", extra=extra_log_follow))
+                    queue = flight.subscribe()
+
+                    async def close_on_disconnect():
+                        await wait_for_disconnect(http_request)
+                        # 立即取消订阅，最后一个订阅者离开时上游连接随之关闭，不必等到下一次写入时才发现
+                        queue.close()
+
+                    disconnect_task = asyncio.create_task(close_on_disconnect())
                     response_wrapper = None
+                    # 记录输出内容，用于写入响应缓存
+                    cache_events = [] if cache_key else None
+                    first_chunk_time = None
                     try:
                         while True:
                             item = await queue.get()
                             if item is None:
                                 break
-                            elif isinstance(item, str):
+                            if isinstance(item, UsageEvent):
+                                # 合并到他人发起的调用时只计入访问密钥，Gemini密钥的用量由发起方记账
+                                meter.apply(item, is_leader)
+                                if meter.over_budget():
+                                    raise TokenBudgetExceeded()
+                                continue
+                            if first_chunk_time is None and isinstance(item, (str, Thought)):
+                                first_chunk_time = time.monotonic()
+                                metrics.time_to_first_token.observe(first_chunk_time - start_time, chat_request.model)
+                            if isinstance(item, str):
+                                meter.on_text(item)
+                                if cache_events is not None:
+                                    cache_events.append(('content', item))
                                 formatted_chunk = {
                                     "id": "chatcmpl-someid",
                                     "object": "chat.completion.chunk",
@@ -485,8 +722,14 @@ async def process_request(chat_request: ChatCompletionRequest, http_request: Req
                                     "choices": [{"delta": {"role": "assistant", "content": item}, "index": 0, "finish_reason": None}]
                                 }
                                 yield f"data: {json.dumps(formatted_chunk)}\n\n"
+                                if meter.over_budget():
+                                    # 额度用完时中断输出，最后一个订阅者离开后上游连接随之关闭
+                                    raise TokenBudgetExceeded()
                                 continue
                             elif isinstance(item, Thought): #检查是否是思考内容
+                                meter.on_text(item.value, True)
+                                if cache_events is not None:
+                                    cache_events.append(('reasoning', item.value))
                                 formatted_chunk = {
                                     "id": "chatcmpl-someid",
                                     "object": "chat.completion.chunk",
@@ -495,6 +738,8 @@ async def process_request(chat_request: ChatCompletionRequest, http_request: Req
                                     "choices": [{"delta": {"role": "assistant", "reasoning_content": item.value}, "index": 0, "finish_reason": None}]
                                 }
                                 yield f"data: {json.dumps(formatted_chunk)}\n\n"
+                                if meter.over_budget():
+                                    raise TokenBudgetExceeded()
                                 continue
                             elif isinstance(item, ResponseWrapper):
                                 response_wrapper = item
@@ -527,11 +772,24 @@ async def process_request(chat_request: ChatCompletionRequest, http_request: Req
                         log_message_text_stream = f"已请求成功,{skStr} 【耗时: {duration:.2f}s】, 【输入Token: {prompt_tokens}】, 【输出Token: {completion_tokens}】"
                         if thinking_tokens > 0:
                             log_message_text_stream += f", 【思考Token: {thinking_tokens}】"
+                        if response_wrapper is not None and response_wrapper.cached_content_token_count:
+                            log_message_text_stream += f", 【缓存Token: {response_wrapper.cached_content_token_count}】"
                         log_message_text_stream += f", 【总Token: {total_tokens}】"
                         
                         log_msg_success_stream = format_log_message('INFO', log_message_text_stream, extra=extra_log_success_stream)
                         logger.info(log_msg_success_stream)
 
+                        metrics.requests_total.inc(chat_request.model, 'stream', "200")
+                        metrics.request_duration.observe(duration, chat_request.model, 'stream')
+                        if first_chunk_time is not None and completion_tokens:
+                            generation_time = time.monotonic() - first_chunk_time
+                            if generation_time > 0:
+                                metrics.tokens_per_second.observe(completion_tokens / generation_time, chat_request.model)
+
+                        if cache_events and response_wrapper is not None and response_wrapper.text:
+                            response_cache.put(cache_key, CachedResponse(cache_events, prompt_tokens, completion_tokens, total_tokens))
+                        record_success()
+
                         final_chunk = {
                             "id": "chatcmpl-someid-final",
                             "object": "chat.completion.chunk",
@@ -551,17 +809,31 @@ async def process_request(chat_request: ChatCompletionRequest, http_request: Req
                         extra_log_cancel = {'ip': client_ip, 'key': current_api_key[:10], 'request_type': 'stream', 'model': chat_request.model, 'error_message': '客户端已断开连接'}
                         log_msg = format_log_message('INFO', "客户端连接已中断", extra=extra_log_cancel)
                         logger.info(log_msg)
+                        metrics.requests_total.inc(chat_request.model, 'stream', "499")
+                    except TokenBudgetExceeded as e:
+                        extra_log_budget = {'ip': client_ip, 'key': current_api_key[:10], 'request_type': 'stream', 'model': chat_request.model, 'status_code': 429, 'error_message': e.message}
+                        logger.warning(format_log_message('WARNING', f"{e.message}，已中断输出, 密钥: {token[:10]}...", extra=extra_log_budget))
+                        metrics.requests_total.inc(chat_request.model, 'stream', "429")
+                        yield f"data: {json.dumps({'error': {'message': e.message, 'type': 'insufficient_quota'}}, ensure_ascii=False)}\n\n"
+                    except SubscriberTooSlow as e:
+                        extra_log_slow = {'ip': client_ip, 'key': current_api_key[:10], 'request_type': 'stream', 'model': chat_request.model, 'error_message': e.message}
+                        logger.warning(format_log_message('WARNING', "合并的流式请求读取过慢，已单独断开", extra=extra_log_slow))
+                        metrics.requests_total.inc(chat_request.model, 'stream', "499")
+                        yield f"data: {json.dumps({'error': {'message': e.message, 'type': 'stream_too_slow'}}, ensure_ascii=False)}\n\n"
                     except Exception as e:
+                        metrics.requests_total.inc(chat_request.model, 'stream', "500")
                         error_detail = handle_gemini_error(e, current_api_key, key_manager, client_ip)
                         yield f"data: {json.dumps({'error': {'message': error_detail, 'type': 'gemini_error'}})}\n\n"
                     finally:
-                        task.cancel()
+                        disconnect_task.cancel()
+                        # 最后一个订阅者离开时才会取消上游调用
+                        flight.unsubscribe(queue)
 
                 return StreamingResponse(stream_generator(), media_type="text/event-stream")
             else:
                 async def run_gemini_completion():
                     try:
-                        response_content = await asyncio.to_thread(gemini_client.complete_chat, chat_request, contents, safety_settings_g2 if 'gemini-2.0-flash-exp' in chat_request.model else safety_settings, system_instruction)
+                        response_content = await gemini_client.complete_chat(chat_request, contents, safety_settings_g2 if 'gemini-2.0-flash-exp' in chat_request.model else safety_settings, system_instruction)
                         return response_content
                     except asyncio.CancelledError:
                         extra_log_gemini_cancel = {'ip': client_ip, 'key': current_api_key[:10], 'request_type': request_type, 'model': chat_request.model, 'error_message': '客户端断开导致API调用取消'}
@@ -570,15 +842,22 @@ async def process_request(chat_request: ChatCompletionRequest, http_request: Req
                         raise
 
                 async def check_client_disconnect():
-                    while True:
-                        if await http_request.is_disconnected():
-                            extra_log_client_disconnect = {'ip': client_ip, 'key': current_api_key[:10], 'request_type': request_type, 'model': chat_request.model, 'error_message': '检测到客户端断开连接'}
-                            log_msg = format_log_message('INFO', "客户端连接已中断，正在取消API请求", extra=extra_log_client_disconnect)
-                            logger.info(log_msg)
-                            return True
-                        await asyncio.sleep(0.5)
+                    await wait_for_disconnect(http_request)
+                    extra_log_client_disconnect = {'ip': client_ip, 'key': current_api_key[:10], 'request_type': request_type, 'model': chat_request.model, 'error_message': '检测到客户端断开连接'}
+                    log_msg = format_log_message('INFO', "客户端连接已中断，正在取消API请求", extra=extra_log_client_disconnect)
+                    logger.info(log_msg)
+                    return True
 
-                gemini_task = asyncio.create_task(run_gemini_completion())
+                flight, is_leader = request_coalescer.join(f"non-stream:{coalesce_key}" if coalesce_key else None)
+                # 合并到他人发起的调用时只计入访问密钥的用量，Gemini密钥的用量由发起方记账
+                meter.attempt(current_api_key if is_leader else None)
+                if is_leader:
+                    flight.start(run_gemini_completion())
+                else:
+                    extra_log_follow = {'ip': client_ip, 'key': 'N/A', 'request_type': request_type, 'model': chat_request.model, 'status_code': 'N/A'}
+                    logger.info(format_log_message('INFO', "合并到进行中的相同请求", extra=extra_log_follow))
+                # 等待者断开只会取消自身的等待，所有等待者都离开后才会取消API调用
+                gemini_task = asyncio.create_task(flight.result())
                 disconnect_task = asyncio.create_task(check_client_disconnect())
 
                 try:
@@ -605,6 +884,7 @@ async def process_request(chat_request: ChatCompletionRequest, http_request: Req
                         except asyncio.CancelledError:
                             pass
                         response_content = gemini_task.result()
+                        meter.on_usage(response_content.usage_metadata)
                         response_text_len = len(response_content.text)
                         extra_log = {'ip': client_ip, 'key': current_api_key[:10], 'request_type': request_type, 'model': chat_request.model, 'status_code': 200}
                         if response_text_len == 0 and attempt < GEMINI_EMPTY_RESPONSE_RETRIES+1:
@@ -636,11 +916,22 @@ async def process_request(chat_request: ChatCompletionRequest, http_request: Req
                         log_message_text_duration = f"已请求成功,{skStr} 【耗时: {duration:.2f}s】, 【输入Token: {prompt_tokens}】, 【输出Token: {completion_tokens}】"
                         if thinking_tokens > 0:
                             log_message_text_duration += f", 【思考Token: {thinking_tokens}】"
+                        if response_content.cached_content_token_count:
+                            log_message_text_duration += f", 【缓存Token: {response_content.cached_content_token_count}】"
                         log_message_text_duration += f", 【总Token: {total_tokens}】"
 
                         log_msg_duration = format_log_message('INFO', log_message_text_duration, extra=extra_log)
                         logger.info(log_msg_duration)
-                        
+
+                        metrics.requests_total.inc(chat_request.model, request_type, "200")
+                        metrics.request_duration.observe(duration, chat_request.model, request_type)
+                        if completion_tokens and duration > 0:
+                            metrics.tokens_per_second.observe(completion_tokens / duration, chat_request.model)
+
+                        if cache_key and response_content.text:
+                            response_cache.put(cache_key, CachedResponse([('content', response_content.text)], prompt_tokens, completion_tokens, total_tokens))
+                        record_success()
+
                         return response
 
                 except asyncio.CancelledError:
@@ -648,7 +939,7 @@ async def process_request(chat_request: ChatCompletionRequest, http_request: Req
                     log_msg = format_log_message('INFO', "请求取消", extra=extra_log_request_cancel)
                     logger.info(log_msg)
                     raise
-                except requests.exceptions.HTTPError as e:
+                except httpx.HTTPStatusError as e:
                     status_code = e.response.status_code
                     if status_code == 503 and attempt < GEMINI_503_RETRIES + 1:
                         extra_log = {'ip': client_ip, 'key': current_api_key[:10], 'request_type': request_type, 'model': chat_request.model, 'status_code': 503}
@@ -663,6 +954,7 @@ async def process_request(chat_request: ChatCompletionRequest, http_request: Req
             if e.status_code == 504:
                 handle_gemini_error(e, current_api_key, key_manager, client_ip)
                 if attempt < GEMINI_EMPTY_RESPONSE_RETRIES+1:
+                    metrics.retries_total.inc("empty")
                     switch_api_key()
                     await asyncio.sleep(GEMINI_RETRY_DELAY)
                     continue
@@ -680,6 +972,7 @@ async def process_request(chat_request: ChatCompletionRequest, http_request: Req
             if e.status_code == 503:
                 handle_gemini_error(e, current_api_key, key_manager, client_ip)
                 if attempt < GEMINI_503_RETRIES + 1:
+                    metrics.retries_total.inc("503")
                     switch_api_key()
                     await asyncio.sleep(GEMINI_RETRY_DELAY)
                     continue
@@ -687,6 +980,7 @@ async def process_request(chat_request: ChatCompletionRequest, http_request: Req
             elif e.status_code == 429:
                 handle_gemini_error(e, current_api_key, key_manager, client_ip)
                 if attempt < GEMINI_429_RETRIES + 1:
+                    metrics.retries_total.inc("429")
                     switch_api_key()
                     await asyncio.sleep(GEMINI_RETRY_DELAY)
                     continue
@@ -707,20 +1001,197 @@ async def process_request(chat_request: ChatCompletionRequest, http_request: Req
         status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="API密钥请求失败,请稍后重试")
 
 @app.get("/v1/models", response_model=ModelList)
-def list_models(request: Request, _: None = Depends(verify_password)):
+async def list_models(request: Request, _: None = Depends(verify_password)):
     client_ip = get_client_ip(request)
+    # 响应体在模型列表更新时预先序列化，客户端缓存未过期时返回304
+    headers = {"ETag": model_registry.etag, "Cache-Control": "private, no-cache"}
+    if model_registry.etag_matches(request.headers.get("If-None-Match")):
+        log_msg = format_log_message('INFO', "Received request to list models", extra={'ip': client_ip, 'request_type': 'list_models', 'status_code': 304})
+        logger.info(log_msg)
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
     log_msg = format_log_message('INFO', "Received request to list models", extra={'ip': client_ip, 'request_type': 'list_models', 'status_code': 200})
     logger.info(log_msg)
-    return ModelList(data=[{"id": model, "object": "model", "created": 1678888888, "owned_by": "organization-owner"} for model in GeminiClient.AVAILABLE_MODELS])
+    return Response(content=model_registry.body, media_type="application/json", headers=headers)
 
 @app.post("/v1/chat/completions", response_model=ChatCompletionResponse)
-async def chat_completions(request: ChatCompletionRequest, http_request: Request, _: None = Depends(verify_password)):
+async def chat_completions(http_request: Request, _: None = Depends(verify_password),
+                           request: ChatCompletionRequest = Depends(parse_chat_request)):
     auth_header = http_request.headers.get("Authorization")
     token = None
     if auth_header and auth_header.startswith("Bearer "):
         token = auth_header.split(" ")[1]
+    request_type = "stream" if request.stream else "non-stream"
+    try:
+        check_chat_request(request, http_request, request_type)
+        # 准入控制: 按上游模型限制并发，超出时按优先级排队，无法及时处理时直接返回 503 + Retry-After
+        access_key_data = get_access_keys().get(token) if token and token.startswith("sk-") else None
+        priority = admission_controller.resolve_priority(
+            access_key_data.get("priority") if access_key_data else None, request.model, http_request.headers.get("X-Priority"))
+        try:
+            queue_timeout = float(http_request.headers.get("X-Queue-Timeout", 0))
+        except ValueError:
+            queue_timeout = 0
+        with span("admission", priority=priority):
+            slot = await admission_controller.acquire(GeminiClient.upstream_model(request.model), priority, queue_timeout)
+        try:
+            response = await process_request(request, http_request, request_type, token)
+        except BaseException:
+            slot.release()
+            raise
+        if isinstance(response, StreamingResponse):
+            # 流式响应在发送结束(包括客户端断开)后才释放名额
+            return SlotResponse(response, slot)
+        slot.release()
+        if isinstance(response, ChatCompletionResponse):
+            # 直接序列化，避免按 response_model 再校验一次，同时记录序列化耗时
+            with span("serialize"):
+                return JSONResponse(content=response.dict())
+        return response
+    except HTTPException as e:
+        metrics.requests_total.inc(request.model, request_type, str(e.status_code))
+        raise
+    except Exception:
+        metrics.requests_total.inc(request.model, request_type, "500")
+        raise
+
+
+@app.post("/v1/embeddings")
+async def embeddings(request: EmbeddingRequest, http_request: Request, _: None = Depends(verify_password)):
+    auth_header = http_request.headers.get("Authorization")
+    token = auth_header.split(" ")[1] if auth_header and auth_header.startswith("Bearer ") else None
+    client_ip = get_client_ip(http_request)
+    with span("rate_limit"):
+        protect_from_abuse(http_request, MAX_REQUESTS_PER_MINUTE, MAX_REQUESTS_PER_DAY_PER_IP)
+    start_time = time.monotonic()
+    try:
+        result = await create_embeddings(request, key_manager, client_ip)
+    except HTTPException as e:
+        metrics.requests_total.inc(request.model, 'embeddings', str(e.status_code))
+        log_msg = format_log_message('ERROR', f"嵌入请求失败: {e.detail}", extra={'ip': client_ip, 'request_type': 'embeddings', 'model': request.model, 'status_code': e.status_code, 'error_message': str(e.detail)})
+        logger.error(log_msg)
+        raise
+    duration = time.monotonic() - start_time
+    prompt_tokens = result["usage"]["prompt_tokens"]
+    extra_log = {'ip': client_ip, 'request_type': 'embeddings', 'model': request.model, 'status_code': 200, 'duration_ms': round(duration * 1000), 'prompt_tokens': prompt_tokens}
+    log_msg = format_log_message('INFO', f"已请求成功, 【耗时: {duration:.2f}s】, 【向量数量: {len(result['data'])}】, 【输入Token(估算): {prompt_tokens}】", extra=extra_log)
+    logger.info(log_msg)
+    metrics.requests_total.inc(request.model, 'embeddings', "200")
+    metrics.request_duration.observe(duration, request.model, 'embeddings')
+    usage_ledger.add(token if token and token.startswith("sk-") else None, None, request.model, 1, prompt_tokens, 0, prompt_tokens)
+    if token:
         update_access_key_usage(token)
-    return await process_request(request, http_request, "stream" if request.stream else "non-stream",token)
+    with span("serialize"):
+        return JSONResponse(content=result)
+
+
+async def run_batch_item(body: dict, api_key: str) -> dict:
+    """执行批处理任务中的单个聊天补全请求(非流式)，返回与 /v1/chat/completions 相同的响应体"""
+    chat_request = ChatCompletionRequest(**dict(body, stream=False))
+    if not model_registry.is_valid(chat_request.model):
+        raise GeminiAPIError("无效的模型", 400)
+    contents, system_instruction = GeminiClient.convert_messages(chat_request.messages)
+    try:
+        contents, _ = context_window.fit(GeminiClient.upstream_model(chat_request.model), contents, system_instruction)
+    except ContextWindowExceeded as e:
+        raise GeminiAPIError(e.message, 400)
+    gemini_client = GeminiClient(api_key, storage=global_image_storage)
+    start_time = time.monotonic()
+    try:
+        response_content = await gemini_client.complete_chat(
+            chat_request, contents,
+            safety_settings_g2 if 'gemini-2.0-flash-exp' in chat_request.model else safety_settings,
+            system_instruction
+        )
+    except httpx.HTTPStatusError as e:
+        metrics.requests_total.inc(chat_request.model, 'batch', str(e.response.status_code))
+        raise
+    if not response_content.text:
+        metrics.requests_total.inc(chat_request.model, 'batch', "504")
+        raise GeminiServiceUnavailableError("Gemini返回内容为空", 504)
+    duration = time.monotonic() - start_time
+    metrics.requests_total.inc(chat_request.model, 'batch', "200")
+    metrics.request_duration.observe(duration, chat_request.model, 'batch')
+    usage_ledger.add(None, api_key, chat_request.model, 1, response_content.prompt_token_count or 0,
+                     response_content.candidates_token_count or 0, response_content.total_token_count or 0)
+    return ChatCompletionResponse(
+        id="chatcmpl-someid",
+        object="chat.completion",
+        created=int(time.time()),
+        model=chat_request.model,
+        choices=[{"index": 0, "message": {"role": "assistant", "content": response_content.text}, "finish_reason": "stop"}],
+        usage={
+            "prompt_tokens": response_content.prompt_token_count or 0,
+            "completion_tokens": response_content.candidates_token_count or 0,
+            "total_tokens": response_content.total_token_count or 0
+        }
+    ).dict()
+
+
+def batch_owner(http_request: Request) -> str:
+    auth_header = http_request.headers.get("Authorization")
+    token = auth_header.split(" ")[1] if auth_header and auth_header.startswith("Bearer ") else None
+    return owner_of(token, get_client_ip(http_request))
+
+
+@app.post("/v1/files")
+async def upload_file(http_request: Request, _: None = Depends(verify_password)):
+    protect_from_abuse(http_request, MAX_REQUESTS_PER_MINUTE, MAX_REQUESTS_PER_DAY_PER_IP)
+    body = await http_request.body()
+    filename, purpose, content = await asyncio.to_thread(
+        parse_upload, http_request.headers.get("content-type", ""), body, http_request.query_params)
+    file_object = await batch_queue.create_file(batch_owner(http_request), filename, purpose, content)
+    log_msg = format_log_message('INFO', f"上传文件 {file_object['id']} ({filename}, {len(content)} 字节)",
+                                 extra={'ip': get_client_ip(http_request), 'request_type': 'batch'})
+    logger.info(log_msg)
+    return file_object
+
+@app.get("/v1/files")
+async def list_files(http_request: Request, purpose: str = None, _: None = Depends(verify_password)):
+    return await batch_queue.list_files(batch_owner(http_request), purpose)
+
+@app.get("/v1/files/{file_id}")
+async def get_file(http_request: Request, file_id: str, _: None = Depends(verify_password)):
+    return await batch_queue.get_file(batch_owner(http_request), file_id)
+
+@app.get("/v1/files/{file_id}/content")
+async def get_file_content(http_request: Request, file_id: str, _: None = Depends(verify_password)):
+    content = await batch_queue.get_file_content(batch_owner(http_request), file_id)
+    return Response(content=content, media_type="application/jsonl")
+
+@app.delete("/v1/files/{file_id}")
+async def delete_file(http_request: Request, file_id: str, _: None = Depends(verify_password)):
+    return await batch_queue.delete_file(batch_owner(http_request), file_id)
+
+@app.post("/v1/batches")
+async def create_batch(http_request: Request, payload: dict = Body(...), _: None = Depends(verify_password)):
+    protect_from_abuse(http_request, MAX_REQUESTS_PER_MINUTE, MAX_REQUESTS_PER_DAY_PER_IP)
+    if not payload.get("input_file_id") or not payload.get("endpoint"):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="缺少 input_file_id 或 endpoint")
+    batch = await batch_queue.create_batch(
+        batch_owner(http_request), payload["input_file_id"], payload["endpoint"],
+        payload.get("completion_window", "24h"), payload.get("metadata"))
+    auth_header = http_request.headers.get("Authorization")
+    if auth_header and auth_header.startswith("Bearer "):
+        update_access_key_usage(auth_header.split(" ")[1])
+    return batch
+
+@app.get("/v1/batches")
+async def list_batches(http_request: Request, limit: int = 20, after: str = None, _: None = Depends(verify_password)):
+    return await batch_queue.list_batches(batch_owner(http_request), limit, after)
+
+@app.get("/v1/batches/{batch_id}")
+async def get_batch(http_request: Request, batch_id: str, _: None = Depends(verify_password)):
+    return await batch_queue.get_batch(batch_owner(http_request), batch_id)
+
+@app.post("/v1/batches/{batch_id}/cancel")
+async def cancel_batch(http_request: Request, batch_id: str, _: None = Depends(verify_password)):
+    return await batch_queue.cancel_batch(batch_owner(http_request), batch_id)
+
+
+@app.get("/metrics")
+async def get_metrics(_: None = Depends(verify_password)):
+    """Prometheus格式的监控指标"""
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
 
 
 @app.exception_handler(Exception)
@@ -785,12 +1256,114 @@ async def get_env_vars(_: None = Depends(verify_jwt_token)):
             "MAX_REQUESTS_PER_MINUTE": {"label": "每分钟最大请求数", "value": os.environ.get("MAX_REQUESTS_PER_MINUTE", "30"), "description": "单个IP每分钟允许的最大请求次数。"},
             "MAX_REQUESTS_PER_DAY_PER_IP": {"label": "单IP每日最大请求数", "value": os.environ.get("MAX_REQUESTS_PER_DAY_PER_IP", "600"), "description": "单个IP每天允许的最大请求次数。"},
             "EXTRA_MODELS": {"label": "自定义模型列表", "value": os.environ.get("EXTRA_MODELS", ""), "description": "自定义模型列表，多个请用逗号隔开。"},
-            "WHITELIST_IPS": {"label": "IP白名单", "value": os.environ.get("WHITELIST_IPS", ""), "description": "允许直接访问的IP地址，多个请用逗号隔开。"},
-            "BLACKLIST_IPS": {"label": "IP黑名单", "value": os.environ.get("BLACKLIST_IPS", ""), "description": "禁止访问的IP地址，多个请用逗号隔开。"},
+            "MODEL_DISCOVERY_INTERVAL": {"label": "模型列表刷新间隔", "value": os.environ.get("MODEL_DISCOVERY_INTERVAL", "3600"), "description": "后台刷新Gemini模型列表的间隔(秒)，0 表示只在加载密钥时获取。"},
+            "MODEL_DISCOVERY_SAMPLE_KEYS": {"label": "模型列表抽样密钥数", "value": os.environ.get("MODEL_DISCOVERY_SAMPLE_KEYS", "3"), "description": "每次获取模型列表时随机抽取的API密钥数量，结果取并集，单个密钥失败不影响模型列表。"},
+            "EMBEDDING_DEFAULT_MODEL": {"label": "默认嵌入模型", "value": os.environ.get("EMBEDDING_DEFAULT_MODEL", "gemini-embedding-001"), "description": "/v1/embeddings 请求 OpenAI 嵌入模型名(如 text-embedding-3-small)时使用的Gemini嵌入模型。"},
+            "EMBEDDING_BATCH_SIZE": {"label": "嵌入批次大小", "value": os.environ.get("EMBEDDING_BATCH_SIZE", "100"), "description": "每个 batchEmbedContents 请求的最大输入数量(最大100)，大数组会被平均拆分为多个批次。"},
+            "EMBEDDING_BATCH_MAX_CHARS": {"label": "嵌入批次最大字符数", "value": os.environ.get("EMBEDDING_BATCH_MAX_CHARS", "400000"), "description": "每个批次的最大字符数，超过时继续拆分。"},
+            "EMBEDDING_CONCURRENCY": {"label": "嵌入并发批次数", "value": os.environ.get("EMBEDDING_CONCURRENCY", "4"), "description": "同时进行的批次数量，每个并发批次使用不同的API密钥。"},
+            "EMBEDDING_MAX_RETRIES": {"label": "嵌入批次重试次数", "value": os.environ.get("EMBEDDING_MAX_RETRIES", "3"), "description": "单个批次遇到429/5xx错误时更换密钥重试的次数。"},
+            "ADMISSION_MAX_IN_FLIGHT": {"label": "单模型最大并发", "value": os.environ.get("ADMISSION_MAX_IN_FLIGHT", "32"), "description": "每个上游模型同时进行的聊天请求数上限，超过时按优先级排队，0 表示不限制。"},
+            "ADMISSION_QUEUE_SIZE": {"label": "排队长度上限", "value": os.environ.get("ADMISSION_QUEUE_SIZE", "100"), "description": "每个模型每个优先级最多排队的请求数，队列满时返回 503 与 Retry-After。"},
+            "ADMISSION_MAX_WAIT": {"label": "最长排队时间", "value": os.environ.get("ADMISSION_MAX_WAIT", "30"), "description": "请求最长排队时间(秒)，预计等待时间超过该值时立即返回 503 与 Retry-After。客户端可通过 X-Queue-Timeout 请求头设置更短的时间。"},
+            "ADMISSION_MODEL_PRIORITIES": {"label": "模型优先级", "value": os.environ.get("ADMISSION_MODEL_PRIORITIES", ""), "description": "按模型设置默认优先级(high/normal/low)，例如 gemini-2.5-pro:high,gemini-2.0-flash:low。访问密钥上设置的优先级优先，X-Priority 请求头只能降低优先级。"},
+            "ADAPTIVE_LIMIT_ENABLED": {
+                "label": "自适应并发",
+                "value": os.environ.get("ADAPTIVE_LIMIT_ENABLED", "true"),
+                "type": "radio",
+                "options": [
+                    {"value": "true", "description": "开启，上游返回503或延迟升高时自动降低单模型并发"},
+                    {"value": "false", "description": "关闭，只使用单模型最大并发"}
+                ],
+                "description": "按上游的503/504与首字节延迟自动调整每个模型的并发上限(加性增、乘性减)，降低后多出的请求按优先级排队。"
+            },
+            "ADAPTIVE_LIMIT_MIN": {"label": "自适应并发下限", "value": os.environ.get("ADAPTIVE_LIMIT_MIN", "1"), "description": "自动降低后每个模型至少保留的并发数。"},
+            "ADAPTIVE_LIMIT_MAX": {"label": "自适应并发上限", "value": os.environ.get("ADAPTIVE_LIMIT_MAX", "32"), "description": "自动增长的最大并发数，实际放行数量同时受单模型最大并发限制。"},
+            "ADAPTIVE_LIMIT_BACKOFF": {"label": "过载降低系数", "value": os.environ.get("ADAPTIVE_LIMIT_BACKOFF", "0.7"), "description": "上游返回503/504时并发上限乘以该系数。"},
+            "ADAPTIVE_LIMIT_LATENCY_TOLERANCE": {"label": "延迟膨胀倍数", "value": os.environ.get("ADAPTIVE_LIMIT_LATENCY_TOLERANCE", "2.0"), "description": "流式请求首字节延迟的短期均值超过基线的该倍数时小幅降低并发上限。"},
+            "REQUEST_BODY_MAX_MB": {"label": "请求体大小上限(MB)", "value": os.environ.get("REQUEST_BODY_MAX_MB", "32"), "description": "超过该大小的请求直接返回413，不读入内存；0表示不限制。/v1/files 按上传文件大小上限限制。"},
+            "REQUEST_BODY_ROUTE_LIMITS": {"label": "按路由的请求体上限", "value": os.environ.get("REQUEST_BODY_ROUTE_LIMITS", ""), "description": "按路径前缀单独设置请求体大小上限(MB)，例如 /v1/embeddings:8,/gemini:64。"},
+            "AUTH_CACHE_TTL": {"label": "鉴权缓存时间(秒)", "value": os.environ.get("AUTH_CACHE_TTL", "60"), "description": "访问密钥与密码的鉴权结果按令牌哈希缓存的时间，管理界面修改访问密钥后立即失效。"},
+            "AUTH_NEGATIVE_TTL": {"label": "无效令牌缓存时间(秒)", "value": os.environ.get("AUTH_NEGATIVE_TTL", "60"), "description": "无效令牌在该时间内重复出现时不再查找与记录日志，也是统计IP鉴权失败次数的时间窗口。"},
+            "AUTH_CACHE_SIZE": {"label": "鉴权缓存数量", "value": os.environ.get("AUTH_CACHE_SIZE", "10000"), "description": "有效与无效令牌各自最多缓存的数量，超出时淘汰最久未使用的。"},
+            "AUTH_FAILURE_LIMIT": {"label": "鉴权失败次数上限", "value": os.environ.get("AUTH_FAILURE_LIMIT", "20"), "description": "同一IP在时间窗口内鉴权失败超过该次数后直接返回429，不再读取请求体；0表示不限制。"},
+            "RESPONSE_COMPRESSION_ENABLED": {
+                "label": "响应压缩",
+                "value": os.environ.get("RESPONSE_COMPRESSION_ENABLED", "true"),
+                "type": "radio",
+                "options": [
+                    {"value": "true", "description": "开启，按客户端的 Accept-Encoding 使用gzip或brotli压缩响应"},
+                    {"value": "false", "description": "关闭"}
+                ],
+                "description": "压缩较大的非流式响应(如模型列表、批处理结果)，已压缩的内容与图片原样输出。"
+            },
+            "RESPONSE_COMPRESSION_MIN_BYTES": {"label": "压缩最小字节数", "value": os.environ.get("RESPONSE_COMPRESSION_MIN_BYTES", "1024"), "description": "小于该字节数的响应不压缩。"},
+            "RESPONSE_COMPRESSION_SSE": {
+                "label": "压缩流式响应",
+                "value": os.environ.get("RESPONSE_COMPRESSION_SSE", "false"),
+                "type": "radio",
+                "options": [
+                    {"value": "true", "description": "开启，每个数据块压缩后立即刷新"},
+                    {"value": "false", "description": "关闭，流式响应不压缩"}
+                ],
+                "description": "是否压缩流式(SSE)响应。部分客户端不支持压缩的SSE，默认关闭。"
+            },
+            "WHITELIST_IPS": {"label": "IP白名单", "value": os.environ.get("WHITELIST_IPS", ""), "description": "允许直接访问的IP地址或CIDR网段(支持IPv6，如 10.0.0.0/8)，多个请用逗号隔开。"},
+            "BLACKLIST_IPS": {"label": "IP黑名单", "value": os.environ.get("BLACKLIST_IPS", ""), "description": "禁止访问的IP地址或CIDR网段(支持IPv6，如 203.0.113.0/24)，多个请用逗号隔开。"},
             "GEMINI_EMPTY_RESPONSE_RETRIES": {"label": "Gemini空响应重试次数", "value": os.environ.get("GEMINI_EMPTY_RESPONSE_RETRIES", "0"), "description": "Gemini API返回空响应时的最大重试次数。"},
             "GEMINI_503_RETRIES": {"label": "Gemini服务503异常重试次数", "value": os.environ.get("GEMINI_503_RETRIES", "3"), "description": "Gemini API当遇到503服务不可用错误时的最大重试次数。"},
             "GEMINI_429_RETRIES": {"label": "Gemini服务429异常重试次数", "value": os.environ.get("GEMINI_429_RETRIES", "3"), "description": "Gemini API当遇到429密钥配额已用尽或其他原因错误时的最大重试次数。"},
             "GEMINI_RETRY_DELAY": {"label": "Gemini服务异常重试间隔时间(秒)", "value": os.environ.get("GEMINI_RETRY_DELAY", "1"), "description": "Gemini API当遇到异常时重试的间隔时间（秒）。"},
+            "RESPONSE_CACHE_ENABLED": {
+                "label": "响应缓存",
+                "value": os.environ.get("RESPONSE_CACHE_ENABLED", "false"),
+                "type": "radio",
+                "options": [
+                    {"value": "true", "description": "开启，相同请求直接返回缓存结果"},
+                    {"value": "false", "description": "关闭"}
+                ],
+                "description": "缓存聊天补全结果，相同模型、消息与生成参数的请求不再调用Gemini API。访问密钥可单独关闭。"
+            },
+            "RESPONSE_CACHE_DETERMINISTIC_ONLY": {
+                "label": "仅缓存确定性请求",
+                "value": os.environ.get("RESPONSE_CACHE_DETERMINISTIC_ONLY", "true"),
+                "type": "radio",
+                "options": [
+                    {"value": "true", "description": "只缓存 temperature 为 0 的请求（推荐）"},
+                    {"value": "false", "description": "缓存所有请求"}
+                ],
+                "description": "控制哪些请求可以使用响应缓存。"
+            },
+            "REQUEST_COALESCING_ENABLED": {
+                "label": "合并相同请求",
+                "value": os.environ.get("REQUEST_COALESCING_ENABLED", "false"),
+                "type": "radio",
+                "options": [
+                    {"value": "true", "description": "开启，同时到达的相同确定性请求共享一次API调用"},
+                    {"value": "false", "description": "关闭"}
+                ],
+                "description": "合并同时进行中的 temperature 为 0 的相同请求，流式请求会分别转发给每个客户端。"
+            },
+            "STREAM_BUFFER_CHUNKS": {"label": "流式缓冲块数", "value": os.environ.get("STREAM_BUFFER_CHUNKS", "16"), "description": "每个流式客户端最多缓冲的数据块数量，客户端读取较慢时暂停读取上游，避免数据堆积在内存中；合并的流式请求中读取过慢的客户端被单独断开。"},
+            "RESPONSE_CACHE_TTL_SECONDS": {"label": "响应缓存有效期(秒)", "value": os.environ.get("RESPONSE_CACHE_TTL_SECONDS", "300"), "description": "缓存结果的有效时间。"},
+            "RESPONSE_CACHE_MAX_MB": {"label": "响应缓存大小(MB)", "value": os.environ.get("RESPONSE_CACHE_MAX_MB", "64"), "description": "响应缓存的最大内存占用，超出后淘汰最久未使用的结果。"},
+            "CONTEXT_CACHE_ENABLED": {
+                "label": "上下文缓存",
+                "value": os.environ.get("CONTEXT_CACHE_ENABLED", "false"),
+                "type": "radio",
+                "options": [
+                    {"value": "true", "description": "开启，重复出现的长系统提示词或对话历史使用Gemini上下文缓存"},
+                    {"value": "false", "description": "关闭"}
+                ],
+                "description": "相同的长前缀重复出现后，为当前API密钥创建Gemini上下文缓存，之后的请求只发送剩余内容。"
+            },
+            "CONTEXT_CACHE_MIN_CHARS": {"label": "上下文缓存最小字符数", "value": os.environ.get("CONTEXT_CACHE_MIN_CHARS", "16384"), "description": "前缀达到该字符数才创建上下文缓存，需满足Gemini的最小缓存token数。"},
+            "CONTEXT_CACHE_MIN_REPEATS": {"label": "上下文缓存触发次数", "value": os.environ.get("CONTEXT_CACHE_MIN_REPEATS", "2"), "description": "相同前缀出现该次数后才创建上下文缓存。"},
+            "CONTEXT_CACHE_TTL_SECONDS": {"label": "上下文缓存有效期(秒)", "value": os.environ.get("CONTEXT_CACHE_TTL_SECONDS", "600"), "description": "创建上下文缓存时设置的有效期。"},
+            "MESSAGE_PREFIX_CACHE_SIZE": {"label": "消息转换缓存条数", "value": os.environ.get("MESSAGE_PREFIX_CACHE_SIZE", "256"), "description": "缓存已转换的对话历史前缀，多轮对话只需转换新增的消息，0表示不缓存。"},
+            "CONTEXT_TRIM_STRATEGY": {"label": "上下文超长裁剪策略", "value": os.environ.get("CONTEXT_TRIM_STRATEGY", "images,oldest"), "description": "请求超出模型上下文窗口时依次执行的裁剪步骤(英文逗号分隔): images 去掉较早消息中的图片，oldest 丢弃最早的对话轮次，placeholder 丢弃最早的轮次并留下省略说明；留空表示不裁剪，直接返回400。"},
+            "CONTEXT_WINDOW_TOKENS": {"label": "模型上下文窗口", "value": os.environ.get("CONTEXT_WINDOW_TOKENS", ""), "description": "按模型名前缀覆盖输入token上限，例如 gemini-2.0-flash:1048576；未设置时使用模型列表返回的上限。"},
+            "CONTEXT_WINDOW_SAFETY": {"label": "上下文窗口使用比例", "value": os.environ.get("CONTEXT_WINDOW_SAFETY", "0.9"), "description": "本地估算的token数只允许使用窗口的该比例，为估算误差留出余量。"},
             "PROXY_URL": {"label": "代理URL", "value": os.environ.get("PROXY_URL", ""), "description": "用于访问Gemini API的HTTP/HTTPS代理地址。"},
         },
         "图片处理与存储": {
@@ -804,6 +1377,9 @@ async def get_env_vars(_: None = Depends(verify_jwt_token)):
                 ],
                 "description": "控制在生成图片时如何处理历史对话中的图片。"
             },
+            "HISTORY_IMAGE_CACHE_MB": {"label": "历史图片缓存大小(MB)", "value": os.environ.get("HISTORY_IMAGE_CACHE_MB", "64"), "description": "缓存历史对话中已下载图片的最大内存占用，0表示不缓存。"},
+            "HISTORY_IMAGE_FETCH_CONCURRENCY": {"label": "历史图片并发下载数", "value": os.environ.get("HISTORY_IMAGE_FETCH_CONCURRENCY", "4"), "description": "提交上下文所有图片时，同时下载历史图片的最大数量。"},
+            "HISTORY_IMAGE_FETCH_DEADLINE_SECONDS": {"label": "历史图片获取超时(秒)", "value": os.environ.get("HISTORY_IMAGE_FETCH_DEADLINE_SECONDS", "8"), "description": "单次请求获取所有历史图片的最长等待时间，超时的图片以占位图代替。"},
             "IMAGE_STORAGE_TYPE": {
                 "label": "图片存储类型",
                 "value": os.environ.get("IMAGE_STORAGE_TYPE", "local"),
@@ -847,6 +1423,71 @@ async def get_env_vars(_: None = Depends(verify_jwt_token)):
             "QINIU_SECRET_KEY": {"label": "七牛云Secret Key", "value": os.environ.get("QINIU_SECRET_KEY", ""), "type": "password", "description": "七牛云API私有密钥(SK)。"},
             "QINIU_BUCKET_NAME": {"label": "七牛云存储空间名", "value": os.environ.get("QINIU_BUCKET_NAME", ""), "description": "用于存储图片的七牛云存储空间名称。"},
             "QINIU_BUCKET_DOMAIN": {"label": "七牛云域名", "value": os.environ.get("QINIU_BUCKET_DOMAIN", ""), "description": "该存储空间对应的访问域名。"},
+        },
+        "日志设置": {
+            "LOG_LEVEL": {
+                "label": "日志级别",
+                "value": os.environ.get("LOG_LEVEL", "INFO"),
+                "type": "radio",
+                "options": [
+                    {"value": "INFO", "description": "记录所有请求日志"},
+                    {"value": "WARNING", "description": "只记录警告与错误"},
+                    {"value": "ERROR", "description": "只记录错误"}
+                ],
+                "description": "低于该级别的日志不会被格式化与输出。"
+            },
+            "LOG_OUTPUT_FORMAT": {
+                "label": "控制台日志格式",
+                "value": os.environ.get("LOG_OUTPUT_FORMAT", "text"),
+                "type": "radio",
+                "options": [
+                    {"value": "text", "description": "文本格式"},
+                    {"value": "json", "description": "每行一条JSON，便于日志系统采集"}
+                ],
+                "description": "控制台输出的日志格式。"
+            },
+            "LOG_SUCCESS_SAMPLE_RATE": {"label": "成功日志采样比例", "value": os.environ.get("LOG_SUCCESS_SAMPLE_RATE", "1"), "description": "成功请求日志的记录比例(0-1)，高并发时可以降低以减少日志量，错误日志始终记录。"},
+        },
+        "监控设置": {
+            "SYSINFO_INTERVAL": {"label": "系统信息采样间隔", "value": os.environ.get("SYSINFO_INTERVAL", "1"), "description": "系统信息页面的采样间隔(秒)，所有客户端共享同一个后台采样器。"},
+            "LOOP_MONITOR_ENABLED": {
+                "label": "事件循环监控",
+                "value": os.environ.get("LOOP_MONITOR_ENABLED", "true"),
+                "type": "radio",
+                "options": [
+                    {"value": "true", "description": "开启"},
+                    {"value": "false", "description": "关闭"}
+                ],
+                "description": "监控事件循环延迟，事件循环被同步代码阻塞时记录调用栈。"
+            },
+            "SLOW_CALLBACK_THRESHOLD_MS": {"label": "慢回调阈值", "value": os.environ.get("SLOW_CALLBACK_THRESHOLD_MS", "100"), "description": "事件循环被阻塞超过该时长(毫秒)时记录调用栈并输出警告日志。"},
+            "PROFILER_INTERVAL_MS": {"label": "采样分析间隔", "value": os.environ.get("PROFILER_INTERVAL_MS", "5"), "description": "采样分析器的采样间隔(毫秒)。"},
+            "PROFILER_MAX_SECONDS": {"label": "采样分析最长时间", "value": os.environ.get("PROFILER_MAX_SECONDS", "60"), "description": "采样分析器单次最长运行时间(秒)，超时自动停止。"},
+            "TRACING_ENABLED": {
+                "label": "请求耗时追踪",
+                "value": os.environ.get("TRACING_ENABLED", "false"),
+                "type": "radio",
+                "options": [
+                    {"value": "true", "description": "开启，响应头中附加 Server-Timing 并导出追踪数据"},
+                    {"value": "false", "description": "关闭"}
+                ],
+                "description": "记录鉴权、限流、消息转换、获取密钥、上游连接/首字节/流式输出、图片保存与序列化等阶段的耗时。"
+            },
+            "TRACE_SAMPLE_RATE": {"label": "追踪采样比例", "value": os.environ.get("TRACE_SAMPLE_RATE", "1"), "description": "被追踪的请求比例(0-1)。"},
+            "TRACE_EXPORT_FILE": {"label": "追踪导出文件", "value": os.environ.get("TRACE_EXPORT_FILE", ""), "description": "追踪数据以 OTLP JSON 格式追加写入该文件(每行一批)，留空不写入。"},
+            "TRACE_EXPORT_ENDPOINT": {"label": "追踪收集器地址", "value": os.environ.get("TRACE_EXPORT_ENDPOINT", ""), "description": "OTLP/HTTP JSON 收集器地址，例如 http://127.0.0.1:4318/v1/traces，留空不发送。"},
+            "USAGE_FILE": {"label": "用量统计文件", "value": os.environ.get("USAGE_FILE", "app/usage.json"), "description": "按访问密钥、Gemini密钥与模型统计的请求数与token用量定期保存到该文件，可通过 /admin/usage 查询。"},
+            "USAGE_BUCKET_SECONDS": {"label": "用量统计时间粒度", "value": os.environ.get("USAGE_BUCKET_SECONDS", "3600"), "description": "用量按该时长(秒)分桶统计，即查询的最小时间粒度。"},
+            "USAGE_RETENTION_DAYS": {"label": "用量统计保留天数", "value": os.environ.get("USAGE_RETENTION_DAYS", "30"), "description": "超过该天数的用量统计会被清理。"},
+            "USAGE_FLUSH_INTERVAL": {"label": "用量统计保存间隔", "value": os.environ.get("USAGE_FLUSH_INTERVAL", "60"), "description": "用量统计写入文件的间隔(秒)。"},
+        },
+        "批处理设置": {
+            "BATCH_DB_FILE": {"label": "批处理数据库文件", "value": os.environ.get("BATCH_DB_FILE", "app/batch_queue.db"), "description": "/v1/files 与 /v1/batches 的文件、任务与进度保存在该SQLite文件中，服务重启后继续处理未完成的任务。"},
+            "BATCH_CONCURRENCY": {"label": "批处理并发数", "value": os.environ.get("BATCH_CONCURRENCY", "4"), "description": "批处理同时进行的上游请求数上限，实际不超过可用的API密钥数。"},
+            "BATCH_MAX_INTERACTIVE": {"label": "交互请求让路阈值", "value": os.environ.get("BATCH_MAX_INTERACTIVE", "2"), "description": "处理中的交互请求超过该数量时暂停派发批处理请求，避免影响在线调用。"},
+            "BATCH_MAX_ATTEMPTS": {"label": "批处理最大尝试次数", "value": os.environ.get("BATCH_MAX_ATTEMPTS", "5"), "description": "单个请求遇到429/5xx时按指数退避重新排队，超过该次数后写入错误文件。"},
+            "BATCH_KEY_COOLDOWN": {"label": "密钥冷却时间", "value": os.environ.get("BATCH_KEY_COOLDOWN", "60"), "description": "密钥返回429后批处理暂停使用该密钥的时间(秒)。"},
+            "BATCH_MAX_FILE_MB": {"label": "上传文件大小上限", "value": os.environ.get("BATCH_MAX_FILE_MB", "100"), "description": "/v1/files 上传文件的最大大小(MB)。"},
         }
     }
     return JSONResponse(content=env_vars_config)
@@ -886,10 +1527,26 @@ async def login_for_access_token(request: Request):
 async def get_admin_status():
     return {
         "api_keys_count": len(key_manager.api_keys),
-        "available_models_count": len(GeminiClient.AVAILABLE_MODELS),
+        "available_models_count": len(model_registry.models),
         "max_requests_per_minute": MAX_REQUESTS_PER_MINUTE,
         "max_requests_per_day_per_ip": MAX_REQUESTS_PER_DAY_PER_IP,
-        "max_retries": len(key_manager.api_keys)
+        "max_retries": len(key_manager.api_keys),
+        "history_image_cache": history_image_cache.stats(),
+        "message_prefix_cache": message_prefix_cache.stats(),
+        "context_cache": context_cache.stats(),
+        "response_cache": response_cache.stats(),
+        "request_coalescing": request_coalescer.stats(),
+        "tracing": trace_exporter.stats(),
+        "model_registry": model_registry.stats(),
+        "batch_queue": batch_queue.stats(),
+        "admission": admission_controller.stats(),
+        "adaptive_limits": adaptive_limits.stats(),
+        "usage": usage_ledger.stats(),
+        "context_window": context_window.stats(),
+        "request_body": request_body_limits.stats(),
+        "auth_cache": auth_cache.stats(),
+        "ip_filter": {"whitelist": authorized_ips.stats(), "blacklist": blacklisted_ips.stats()},
+        "compression": compression_stats.stats()
     }
 
 async def reload_config():
@@ -897,10 +1554,10 @@ async def reload_config():
 
     MAX_REQUESTS_PER_MINUTE = int(os.environ.get("MAX_REQUESTS_PER_MINUTE", "30"))
     MAX_REQUESTS_PER_DAY_PER_IP = int(os.environ.get("MAX_REQUESTS_PER_DAY_PER_IP", "600"))
-    WHITELIST_IPS = os.environ.get("WHITELIST_IPS", "").split(",")
-    authorized_ips = set(ip.strip() for ip in WHITELIST_IPS if ip.strip())
-    BLACKLIST_IPS = os.environ.get("BLACKLIST_IPS", "").split(",")
-    blacklisted_ips = set(ip.strip() for ip in BLACKLIST_IPS if ip.strip())
+    WHITELIST_IPS = parse_ip_list(os.environ.get("WHITELIST_IPS", ""))
+    authorized_ips = IPMatcher("whitelist", WHITELIST_IPS)
+    BLACKLIST_IPS = parse_ip_list(os.environ.get("BLACKLIST_IPS", ""))
+    blacklisted_ips = IPMatcher("blacklist", BLACKLIST_IPS)
     GEMINI_EMPTY_RESPONSE_RETRIES = int(os.environ.get('GEMINI_EMPTY_RESPONSE_RETRIES', '0'))
     GEMINI_503_RETRIES = int(os.environ.get('GEMINI_503_RETRIES', '3'))
     GEMINI_429_RETRIES = int(os.environ.get('GEMINI_429_RETRIES', '3'))
@@ -928,10 +1585,64 @@ async def reload_config():
         await reload_keys()
     # 重新初始化图片存储
     global_image_storage = get_image_storage()
+    # 重新设置历史图片缓存容量
+    reload_history_image_cache()
+    reload_message_prefix_cache()
+    reload_context_cache()
+    reload_log_settings(logger)
+    reload_sysinfo_sampler()
+    reload_loop_monitor()
+    reload_tracing()
+    reload_model_registry(lambda: key_manager.api_keys, GeminiClient.list_available_models)
+    reload_embedding_settings()
+    reload_batch_settings()
+    reload_admission_settings()
+    reload_adaptive_limits()
+    reload_usage_settings()
+    reload_context_window()
+    reload_request_body_settings()
+    reload_compression_settings()
+    reload_auth_cache()
+    # 重新加载响应缓存与请求合并配置
+    reload_response_cache()
+    reload_request_coalescer()
     log_msg = format_log_message('INFO', "配置已重新加载。")
     logger.info(log_msg)
 
 
+@app.get("/admin/usage", dependencies=[Depends(verify_jwt_token)])
+async def get_usage(group_by: str = "model", hours: float = 24, name: str = None, series: bool = False):
+    """按访问密钥(access_key)、Gemini密钥(api_key)或模型(model)汇总最近 hours 小时的请求数与token用量"""
+    try:
+        return usage_ledger.query(group_by, since=time.time() - hours * 3600, name=name, series=series)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+@app.get("/admin/loop_monitor", dependencies=[Depends(verify_jwt_token)])
+async def get_loop_monitor_stats():
+    return {"loop_monitor": loop_monitor.stats(), "profiler": sampling_profiler.status()}
+
+@app.post("/admin/profiler/start", dependencies=[Depends(verify_jwt_token)])
+async def start_profiler(payload: dict = Body(default={})):
+    started = sampling_profiler.start(
+        duration=payload.get("duration"),
+        interval_ms=payload.get("interval_ms"),
+        all_threads=bool(payload.get("all_threads", False)),
+    )
+    if not started:
+        raise HTTPException(status_code=409, detail="采样分析器已在运行")
+    return {"message": "采样分析已开始", **sampling_profiler.status()}
+
+@app.post("/admin/profiler/stop", dependencies=[Depends(verify_jwt_token)])
+async def stop_profiler():
+    await asyncio.to_thread(sampling_profiler.stop)
+    return {"message": "采样分析已停止", **sampling_profiler.status()}
+
+@app.get("/admin/profiler/folded", dependencies=[Depends(verify_jwt_token)])
+async def get_profiler_folded():
+    # 折叠格式，可直接用于 flamegraph.pl 或 speedscope
+    return PlainTextResponse(sampling_profiler.folded(), headers={"Content-Disposition": "attachment; filename=profile.folded"})
+
 @app.post("/admin/update")
 async def update_env_vars(request: Request, _: None = Depends(verify_jwt_token)):
     data = await request.json()
@@ -1080,8 +1791,8 @@ async def check_gemini_key_real(payload: dict = Body(...)):
     try:
         gemini_client = GeminiClient(api_key, storage=global_image_storage)
         chat_request = ChatCompletionRequest(model=model, messages=[{"role": "user", "content": "test"}])
-        contents, system_instruction = GeminiClient.convert_messages(GeminiClient, chat_request.messages)
-        response_content = await asyncio.to_thread(gemini_client.complete_chat, chat_request, contents, safety_settings, system_instruction)
+        contents, system_instruction = GeminiClient.convert_messages(chat_request.messages)
+        response_content = await gemini_client.complete_chat(chat_request, contents, safety_settings, system_instruction)
         
         if response_content and response_content.text:
             return JSONResponse(content={"valid": True, "message": "API 密钥真实有效"})
@@ -1168,7 +1879,8 @@ async def create_key(request: Request, key_create: AccessKeyCreate):
     while new_key_str in access_keys:
         new_key_str = "sk-" + generate_random_alphanumeric(64)
 
-    if key_create.usage_limit is None:
+    # 没有次数与token限制时每日重置没有意义
+    if key_create.usage_limit is None and key_create.token_limit is None:
         key_create.reset_daily = False
 
     new_key = AccessKey(
@@ -1179,6 +1891,7 @@ async def create_key(request: Request, key_create: AccessKeyCreate):
     with access_keys_lock:
         access_keys[new_key.key] = new_key.dict()
         save_access_keys()
+    auth_cache.invalidate(new_key.key)
     
     client_ip = get_client_ip(request)
     log_msg = format_log_message('INFO', f"访问密钥已创建: {new_key.key[:10]}...", extra={'ip': client_ip, 'request_type': 'admin_create_key'})
@@ -1195,13 +1908,15 @@ async def update_key(request: Request, key: str, key_update: AccessKey):
     # Key本身不应改变，但如果前端发送的key与AccessKey对象中的不一致，则以URL中的为准
     key_update.key = key
 
-    if key_update.usage_limit is None:
+    # 没有次数与token限制时每日重置没有意义
+    if key_update.usage_limit is None and key_update.token_limit is None:
         key_update.reset_daily = False
     
     # 更新字典
     with access_keys_lock:
         access_keys[key] = key_update.dict()
         save_access_keys()
+    auth_cache.invalidate(key)
         
     client_ip = get_client_ip(request)
     log_msg = format_log_message('INFO', f"访问密钥已更新: {key[:10]}...", extra={'ip': client_ip, 'request_type': 'admin_update_key'})
@@ -1217,6 +1932,7 @@ async def delete_key(request: Request, key: str):
     with access_keys_lock:
         del access_keys[key]
         save_access_keys()
+    auth_cache.invalidate(key)
         
     client_ip = get_client_ip(request)
     log_msg = format_log_message('INFO', f"访问密钥已删除: {key[:10]}...", extra={'ip': client_ip, 'request_type': 'admin_delete_key'})
@@ -1247,21 +1963,31 @@ async def websocket_endpoint(websocket: WebSocket, token: str = None):
 
     await websocket.accept()
 
-    # 发送所有当前日志
-    for log_entry in list(log_records):
-        await websocket.send_text(log_entry)
-        set_log_new(False)
+    # 订阅日志总线，先发送历史日志，之后由总线推送新日志，空闲时无需轮询
+    subscriber, backlog = log_bus.subscribe()
 
+    async def forward_logs():
+        # 日志以JSON格式发送，text字段为文本格式的完整日志
+        for seq, log_entry in backlog:
+            await websocket.send_text(json.dumps(dict(log_entry, seq=seq), ensure_ascii=False))
+        while True:
+            seq, log_entry, skipped = await subscriber.get()
+            if skipped:
+                # 客户端处理过慢时跳过部分日志，不阻塞日志写入
+                notice = f"... 客户端处理过慢，已跳过 {skipped} 条日志 ..."
+                await websocket.send_text(json.dumps({"level": "WARNING", "message": notice, "text": notice}, ensure_ascii=False))
+            await websocket.send_text(json.dumps(dict(log_entry, seq=seq), ensure_ascii=False))
+
+    forward_task = asyncio.create_task(forward_logs())
     try:
+        # 客户端不会发送消息，receive 仅用于及时感知连接断开
         while True:
-            # 检查是否有新的日志
-            if get_log_new():
-                # 发送最新日志
-                    await websocket.send_text(log_records[-1])
-                    set_log_new(False)
-            await asyncio.sleep(0.1)  # 每0.1秒检查一次
+            await websocket.receive_text()
     except WebSocketDisconnect:
-        print("Client disconnected")
+        pass
+    finally:
+        forward_task.cancel()
+        log_bus.unsubscribe(subscriber)
 
 @app.websocket("/ws/sysinfo")
 async def websocket_sysinfo(websocket: WebSocket, token: str = None):
@@ -1276,35 +2002,20 @@ async def websocket_sysinfo(websocket: WebSocket, token: str = None):
 
     await websocket.accept()
 
+    # 所有客户端共享同一个后台采样器，采样在工作线程中进行，不阻塞事件循环
+    subscriber = sysinfo_sampler.subscribe()
+
+    async def forward_sysinfo():
+        while True:
+            await websocket.send_json(await subscriber.get())
+
+    forward_task = asyncio.create_task(forward_sysinfo())
     try:
-        last_net_info = psutil.net_io_counters()
+        # receive 仅用于及时感知连接断开
         while True:
-            await asyncio.sleep(1)  # 每1秒检查一次
-            # psutil.cpu_percent(interval=1) creates a 1-second blocking delay
-            cpu_percent = psutil.cpu_percent(interval=1)
-            
-            memory_info = psutil.virtual_memory()
-            disk_info = psutil.disk_usage('/')
-            current_net_info = psutil.net_io_counters()
-
-            # Calculate the difference over the 1-second interval
-            net_sent_speed = current_net_info.bytes_sent - last_net_info.bytes_sent
-            net_received_speed = current_net_info.bytes_recv - last_net_info.bytes_recv
-            
-            # Update for the next iteration
-            last_net_info = current_net_info
-
-            sys_info = {
-                "cpu_percent": cpu_percent,
-                "memory_percent": memory_info.percent,
-                "memory_used": f"{memory_info.used / (1024 ** 3):.2f}",
-                "memory_total": f"{memory_info.total / (1024 ** 3):.2f}",
-                "disk_percent": disk_info.percent,
-                "disk_used": f"{disk_info.used / (1024 ** 3):.2f}",
-                "disk_total": f"{disk_info.total / (1024 ** 3):.2f}",
-                "net_sent": f"{net_sent_speed / 1024:.2f}",
-                "net_received": f"{net_received_speed / 1024:.2f}",
-            }
-            await websocket.send_json(sys_info)
+            await websocket.receive_text()
     except WebSocketDisconnect:
-        print("Sysinfo client disconnected")
+        pass
+    finally:
+        forward_task.cancel()
+        sysinfo_sampler.unsubscribe(subscriber)
@@ -0,0 +1,248 @@
+import os
+import base64
+import asyncio
+import logging
+import mimetypes
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple, List, Dict
+from urllib.parse import urlparse
+
+logger = logging.getLogger('my_logger')
+from dotenv import load_dotenv
+# 加载.env文件中的环境变量
+load_dotenv()
+
+# 历史图片并发下载数量
+HISTORY_IMAGE_FETCH_CONCURRENCY = int(os.environ.get('HISTORY_IMAGE_FETCH_CONCURRENCY', 4))
+# 单次请求获取所有历史图片的最长等待时间(秒)，超时的图片使用占位图代替
+HISTORY_IMAGE_FETCH_DEADLINE_SECONDS = float(os.environ.get('HISTORY_IMAGE_FETCH_DEADLINE_SECONDS', 8))
+
+
+class MediaCache:
+    """按字节大小限制的LRU缓存，用于缓存历史消息中图片的base64数据"""
+
+    def __init__(self, max_bytes: int):
+        """初始化缓存
+
+        Args:
+            max_bytes: 缓存允许占用的最大字节数(按base64字符串长度计算)，0表示禁用缓存
+        """
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Tuple[Optional[str], Optional[str]]:
+        """获取缓存的图片
+
+        Returns:
+            tuple: (mime_type, base64_data) 或 (None, None) 如果未命中
+        """
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return None, None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item
+
+    def put(self, key: str, mime_type: str, base64_data: str):
+        """写入缓存，超过容量时淘汰最久未使用的图片"""
+        size = len(base64_data)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.current_bytes -= len(old[1])
+            self._items[key] = (mime_type, base64_data)
+            self.current_bytes += size
+            self._evict()
+
+    def resize(self, max_bytes: int):
+        """调整缓存容量"""
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.current_bytes = 0
+
+    def _evict(self):
+        while self._items and self.current_bytes > self.max_bytes:
+            _, (_, base64_data) = self._items.popitem(last=False)
+            self.current_bytes -= len(base64_data)
+
+    def stats(self) -> dict:
+        return {
+            "items": len(self._items),
+            "size_mb": round(self.current_bytes / (1024 * 1024), 2),
+            "max_size_mb": round(self.max_bytes / (1024 * 1024), 2),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+def _cache_size_from_env() -> int:
+    return int(float(os.environ.get('HISTORY_IMAGE_CACHE_MB', 64)) * 1024 * 1024)
+
+
+# 全局历史图片缓存实例
+history_image_cache = MediaCache(_cache_size_from_env())
+
+
+def reload_history_image_cache():
+    """根据环境变量重新设置缓存容量与并发下载参数"""
+    global HISTORY_IMAGE_FETCH_CONCURRENCY, HISTORY_IMAGE_FETCH_DEADLINE_SECONDS
+    history_image_cache.resize(_cache_size_from_env())
+    HISTORY_IMAGE_FETCH_CONCURRENCY = int(os.environ.get('HISTORY_IMAGE_FETCH_CONCURRENCY', 4))
+    HISTORY_IMAGE_FETCH_DEADLINE_SECONDS = float(os.environ.get('HISTORY_IMAGE_FETCH_DEADLINE_SECONDS', 8))
+
+
+def _local_image_dir() -> str:
+    return os.environ.get('IMAGE_STORAGE_DIR') or os.path.join(os.path.dirname(__file__), 'images')
+
+
+def _is_own_host(url: str, storage=None) -> bool:
+    """判断URL是否指向本服务(HOST_URL或存储实例的host_url)"""
+    netloc = urlparse(url).netloc
+    if not netloc:
+        return False
+    own_hosts = {urlparse(os.environ.get('HOST_URL', "http://127.0.0.1:7860")).netloc}
+    host_url = getattr(storage, 'host_url', None)
+    if host_url:
+        own_hosts.add(urlparse(host_url).netloc)
+    return netloc in own_hosts
+
+
+def resolve_from_storage(url: str, storage=None) -> Tuple[Optional[str], Optional[str]]:
+    """直接从本服务的存储中读取图片，避免对自身发起HTTP请求
+
+    支持 /images/ (本地存储) 与 /memory-images/、/memory-media/ (内存存储) 路径。
+
+    Returns:
+        tuple: (mime_type, base64_data) 或 (None, None) 如果无法从存储中获取
+    """
+    if not _is_own_host(url, storage):
+        return None, None
+    path = urlparse(url).path
+    directory, _, filename = path.rpartition('/')
+    if not filename or filename in ('.', '..'):
+        return None, None
+    try:
+        if directory.endswith('/images'):
+            image_dir = getattr(storage, 'image_dir', None) or _local_image_dir()
+            file_path = os.path.join(image_dir, filename)
+            # 按扩展名得到标准的MIME类型(.jpg 为 image/jpeg)，无法识别的文件仍走HTTP下载
+            mime_type = mimetypes.guess_type(filename)[0]
+            if not os.path.isfile(file_path) or not mime_type or not mime_type.startswith('image/'):
+                return None, None
+            with open(file_path, 'rb') as f:
+                image_data = f.read()
+            return mime_type, base64.b64encode(image_data).decode('utf-8')
+        if directory.endswith('/memory-images') or directory.endswith('/memory-media'):
+            from app.image_storage import MemoryImageStorage
+            if isinstance(storage, MemoryImageStorage):
+                base64_data, mime_type = storage.get_image(filename)
+                if base64_data:
+                    return mime_type, base64_data
+    except Exception as e:
+        logger.warning(f"从本地存储读取图片失败: {e}")
+    return None, None
+
+
+def get_history_image(url: str, storage=None) -> Tuple[Optional[str], Optional[str]]:
+    """获取历史消息中的图片，依次尝试: 本服务存储 -> LRU缓存 -> HTTP下载
+
+    内存存储中的图片本身就是base64数据，不再重复放入缓存。
+
+    Returns:
+        tuple: (mime_type, base64_data) 或 (None, None) 如果失败
+    """
+    mime_type, base64_data = _get_local_history_image(url, storage)
+    if mime_type and base64_data:
+        return mime_type, base64_data
+
+    from app.utils import download_image_to_base64
+    mime_type, base64_data = download_image_to_base64(url)
+    if mime_type and base64_data:
+        history_image_cache.put(url, mime_type, base64_data)
+    return mime_type, base64_data
+
+
+def _get_local_history_image(url: str, storage=None) -> Tuple[Optional[str], Optional[str]]:
+    """不发起网络请求获取图片: 内存存储 -> LRU缓存 -> 本地存储"""
+    mime_type, base64_data = _get_cached_history_image(url, storage)
+    if base64_data:
+        return mime_type, base64_data
+    return _read_stored_history_image(url, storage)
+
+
+def _get_cached_history_image(url: str, storage=None) -> Tuple[Optional[str], Optional[str]]:
+    """从内存存储与LRU缓存中获取图片，不涉及磁盘与网络I/O"""
+    from app.image_storage import MemoryImageStorage
+    if isinstance(storage, MemoryImageStorage) and _is_own_host(url, storage):
+        mime_type, base64_data = resolve_from_storage(url, storage)
+        if base64_data:
+            return mime_type, base64_data
+    return history_image_cache.get(url)
+
+
+def _read_stored_history_image(url: str, storage=None) -> Tuple[Optional[str], Optional[str]]:
+    """从本服务的存储中读取图片(可能读取本地文件)，并放入LRU缓存"""
+    mime_type, base64_data = resolve_from_storage(url, storage)
+    if base64_data:
+        history_image_cache.put(url, mime_type, base64_data)
+    return mime_type, base64_data
+
+
+async def fetch_history_images(urls: List[str], storage=None) -> Dict[str, Tuple[str, str]]:
+    """并发获取一次请求中的所有历史图片
+
+    先从存储与缓存中获取，剩余图片使用异步客户端并发下载，并发数与总等待时间
+    分别由 HISTORY_IMAGE_FETCH_CONCURRENCY 与 HISTORY_IMAGE_FETCH_DEADLINE_SECONDS 控制。
+    超时或失败的图片不会出现在返回结果中，由调用方使用占位图代替。
+
+    Returns:
+        dict: {url: (mime_type, base64_data)}
+    """
+    results = {}
+    remote_urls = []
+    for url in dict.fromkeys(urls):
+        mime_type, base64_data = _get_cached_history_image(url, storage)
+        if not base64_data and _is_own_host(url, storage):
+            # 本地存储的图片在线程中读取，磁盘I/O不阻塞事件循环
+            mime_type, base64_data = await asyncio.to_thread(_read_stored_history_image, url, storage)
+        if mime_type and base64_data:
+            results[url] = (mime_type, base64_data)
+        else:
+            remote_urls.append(url)
+    if not remote_urls:
+        return results
+
+    import httpx
+    from app.utils import download_image_to_base64_async
+    semaphore = asyncio.Semaphore(max(1, HISTORY_IMAGE_FETCH_CONCURRENCY))
+
+    async with httpx.AsyncClient() as client:
+        async def fetch(url):
+            async with semaphore:
+                mime_type, base64_data = await download_image_to_base64_async(client, url)
+            if mime_type and base64_data:
+                history_image_cache.put(url, mime_type, base64_data)
+                results[url] = (mime_type, base64_data)
+
+        tasks = [asyncio.create_task(fetch(url)) for url in remote_urls]
+        done, pending = await asyncio.wait(tasks, timeout=HISTORY_IMAGE_FETCH_DEADLINE_SECONDS)
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+            logger.warning(f"获取历史图片超时，{len(pending)}/{len(remote_urls)} 张图片使用占位图代替")
+    return results
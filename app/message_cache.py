@@ -0,0 +1,110 @@
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional, NamedTuple, Tuple
+
+from .hashing import update_hash
+
+logger = logging.getLogger('my_logger')
+from dotenv import load_dotenv
+# 加载.env文件中的环境变量
+load_dotenv()
+
+
+class ConversionState(NamedTuple):
+    """convert_messages 处理完若干条消息后的不可变快照
+
+    history 元素为 (role, parts)，parts 为 part 字典组成的元组，
+    快照只会被复制引用，不会被修改，可以在多个请求之间安全共享。
+    """
+    history: Tuple[Tuple[str, tuple], ...] = ()
+    errors: Tuple[str, ...] = ()
+    system_instruction_text: str = ""
+    is_system_phase: bool = False
+
+
+def message_digest(previous: bytes, message) -> bytes:
+    """计算链式消息哈希: 哈希值同时由之前所有消息与当前消息决定"""
+    h = hashlib.sha1(previous)
+    h.update(str(message.role).encode('utf-8'))
+    h.update(b'\x00')
+    content = message.content
+    if isinstance(content, str):
+        h.update(b's')
+        h.update(content.encode('utf-8', 'surrogatepass'))
+    else:
+        h.update(b'l')
+        # 文本与图片URL直接写入哈希，不序列化整个条目，多MB的 data: 图片不会被复制
+        update_hash(h, content)
+    return h.digest()
+
+
+class MessagePrefixCache:
+    """按条目数量限制的LRU缓存，保存已转换消息前缀的快照
+
+    客户端每轮对话都会重新发送完整的历史消息，命中最长的已缓存前缀后
+    只需转换新增的尾部消息。
+    """
+
+    def __init__(self, max_items: int):
+        self.max_items = max_items
+        self.hits = 0
+        self.misses = 0
+        self.reused_messages = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: bytes) -> Optional[ConversionState]:
+        with self._lock:
+            state = self._items.get(key)
+            if state is not None:
+                self._items.move_to_end(key)
+            return state
+
+    def put(self, key: bytes, state: ConversionState):
+        if self.max_items <= 0:
+            return
+        with self._lock:
+            self._items[key] = state
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def record(self, reused: int):
+        """记录一次转换命中的前缀消息数量"""
+        with self._lock:
+            if reused:
+                self.hits += 1
+                self.reused_messages += reused
+            else:
+                self.misses += 1
+
+    def resize(self, max_items: int):
+        with self._lock:
+            self.max_items = max_items
+            while len(self._items) > max(self.max_items, 0):
+                self._items.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {
+            "items": len(self._items),
+            "max_items": self.max_items,
+            "hits": self.hits,
+            "misses": self.misses,
+            "reused_messages": self.reused_messages,
+        }
+
+
+def _cache_size_from_env() -> int:
+    return int(os.environ.get('MESSAGE_PREFIX_CACHE_SIZE', 256))
+
+
+# 全局消息前缀缓存实例
+message_prefix_cache = MessagePrefixCache(_cache_size_from_env())
+
+
+def reload_message_prefix_cache():
+    """根据环境变量重新设置消息前缀缓存容量"""
+    message_prefix_cache.resize(_cache_size_from_env())
@@ -0,0 +1,195 @@
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+# 默认的耗时分桶(秒)
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# 生成速度分桶(token/秒)
+RATE_BUCKETS = (1, 5, 10, 20, 50, 100, 200, 500)
+# 事件循环延迟分桶(秒)
+LOOP_LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labelnames: Tuple[str, ...], labels: Tuple, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, labels)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value) -> str:
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """指标基类
+
+    热路径上只做字典查找与数值加法，不加锁: 指标主要在事件循环中更新，
+    线程池中的极少量并发更新即使丢失也不影响监控趋势。
+    """
+    type_name = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def samples(self):
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels) -> float:
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        for labels, value in list(self._values.items()):
+            yield "", _format_labels(self.labelnames, labels), value
+
+
+class Gauge(Metric):
+    """取值由回调函数在采集时计算，回调返回 {标签元组: 值}"""
+    type_name = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (), callback: Optional[Callable[[], Dict[Tuple, float]]] = None):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def set_callback(self, callback: Callable[[], Dict[Tuple, float]]):
+        self.callback = callback
+
+    def samples(self):
+        if self.callback is None:
+            return
+        try:
+            values = self.callback()
+        except Exception:
+            return
+        for labels, value in values.items():
+            yield "", _format_labels(self.labelnames, labels), value
+
+
+class Histogram(Metric):
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # 每个标签组合: [各分桶计数(非累计，最后一项为+Inf), 总和, 次数]
+        self._values: Dict[Tuple, list] = {}
+
+    def observe(self, value: float, *labels):
+        entry = self._values.get(labels)
+        if entry is None:
+            entry = self._values.setdefault(labels, [[0] * (len(self.buckets) + 1), 0.0, 0])
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def samples(self):
+        for labels, (counts, total, count) in list(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                yield "_bucket", _format_labels(self.labelnames, labels, ("le", _format_value(float(bound)))), cumulative
+            yield "_sum", _format_labels(self.labelnames, labels), total
+            yield "_count", _format_labels(self.labelnames, labels), count
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=(), callback=None) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames, callback))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        """按Prometheus文本格式输出所有指标"""
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+
+# 全局指标注册表
+registry = MetricsRegistry()
+
+_START_TIME = time.time()
+
+process_start_time = registry.gauge(
+    "hagemi_process_start_time_seconds", "服务启动时间戳", callback=lambda: {(): _START_TIME})
+
+requests_total = registry.counter(
+    "hagemi_requests_total", "聊天补全请求数", ("model", "request_type", "status_code"))
+request_duration = registry.histogram(
+    "hagemi_request_duration_seconds", "聊天补全请求总耗时", ("model", "request_type"))
+time_to_first_token = registry.histogram(
+    "hagemi_time_to_first_token_seconds", "流式请求首个数据块的耗时", ("model",))
+tokens_per_second = registry.histogram(
+    "hagemi_tokens_per_second", "输出token生成速度", ("model",), buckets=RATE_BUCKETS)
+upstream_responses = registry.counter(
+    "hagemi_upstream_responses_total", "Gemini上游响应状态码", ("key", "model", "status_code"))
+retries_total = registry.counter(
+    "hagemi_retries_total", "按原因统计的重试次数(empty/429/503)", ("cause",))
+api_keys = registry.gauge(
+    "hagemi_api_keys", "API密钥池状态(configured: 已配置, available: 本轮未使用)", ("state",))
+api_key_exhausted_total = registry.counter(
+    "hagemi_api_key_exhausted_total", "所有API密钥都已尝试过而无法获取密钥的次数")
+rate_limit_rejections = registry.counter(
+    "hagemi_rate_limit_rejections_total", "被限流拒绝的请求数", ("scope",))
+storage_save_duration = registry.histogram(
+    "hagemi_storage_save_seconds", "保存生成图片/视频的耗时", ("storage",))
+in_flight_requests = registry.gauge(
+    "hagemi_in_flight_requests", "正在处理中的HTTP请求数")
+event_loop_lag = registry.histogram(
+    "hagemi_event_loop_lag_seconds", "事件循环定时回调的延迟", buckets=LOOP_LAG_BUCKETS)
+slow_callbacks_total = registry.counter(
+    "hagemi_slow_callbacks_total", "阻塞事件循环超过阈值的次数")
+batch_requests_total = registry.counter(
+    "hagemi_batch_requests_total", "批处理任务中的请求处理结果(completed/failed/retried)", ("status",))
+admission_wait = registry.histogram(
+    "hagemi_admission_wait_seconds", "请求在准入队列中的等待时间", ("priority",))
+admission_rejections_total = registry.counter(
+    "hagemi_admission_rejections_total", "准入控制拒绝的请求数(queue_full/deadline/timeout)", ("reason", "priority"))
+admission_queue_depth = registry.gauge(
+    "hagemi_admission_queue_depth", "准入队列中等待的请求数", ("model", "priority"))
+adaptive_concurrency_limit = registry.gauge(
+    "hagemi_adaptive_concurrency_limit", "按上游503与延迟自动调整的单模型并发上限", ("model",))
+adaptive_limit_decreases_total = registry.counter(
+    "hagemi_adaptive_limit_decreases_total", "自适应并发上限降低次数(overload/latency)", ("model", "cause"))
+tokens_total = registry.counter(
+    "hagemi_tokens_total", "按模型统计的Token用量(prompt/completion/total)，流式输出过程中实时累计", ("model", "type"))
+context_trims_total = registry.counter(
+    "hagemi_context_trims_total", "超出上下文窗口时按步骤(images/oldest/placeholder)裁剪的请求数", ("model", "step"))
+auth_rejections_total = registry.counter(
+    "hagemi_auth_rejections_total", "鉴权拒绝的请求数(invalid: 令牌无效, throttled: 失败次数过多被限制)", ("reason",))
+ip_filter_hits_total = registry.counter(
+    "hagemi_ip_filter_hits_total", "IP白名单/黑名单(含CIDR网段)命中次数", ("list",))
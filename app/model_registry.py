@@ -0,0 +1,192 @@
+import os
+import json
+import random
+import asyncio
+import hashlib
+import logging
+import threading
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional
+
+from .utils import format_log_message
+from dotenv import load_dotenv
+# 加载.env文件中的环境变量
+load_dotenv()
+
+logger = logging.getLogger("my_logger")
+
+# /v1/models 中每个模型的固定字段
+MODEL_CREATED = 1678888888
+MODEL_OWNER = "organization-owner"
+
+
+def _load_settings():
+    global MODEL_DISCOVERY_INTERVAL, MODEL_DISCOVERY_SAMPLE_KEYS
+    # 后台刷新模型列表的间隔(秒)，0 表示只在加载密钥时获取
+    MODEL_DISCOVERY_INTERVAL = float(os.environ.get("MODEL_DISCOVERY_INTERVAL", 3600))
+    # 每次获取模型列表时抽样的API密钥数量，结果取并集
+    MODEL_DISCOVERY_SAMPLE_KEYS = int(os.environ.get("MODEL_DISCOVERY_SAMPLE_KEYS", 3))
+
+
+_load_settings()
+
+
+class PrefixTrie:
+    """前缀树，用于判断模型名是否以某个思考模型名开头"""
+
+    _END = object()
+
+    def __init__(self, words: Iterable[str] = ()):
+        self._root: Dict = {}
+        for word in words:
+            self.add(word)
+
+    def add(self, word: str):
+        node = self._root
+        for char in word:
+            node = node.setdefault(char, {})
+        node[self._END] = word
+
+    def longest_prefix(self, text: str) -> Optional[str]:
+        """返回 text 以之开头的最长单词，没有时返回 None"""
+        node = self._root
+        found = node.get(self._END)
+        for char in text:
+            node = node.get(char)
+            if node is None:
+                break
+            found = node.get(self._END, found)
+        return found
+
+
+class ModelRegistry:
+    """可用模型注册表
+
+    模型列表由三部分组成: 从Gemini获取的模型、扩展的思考模型别名与自定义模型。
+    列表更新时一次性构建查找用的集合、思考模型前缀树以及 /v1/models 的响应体与ETag，
+    请求路径上只做集合查找与前缀树匹配。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.gemini_models: List[str] = []
+        self.extended_models: List[str] = []
+        self.extra_models: List[str] = []
+        self.models: List[str] = []
+        self._model_set = frozenset()
+        self._thinking_trie = PrefixTrie()
+        self.body = b""
+        self.etag = ""
+        self._listeners: List[Callable[[List[str]], None]] = []
+        self._discovery_task: Optional[asyncio.Task] = None
+        self._rebuild()
+
+    def on_update(self, listener: Callable[[List[str]], None]):
+        """注册模型列表更新时的回调"""
+        self._listeners.append(listener)
+
+    def set_thinking_models(self, models: Iterable[str]):
+        self._thinking_trie = PrefixTrie(models)
+
+    def update(self, gemini_models: Optional[Iterable[str]] = None, extended_models: Optional[Iterable[str]] = None,
+               extra_models: Optional[Iterable[str]] = None):
+        with self._lock:
+            if gemini_models is not None:
+                # 统一去掉 models/ 前缀
+                self.gemini_models = [model.replace("models/", "", 1) for model in gemini_models]
+            if extended_models is not None:
+                self.extended_models = list(extended_models)
+            if extra_models is not None:
+                self.extra_models = [model for model in extra_models if model]
+            self._rebuild()
+        for listener in self._listeners:
+            listener(self.models)
+
+    def _rebuild(self):
+        # 保持原有顺序并去重
+        models = list(dict.fromkeys(self.gemini_models + self.extended_models + self.extra_models))
+        body = json.dumps({
+            "object": "list",
+            "data": [{"id": model, "object": "model", "created": MODEL_CREATED, "owned_by": MODEL_OWNER} for model in models],
+        }, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        # 先更新响应体再替换引用，读取方无需加锁
+        self.body = body
+        self.etag = f'"{hashlib.sha1(body).hexdigest()[:20]}"'
+        self._model_set = frozenset(models)
+        self.models = models
+
+    def is_available(self, model: str) -> bool:
+        return model in self._model_set
+
+    def thinking_prefix(self, model: str) -> Optional[str]:
+        """返回模型名所匹配的思考模型名，不是思考模型时返回 None"""
+        return self._thinking_trie.longest_prefix(model)
+
+    def is_valid(self, model: str) -> bool:
+        """模型在列表中，或是支持自定义思维预算的思考模型变体"""
+        if model in self._model_set:
+            return True
+        return 'image' not in model.lower() and self._thinking_trie.longest_prefix(model) is not None
+
+    def etag_matches(self, if_none_match: Optional[str]) -> bool:
+        if not if_none_match:
+            return False
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or self.etag in tags or f"W/{self.etag}" in tags
+
+    async def discover(self, api_keys: List[str], fetch: Callable[[str], Awaitable[List[str]]]) -> bool:
+        """从抽样的多个API密钥获取模型列表并取并集，全部失败时保留原列表"""
+        if not api_keys:
+            return False
+        sample = random.sample(api_keys, min(len(api_keys), max(MODEL_DISCOVERY_SAMPLE_KEYS, 1)))
+        results = await asyncio.gather(*(fetch(key) for key in sample), return_exceptions=True)
+        models: Dict[str, None] = {}
+        failures = 0
+        for key, result in zip(sample, results):
+            if isinstance(result, Exception):
+                failures += 1
+                log_msg = format_log_message('WARNING', f"获取模型列表失败: {result}", extra={'key': key[:10], 'request_type': 'model_discovery'})
+                logger.warning(log_msg)
+                continue
+            models.update(dict.fromkeys(result))
+        if not models:
+            return False
+        self.update(gemini_models=list(models))
+        log_msg = format_log_message('INFO', f"模型列表已更新，共 {len(self.models)} 个模型 (抽样密钥: {len(sample)}, 失败: {failures})",
+                                     extra={'request_type': 'model_discovery'})
+        logger.info(log_msg)
+        return True
+
+    def start_periodic_discovery(self, get_api_keys: Callable[[], List[str]], fetch: Callable[[str], Awaitable[List[str]]]):
+        """在事件循环中定期刷新模型列表"""
+        if self._discovery_task is not None and not self._discovery_task.done():
+            return
+
+        async def run():
+            while MODEL_DISCOVERY_INTERVAL > 0:
+                await asyncio.sleep(MODEL_DISCOVERY_INTERVAL)
+                try:
+                    await self.discover(get_api_keys(), fetch)
+                except Exception as e:
+                    logger.error(format_log_message('ERROR', f"刷新模型列表失败: {e}", extra={'request_type': 'model_discovery'}))
+
+        self._discovery_task = asyncio.create_task(run())
+
+    def stats(self) -> dict:
+        return {
+            "models": len(self.models),
+            "gemini_models": len(self.gemini_models),
+            "etag": self.etag,
+            "discovery_interval": MODEL_DISCOVERY_INTERVAL,
+            "discovery_sample_keys": MODEL_DISCOVERY_SAMPLE_KEYS,
+        }
+
+
+# 全局模型注册表
+model_registry = ModelRegistry()
+
+
+def reload_model_registry(get_api_keys: Callable[[], List[str]], fetch: Callable[[str], Awaitable[List[str]]]):
+    """根据环境变量重新加载模型发现配置，间隔从0改为正数时重新启动后台刷新"""
+    _load_settings()
+    if MODEL_DISCOVERY_INTERVAL > 0:
+        model_registry.start_periodic_discovery(get_api_keys, fetch)
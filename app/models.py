@@ -46,22 +46,35 @@ class ModelList(BaseModel):
     object: str = "list"
     data: List[Dict]
 
+class EmbeddingRequest(BaseModel):
+    model: str
+    input: Union[str, List[str], List[int], List[List[int]]]
+    encoding_format: Literal["float", "base64"] = "float"
+    dimensions: Optional[int] = None
+    user: Optional[str] = None
+
 class AccessKey(BaseModel):
     key: str
     name: Optional[str] = None
     usage_limit: Optional[int] = None
     usage_count: int = 0
+    token_limit: Optional[int] = None
     expires_at: Optional[int] = None
     is_active: bool = True
     reset_daily: bool = False
+    response_cache: bool = True
+    priority: Literal["high", "normal", "low"] = "normal"
 
 
 class AccessKeyCreate(BaseModel):
     name: Optional[str] = None
     usage_limit: Optional[int] = None
+    token_limit: Optional[int] = None
     expires_at: Optional[int] = None
     is_active: bool = True
     reset_daily: bool = False
+    response_cache: bool = True
+    priority: Literal["high", "normal", "low"] = "normal"
 
 class Thought(BaseModel):
     value: str
\ No newline at end of file
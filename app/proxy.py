@@ -9,6 +9,7 @@ from .xai_tools import xai_image_request_converter
 from .gemini_tools import gemini_image_request_converter, gemini_veo_request_converter
 logger = logging.getLogger('my_logger')
 from .config_manager import get_api_mappings
+from .compression import accepts_encoding
 
 proxy_router = APIRouter()
 
@@ -87,13 +88,16 @@ async def proxy_request(full_path: str, request: Request):
                 #调用gemini的视频模型请求转换器,获取转换后的请求地址和参数并设置到请求参数中
                 return gemini_veo_request_converter(request.method,headers,request_json)
 
-        # 使用requests发送请求，根据stream参数决定是否启用流式响应
+        if enable_stream:
+            # 流式响应需要逐行解析，只请求requests能够解压的编码
+            headers['accept-encoding'] = 'gzip, deflate'
+        # 使用requests发送请求，始终以流的方式读取，普通响应可以直接转发上游压缩后的数据
         response = requests.request(
             method=request.method,
             url=target_url,
             headers=headers,
             data=request_body, # 转发请求体
-            stream=enable_stream # 根据请求参数决定是否启用流式响应
+            stream=True
         )
         # 处理流式响应
         async def process_stream():
@@ -133,7 +137,17 @@ async def proxy_request(full_path: str, request: Request):
                 media_type=response.headers.get('content-type')
             )
         else:
-            # 返回普通响应
+            # 返回普通响应，上游的压缩编码客户端也支持时直接转发压缩数据，不再解压后重新压缩
+            content_encoding = response.headers.get('content-encoding', '')
+            if content_encoding and content_encoding.lower() != 'identity' and accepts_encoding(request.headers.get('accept-encoding', ''), content_encoding):
+                content = response.raw.read(decode_content=False)
+                response.close()
+                return Response(
+                    content=content,
+                    status_code=response.status_code,
+                    media_type=response.headers.get('content-type'),
+                    headers={'Content-Encoding': content_encoding, 'Vary': 'Accept-Encoding'}
+                )
             return Response(
                 content=response.content,
                 status_code=response.status_code,
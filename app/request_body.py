@@ -0,0 +1,172 @@
+import os
+import json
+import logging
+from typing import Any, Dict, Optional
+
+from fastapi import HTTPException, status
+
+from . import batch_queue
+from .model_registry import PrefixTrie
+from .utils import format_log_message
+from dotenv import load_dotenv
+# 加载.env文件中的环境变量
+load_dotenv()
+
+try:
+    import orjson
+except ImportError:  # 未安装 orjson 时使用标准库
+    orjson = None
+
+logger = logging.getLogger("my_logger")
+
+MB = 1024 * 1024
+
+
+def _parse_route_limits(value: str) -> Dict[str, float]:
+    """解析 "路径前缀:MB,路径前缀:MB" 格式的配置，0 表示不限制"""
+    result = {}
+    for item in value.split(","):
+        path, _, size = item.strip().rpartition(":")
+        try:
+            result[path] = float(size)
+        except ValueError:
+            continue
+    return {path: size for path, size in result.items() if path.startswith("/")}
+
+
+def _load_settings():
+    global REQUEST_BODY_MAX_MB, REQUEST_BODY_ROUTE_LIMITS
+    # 请求体大小上限(MB)，未单独配置的路由使用该值，0 表示不限制
+    REQUEST_BODY_MAX_MB = float(os.environ.get("REQUEST_BODY_MAX_MB", 32))
+    # 按路径前缀单独设置的请求体大小上限(MB)，例如 /v1/embeddings:8,/gemini:64
+    REQUEST_BODY_ROUTE_LIMITS = _parse_route_limits(os.environ.get("REQUEST_BODY_ROUTE_LIMITS", ""))
+
+
+_load_settings()
+
+
+def loads_json(data: bytes) -> Any:
+    """解析JSON，优先使用 orjson，解析失败时抛出 ValueError"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps_json(obj: Any) -> bytes:
+    """序列化为UTF-8编码的JSON，直接得到bytes，不再经过中间的str"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+async def read_json_body(request) -> Optional[Any]:
+    """读取并解析JSON请求体，结果保存在 request.state 中，鉴权与接口处理共用同一次解析
+
+    Content-Type 不是JSON时返回 None；请求体不是合法JSON时抛出 ValueError。
+    """
+    if hasattr(request.state, "json_body"):
+        return request.state.json_body
+    content_type = request.headers.get("content-type", "")
+    body = None
+    if not content_type or "json" in content_type:
+        data = await request.body()
+        body = loads_json(data) if data else None
+    request.state.json_body = body
+    return body
+
+
+class RequestBodyLimits:
+    """按路由的请求体大小上限
+
+    路径按最长前缀匹配 REQUEST_BODY_ROUTE_LIMITS，/v1/files 默认按 BATCH_MAX_FILE_MB 限制(另加表单开销)。
+    """
+
+    def __init__(self):
+        self._routes: Dict[str, float] = {}
+        self._trie = PrefixTrie()
+        self.rejected = 0
+        self.apply_settings()
+
+    def apply_settings(self):
+        self._routes = dict(REQUEST_BODY_ROUTE_LIMITS)
+        self._trie = PrefixTrie(self._routes)
+
+    def limit(self, path: str) -> Optional[int]:
+        """路径对应的上限(字节)，不限制时返回 None"""
+        prefix = self._trie.longest_prefix(path)
+        if prefix is not None:
+            size = self._routes[prefix]
+        elif path.startswith("/v1/files"):
+            size = batch_queue.BATCH_MAX_FILE_MB + 1
+        else:
+            size = REQUEST_BODY_MAX_MB
+        return int(size * MB) if size > 0 else None
+
+    def stats(self) -> dict:
+        return {
+            "max_mb": REQUEST_BODY_MAX_MB,
+            "routes": self._routes,
+            "rejected": self.rejected,
+        }
+
+
+# 全局请求体大小上限
+request_body_limits = RequestBodyLimits()
+
+
+class BodySizeLimitMiddleware:
+    """请求体大小限制(纯ASGI中间件)
+
+    Content-Length 超出上限时不读取请求体直接返回413；没有 Content-Length(分块传输)时边读边计数，
+    超出上限时在读取处抛出413，避免把超大的请求体读入内存。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        limit = request_body_limits.limit(scope["path"]) if scope["type"] == "http" else None
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > limit:
+            await self._reject(scope, send, limit)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    # 在读取请求体的位置抛出，由FastAPI的异常处理返回413
+                    raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=self._rejected(scope, limit))
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+    @staticmethod
+    def _rejected(scope, limit: int) -> str:
+        request_body_limits.rejected += 1
+        detail = f"请求体超过 {limit / MB:g}MB"
+        log_msg = format_log_message('WARNING', f"{scope['path']} {detail}", extra={'status_code': 413})
+        logger.warning(log_msg)
+        return detail
+
+    async def _reject(self, scope, send, limit: int):
+        body = dumps_json({"detail": self._rejected(scope, limit)})
+        await send({
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+
+def reload_request_body_settings():
+    """根据环境变量重新加载请求体大小上限"""
+    _load_settings()
+    request_body_limits.apply_settings()
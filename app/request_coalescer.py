@@ -0,0 +1,249 @@
+import os
+import asyncio
+import logging
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger('my_logger')
+from dotenv import load_dotenv
+# 加载.env文件中的环境变量
+load_dotenv()
+
+# 是否合并并发的相同请求(默认关闭)
+REQUEST_COALESCING_ENABLED = os.environ.get('REQUEST_COALESCING_ENABLED', 'false').lower() == 'true'
+# 每个流式订阅者最多缓冲的数据块数量: 只有一个订阅者时超过该值暂停读取上游(背压)，
+# 合并的多个订阅者中缓冲超过该值的订阅者被断开，不会拖慢其他订阅者
+STREAM_BUFFER_CHUNKS = max(1, int(os.environ.get('STREAM_BUFFER_CHUNKS', 16)))
+
+# 订阅被关闭(客户端断开)的标记
+_CLOSED = object()
+# 订阅者读取过慢被断开的标记
+_TOO_SLOW = object()
+
+
+class SubscriberTooSlow(Exception):
+    """合并的流式请求中，订阅者的缓冲已满，被断开以免拖慢其他订阅者"""
+
+    def __init__(self, message: str = "客户端读取过慢，已断开"):
+        super().__init__(message)
+        self.message = message
+
+
+class Subscription:
+    """流式数据的一个订阅者，拥有独立的缓冲队列"""
+
+    def __init__(self, flight: 'Flight'):
+        self._flight = flight
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self.closed = False
+        # 已读取的数据块数量
+        self.position = 0
+        # 加入时补发的数据块数量，不计入缓冲上限
+        self._backlog = 0
+
+    def _put(self, item):
+        if not self.closed:
+            self._queue.put_nowait(item)
+
+    @property
+    def pending(self) -> int:
+        """缓冲中尚未读取的实时数据块数量(不含加入时补发的部分)"""
+        return self._queue.qsize() - self._backlog
+
+    async def get(self):
+        """读取下一个数据块，订阅已被关闭时抛出 CancelledError，读取过慢被断开时抛出 SubscriberTooSlow"""
+        item = await self._queue.get()
+        if item is _CLOSED:
+            raise asyncio.CancelledError()
+        if item is _TOO_SLOW:
+            raise SubscriberTooSlow()
+        if self._backlog:
+            self._backlog -= 1
+        self.position += 1
+        self._flight._consumed()
+        return item
+
+    def _discard(self, marker):
+        self.closed = True
+        while not self._queue.empty():
+            self._queue.get_nowait()
+        self._backlog = 0
+        self._queue.put_nowait(marker)
+        self._flight.unsubscribe(self)
+
+    def close(self):
+        """客户端断开: 丢弃已缓冲的数据块、唤醒读取方并立即取消订阅"""
+        if not self.closed:
+            self._discard(_CLOSED)
+
+    def drop_slow(self):
+        """缓冲已满: 丢弃已缓冲的数据块并断开，读取方收到 SubscriberTooSlow"""
+        if not self.closed:
+            self._discard(_TOO_SLOW)
+
+
+class Flight:
+    """一次正在进行中的上游调用，相同请求的所有客户端共享其结果
+
+    流式请求: 上游任务通过 send 发布数据块，每个订阅者拥有独立的队列。只有一个订阅者时，
+    其缓冲超过 STREAM_BUFFER_CHUNKS 后上游任务暂停，直到其读取后继续；多个订阅者时缓冲已满的订阅者
+    被单独断开，上游与其他订阅者不受影响。
+    后加入的订阅者会先收到已发布的全部数据块。开始输出且所有订阅者都已读取后，flight丢弃保留的数据块，
+    不再接受新的订阅者，相同的新请求另行发起上游调用，已发布的数据块不会在整个调用期间一直占用内存。
+    非流式请求: 所有等待者通过 result 共享同一个任务的结果。
+    只有当所有订阅者与等待者都离开后，才会取消上游任务。
+    """
+
+    def __init__(self, coalescer: Optional['RequestCoalescer'], key: Optional[str]):
+        self._coalescer = coalescer
+        self.key = key
+        self.task: Optional[asyncio.Task] = None
+        self.events: List = []
+        self.queues: List[Subscription] = []
+        self.waiters = 0
+        self.finished = False
+        # 是否还接受新的订阅者(丢弃保留的数据块后不再接受)
+        self.joinable = True
+        self._streaming = False
+        self._drained = asyncio.Event()
+
+    def start(self, coro):
+        """启动上游任务(仅由leader调用)"""
+        self.task = asyncio.create_task(coro)
+        self.task.add_done_callback(self._on_done)
+        return self.task
+
+    def _on_done(self, task: asyncio.Task):
+        self.finished = True
+        if self._coalescer is not None:
+            self._coalescer._forget(self)
+
+    def publish(self, item):
+        """向所有订阅者广播一个数据块，不等待订阅者读取(用于结束标记、异常与用量事件)"""
+        if self.key is not None and self.joinable:
+            # 只有参与合并的flight需要为后加入的订阅者保留已发布的数据块
+            self.events.append(item)
+        for queue in self.queues:
+            queue._put(item)
+
+    async def send(self, item):
+        """广播一个输出数据块
+
+        只有一个订阅者时，其缓冲已满则等待其读取(背压)；多个订阅者时断开缓冲已满的订阅者，
+        不按最慢的订阅者暂停上游。
+        """
+        self._streaming = True
+        if len(self.queues) > 1:
+            for queue in [queue for queue in self.queues if queue.pending >= STREAM_BUFFER_CHUNKS]:
+                if self._coalescer is not None:
+                    self._coalescer.slow_dropped += 1
+                queue.drop_slow()
+        self.publish(item)
+        while len(self.queues) == 1 and self.queues[0].pending >= STREAM_BUFFER_CHUNKS:
+            self._drained.clear()
+            await self._drained.wait()
+
+    def subscribe(self) -> Subscription:
+        """订阅流式数据，返回独立的订阅者"""
+        queue = Subscription(self)
+        for item in self.events:
+            queue._put(item)
+        queue._backlog = len(self.events)
+        self.queues.append(queue)
+        return queue
+
+    def _consumed(self):
+        """订阅者读取了一个数据块: 解除背压，开始输出后丢弃已被所有订阅者读取的数据块"""
+        self._drained.set()
+        if not self.joinable or not self._streaming or not self.queues:
+            return
+        if all(queue.position > 0 for queue in self.queues):
+            # 保留的数据块已进入每个订阅者的队列，只用于补发给后加入的订阅者
+            self.events = []
+            self.joinable = False
+            if self._coalescer is not None:
+                self._coalescer._forget(self)
+
+    def unsubscribe(self, queue: Subscription):
+        """取消订阅，最后一个订阅者离开时取消上游任务"""
+        if queue in self.queues:
+            self.queues.remove(queue)
+            self._drained.set()
+        self._release_if_idle()
+
+    async def result(self):
+        """等待非流式任务的结果，等待者被取消不会影响其他等待者"""
+        self.waiters += 1
+        try:
+            return await asyncio.shield(self.task)
+        finally:
+            self.waiters -= 1
+            self._release_if_idle()
+
+    def _release_if_idle(self):
+        if self.finished or self.queues or self.waiters:
+            return
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+        if self._coalescer is not None:
+            self._coalescer._forget(self)
+
+
+class RequestCoalescer:
+    """单飞(single-flight)请求合并: 相同key的并发请求只向上游发起一次调用"""
+
+    def __init__(self):
+        self._flights: Dict[str, Flight] = {}
+        self.leaders = 0
+        self.followers = 0
+        self.slow_dropped = 0
+
+    def join(self, key: Optional[str]) -> Tuple[Flight, bool]:
+        """加入key对应的进行中调用
+
+        Returns:
+            tuple: (flight, is_leader)，is_leader为True时调用方需要通过 flight.start 启动上游任务。
+            key为None时返回一个不参与合并的独立flight。
+        """
+        if key is None:
+            return Flight(None, None), True
+        flight = self._flights.get(key)
+        if flight is not None and not flight.finished and flight.joinable:
+            self.followers += 1
+            return flight, False
+        flight = Flight(self, key)
+        self._flights[key] = flight
+        self.leaders += 1
+        return flight, True
+
+    def _forget(self, flight: Flight):
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+
+    def stats(self) -> dict:
+        return {
+            "enabled": REQUEST_COALESCING_ENABLED,
+            "in_flight": len(self._flights),
+            "leaders": self.leaders,
+            "followers": self.followers,
+            "slow_dropped": self.slow_dropped,
+        }
+
+
+# 全局请求合并实例
+request_coalescer = RequestCoalescer()
+
+
+def reload_request_coalescer():
+    """根据环境变量重新加载请求合并配置"""
+    global REQUEST_COALESCING_ENABLED, STREAM_BUFFER_CHUNKS
+    REQUEST_COALESCING_ENABLED = os.environ.get('REQUEST_COALESCING_ENABLED', 'false').lower() == 'true'
+    STREAM_BUFFER_CHUNKS = max(1, int(os.environ.get('STREAM_BUFFER_CHUNKS', 16)))
+
+
+def should_coalesce(chat_request, image_models=()) -> bool:
+    """只合并 temperature 为 0 的确定性请求，图片生成模型不参与合并"""
+    if not REQUEST_COALESCING_ENABLED:
+        return False
+    if chat_request.model in image_models or 'image' in chat_request.model:
+        return False
+    return chat_request.temperature == 0
@@ -0,0 +1,171 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Optional, List, Tuple
+
+from .hashing import structured_digest
+
+logger = logging.getLogger('my_logger')
+from dotenv import load_dotenv
+# 加载.env文件中的环境变量
+load_dotenv()
+
+
+@dataclass
+class CachedResponse:
+    """缓存的聊天补全结果
+
+    events 按原始顺序保存流式输出的内容，元素为 (类型, 文本)，类型为 content 或 reasoning，
+    非流式请求只有一个 content 事件。
+    """
+    events: List[Tuple[str, str]]
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    total_tokens: int = 0
+    created_at: float = field(default_factory=time.time)
+
+    @property
+    def text(self) -> str:
+        return "".join(value for kind, value in self.events if kind == 'content')
+
+    @property
+    def size(self) -> int:
+        return sum(len(value) for _, value in self.events)
+
+
+class ResponseCache:
+    """按字节大小限制、带过期时间的LRU响应缓存"""
+
+    def __init__(self, max_bytes: int, ttl_seconds: float):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if time.time() - entry.created_at > self.ttl_seconds:
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: str, entry: CachedResponse):
+        size = entry.size
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._items:
+                self._remove(key)
+            self._items[key] = entry
+            self.current_bytes += size
+            while self._items and self.current_bytes > self.max_bytes:
+                oldest_key = next(iter(self._items))
+                self._remove(oldest_key)
+                self.evictions += 1
+
+    def configure(self, max_bytes: int, ttl_seconds: float):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self.ttl_seconds = ttl_seconds
+            while self._items and self.current_bytes > self.max_bytes:
+                self._remove(next(iter(self._items)))
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.current_bytes = 0
+
+    def _remove(self, key: str):
+        entry = self._items.pop(key)
+        self.current_bytes -= entry.size
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": RESPONSE_CACHE_ENABLED,
+            "items": len(self._items),
+            "size_mb": round(self.current_bytes / (1024 * 1024), 2),
+            "max_size_mb": round(self.max_bytes / (1024 * 1024), 2),
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+def _load_settings():
+    global RESPONSE_CACHE_ENABLED, RESPONSE_CACHE_DETERMINISTIC_ONLY, RESPONSE_CACHE_TTL_SECONDS, RESPONSE_CACHE_MAX_MB
+    # 是否启用响应缓存(默认关闭)
+    RESPONSE_CACHE_ENABLED = os.environ.get('RESPONSE_CACHE_ENABLED', 'false').lower() == 'true'
+    # 是否只缓存 temperature 为 0 的确定性请求
+    RESPONSE_CACHE_DETERMINISTIC_ONLY = os.environ.get('RESPONSE_CACHE_DETERMINISTIC_ONLY', 'true').lower() == 'true'
+    RESPONSE_CACHE_TTL_SECONDS = float(os.environ.get('RESPONSE_CACHE_TTL_SECONDS', 300))
+    RESPONSE_CACHE_MAX_MB = float(os.environ.get('RESPONSE_CACHE_MAX_MB', 64))
+
+
+_load_settings()
+
+# 全局响应缓存实例
+response_cache = ResponseCache(int(RESPONSE_CACHE_MAX_MB * 1024 * 1024), RESPONSE_CACHE_TTL_SECONDS)
+
+
+def reload_response_cache():
+    """根据环境变量重新加载响应缓存配置"""
+    _load_settings()
+    response_cache.configure(int(RESPONSE_CACHE_MAX_MB * 1024 * 1024), RESPONSE_CACHE_TTL_SECONDS)
+    if not RESPONSE_CACHE_ENABLED:
+        response_cache.clear()
+
+
+def is_cacheable(chat_request, access_key_data: Optional[dict] = None, image_models=()) -> bool:
+    """判断请求是否可以使用响应缓存
+
+    图片生成模型会产生新的存储文件，不参与缓存；访问密钥可通过 response_cache=False 关闭缓存。
+    """
+    if not RESPONSE_CACHE_ENABLED:
+        return False
+    if access_key_data is not None and not access_key_data.get('response_cache', True):
+        return False
+    if chat_request.model in image_models or 'image' in chat_request.model:
+        return False
+    if RESPONSE_CACHE_DETERMINISTIC_ONLY and chat_request.temperature != 0:
+        return False
+    return True
+
+
+def build_cache_key(chat_request, contents, system_instruction) -> str:
+    """根据模型、转换后的contents、system_instruction与生成参数计算哈希"""
+    payload = {
+        "model": chat_request.model,
+        "contents": contents,
+        "system_instruction": system_instruction,
+        "generation_config": {
+            "temperature": chat_request.temperature,
+            "top_p": chat_request.top_p,
+            "n": chat_request.n,
+            "stop": chat_request.stop,
+            "max_tokens": chat_request.max_tokens,
+            "extra_body": chat_request.extra_body,
+        },
+    }
+    # 逐项写入哈希，内联图片按单独的摘要并入，不构建整个请求的规范化JSON
+    return structured_digest(payload)
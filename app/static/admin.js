@@ -50,6 +50,8 @@ document.addEventListener('DOMContentLoaded', function() {
     fetchStorageDetails('local');
     // 获取本地存储图片
     fetchMedia(1, 'local', 10);
+    // 获取事件循环监控状态
+    refreshProfilerStatus();
 
     document.querySelectorAll('.category-header').forEach(header => {
         header.addEventListener('click', function() {
@@ -1043,6 +1045,56 @@ function updateDeleteInvalidKeysButtonVisibility() {
     }
 }
 
+// --- 事件循环监控与采样分析 ---
+async function refreshProfilerStatus() {
+    const response = await fetch('/admin/loop_monitor', {
+        headers: { 'Authorization': 'Bearer ' + token }
+    });
+    if (!response.ok) return;
+    const data = await response.json();
+    const monitor = data.loop_monitor;
+    const profiler = data.profiler;
+    document.getElementById('profiler-toggle-text').textContent = profiler.running ? `停止采样分析 (${profiler.samples} 次采样)` : '开始采样分析';
+    document.getElementById('loop-monitor-status').textContent = monitor.enabled
+        ? `事件循环延迟: ${monitor.last_lag_ms}ms (最大 ${monitor.max_lag_ms}ms)，阻塞超过 ${monitor.slow_callback_threshold_ms}ms 的次数: ${monitor.slow_callbacks}`
+        : '事件循环监控未开启';
+    return profiler;
+}
+
+async function toggleProfiler() {
+    const profiler = await refreshProfilerStatus();
+    if (!profiler) return;
+    const action = profiler.running ? 'stop' : 'start';
+    showLoader();
+    fetch(`/admin/profiler/${action}`, {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+            'Authorization': 'Bearer ' + token
+        },
+        body: JSON.stringify({})
+    })
+    .then(handleApiResponse)
+    .then(refreshProfilerStatus)
+    .finally(hideLoader);
+}
+
+async function downloadProfile() {
+    const response = await fetch('/admin/profiler/folded', {
+        headers: { 'Authorization': 'Bearer ' + token }
+    });
+    const text = await response.text();
+    if (!response.ok || !text) {
+        alert('暂无采样数据，请先开始采样分析');
+        return;
+    }
+    const link = document.createElement('a');
+    link.href = URL.createObjectURL(new Blob([text], { type: 'text/plain' }));
+    link.download = 'profile.folded';
+    link.click();
+    URL.revokeObjectURL(link.href);
+}
+
 function logout() {
     localStorage.removeItem('admin-token');
     window.location.href = '/';
@@ -1534,9 +1586,12 @@ function showAccessKeyPrompt(title, keyData = {}) {
         const isActiveInput = document.getElementById('modal-input-is-active');
         const resetDailyContainer = document.getElementById('modal-reset-daily-container');
         const resetDailyInput = document.getElementById('modal-input-reset-daily');
+        const responseCacheInput = document.getElementById('modal-input-response-cache');
+        const priorityInput = document.getElementById('modal-input-priority');
+        const tokenLimitInput = document.getElementById('modal-input-token-limit');
 
         const toggleResetDaily = () => {
-            const isUnlimited = usageLimitInput.value.trim() === '';
+            const isUnlimited = usageLimitInput.value.trim() === '' && tokenLimitInput.value.trim() === '';
             resetDailyInput.disabled = isUnlimited;
             if (isUnlimited) {
                 resetDailyInput.checked = false;
@@ -1544,10 +1599,12 @@ function showAccessKeyPrompt(title, keyData = {}) {
         };
 
         usageLimitInput.addEventListener('input', toggleResetDaily);
+        tokenLimitInput.addEventListener('input', toggleResetDaily);
 
         // Populate with existing data if available (for editing)
         nameInput.value = keyData.name || '';
         usageLimitInput.value = keyData.usage_limit || '';
+        tokenLimitInput.value = keyData.token_limit || '';
         if (keyData.expires_at) {
             const now = new Date();
             const expiresDate = new Date(keyData.expires_at * 1000);
@@ -1561,6 +1618,8 @@ function showAccessKeyPrompt(title, keyData = {}) {
         // "每日重置" 选项在添加和编辑时都可见
         resetDailyContainer.style.display = 'block';
         resetDailyInput.checked = keyData.reset_daily || false;
+        responseCacheInput.checked = keyData.hasOwnProperty('response_cache') ? keyData.response_cache : true;
+        priorityInput.value = keyData.priority || 'normal';
 
         // "是否启用" 选项仅在编辑时可见
         if (keyData.hasOwnProperty('is_active')) {
@@ -1578,6 +1637,7 @@ function showAccessKeyPrompt(title, keyData = {}) {
         modalConfirmBtn.onclick = () => {
             const name = nameInput.value.trim();
             const usage_limit = usageLimitInput.value.trim();
+            const token_limit = tokenLimitInput.value.trim();
             const hours = expiresAtInput.value.trim();
 
             if (resolvePromise) {
@@ -1592,9 +1652,12 @@ function showAccessKeyPrompt(title, keyData = {}) {
                 resolve({
                     name: name,
                     usage_limit: usage_limit ? parseInt(usage_limit, 10) : null,
+                    token_limit: token_limit ? parseInt(token_limit, 10) : null,
                     expires_at: expires_at_timestamp,
                     is_active: keyData.hasOwnProperty('is_active') ? isActiveInput.checked : true,
-                    reset_daily: resetDailyInput.checked
+                    reset_daily: resetDailyInput.checked,
+                    response_cache: responseCacheInput.checked,
+                    priority: priorityInput.value
                 });
             }
             hideModal();
@@ -1626,9 +1689,12 @@ async function addAccessKey() {
     const data = {
         name: result.name,
         usage_limit: result.usage_limit,
+        token_limit: result.token_limit,
         expires_at: result.expires_at,
         is_active: true,
-        reset_daily: result.reset_daily
+        reset_daily: result.reset_daily,
+        response_cache: result.response_cache,
+        priority: result.priority
     };
 
     showLoader();
@@ -1685,9 +1751,12 @@ async function editAccessKey(key) {
         key: key,
         name: result.name,
         usage_limit: result.usage_limit,
+        token_limit: result.token_limit,
         expires_at: result.expires_at,
         is_active: result.is_active,
         reset_daily: result.reset_daily,
+        response_cache: result.response_cache,
+        priority: result.priority,
         usage_count: key_data.usage_count
     };
 
@@ -0,0 +1,165 @@
+import os
+import time
+import asyncio
+import threading
+from typing import Any, Dict, List, Optional
+
+import psutil
+from dotenv import load_dotenv
+# 加载.env文件中的环境变量
+load_dotenv()
+
+# 系统信息采样间隔(秒)
+SYSINFO_INTERVAL = float(os.environ.get("SYSINFO_INTERVAL", 1))
+
+
+class InFlightMiddleware:
+    """统计正在处理中的HTTP请求数量(纯ASGI中间件，不包装响应体)"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        sysinfo_sampler.in_flight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            sysinfo_sampler.in_flight -= 1
+
+
+class SysInfoSampler:
+    """共享的系统信息采样器
+
+    在后台线程中按固定间隔采集CPU、内存、磁盘、网络与进程信息，并把同一份快照推送给所有订阅者。
+    没有订阅者时线程自动退出，不产生任何开销。事件循环延迟通过 call_soon_threadsafe
+    投递回调并测量其被执行的耗时得到。
+    """
+
+    def __init__(self, interval: float = SYSINFO_INTERVAL):
+        self.interval = interval
+        # 正在处理中的HTTP请求数量，只在事件循环中修改
+        self.in_flight = 0
+        self.latest: Optional[Dict[str, Any]] = None
+        self._subscribers: List[asyncio.Queue] = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._process = psutil.Process(os.getpid())
+        self._loop_lag = 0.0
+
+    def subscribe(self) -> asyncio.Queue:
+        """注册订阅者，返回接收快照的队列(只保留最新一份快照)"""
+        subscriber = asyncio.Queue(maxsize=1)
+        with self._lock:
+            self._loop = asyncio.get_running_loop()
+            self._subscribers.append(subscriber)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="sysinfo-sampler", daemon=True)
+                self._thread.start()
+        if self.latest is not None:
+            subscriber.put_nowait(self.latest)
+        return subscriber
+
+    def unsubscribe(self, subscriber: asyncio.Queue):
+        with self._lock:
+            if subscriber in self._subscribers:
+                self._subscribers.remove(subscriber)
+
+    def _run(self):
+        last_net_info = psutil.net_io_counters()
+        last_time = time.monotonic()
+        # 第一次调用只用于建立基准，返回值无意义
+        psutil.cpu_percent(interval=None)
+        self._process.cpu_percent(interval=None)
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._subscribers:
+                    self._thread = None
+                    return
+                loop = self._loop
+            self._probe_loop_lag(loop)
+
+            now = time.monotonic()
+            current_net_info = psutil.net_io_counters()
+            elapsed = max(now - last_time, 1e-6)
+            snapshot = self._sample(last_net_info, current_net_info, elapsed)
+            last_net_info, last_time = current_net_info, now
+
+            self.latest = snapshot
+            try:
+                loop.call_soon_threadsafe(self._broadcast, snapshot)
+            except RuntimeError:
+                # 事件循环已关闭
+                return
+
+    def _probe_loop_lag(self, loop: asyncio.AbstractEventLoop):
+        scheduled = time.monotonic()
+
+        def _measure():
+            self._loop_lag = time.monotonic() - scheduled
+
+        try:
+            loop.call_soon_threadsafe(_measure)
+        except RuntimeError:
+            pass
+
+    def _sample(self, last_net_info, current_net_info, elapsed: float) -> Dict[str, Any]:
+        memory_info = psutil.virtual_memory()
+        disk_info = psutil.disk_usage('/')
+        # 按实际间隔换算为每秒的速度
+        net_sent_speed = (current_net_info.bytes_sent - last_net_info.bytes_sent) / elapsed
+        net_received_speed = (current_net_info.bytes_recv - last_net_info.bytes_recv) / elapsed
+
+        try:
+            with self._process.oneshot():
+                process_cpu = self._process.cpu_percent(interval=None)
+                process_rss = self._process.memory_info().rss
+                process_threads = self._process.num_threads()
+                get_connections = getattr(self._process, 'net_connections', None) or self._process.connections
+                open_connections = len(get_connections(kind='tcp'))
+        except (psutil.Error, OSError):
+            process_cpu, process_rss, process_threads, open_connections = 0.0, 0, 0, 0
+
+        return {
+            "cpu_percent": psutil.cpu_percent(interval=None),
+            "memory_percent": memory_info.percent,
+            "memory_used": f"{memory_info.used / (1024 ** 3):.2f}",
+            "memory_total": f"{memory_info.total / (1024 ** 3):.2f}",
+            "disk_percent": disk_info.percent,
+            "disk_used": f"{disk_info.used / (1024 ** 3):.2f}",
+            "disk_total": f"{disk_info.total / (1024 ** 3):.2f}",
+            "net_sent": f"{net_sent_speed / 1024:.2f}",
+            "net_received": f"{net_received_speed / 1024:.2f}",
+            "process_cpu_percent": process_cpu,
+            "process_memory": f"{process_rss / (1024 ** 2):.1f}",
+            "process_threads": process_threads,
+            "open_connections": open_connections,
+            "in_flight_requests": self.in_flight,
+            # 上一次探测得到的事件循环延迟(毫秒)
+            "loop_lag_ms": round(self._loop_lag * 1000, 2),
+        }
+
+    def _broadcast(self, snapshot: Dict[str, Any]):
+        # 在事件循环中执行；处理不过来的订阅者只保留最新快照
+        for subscriber in list(self._subscribers):
+            if subscriber.full():
+                try:
+                    subscriber.get_nowait()
+                except asyncio.QueueEmpty:
+                    pass
+            subscriber.put_nowait(snapshot)
+
+
+# 全局系统信息采样器
+sysinfo_sampler = SysInfoSampler()
+
+
+def reload_sysinfo_sampler():
+    """根据环境变量重新加载采样间隔"""
+    global SYSINFO_INTERVAL
+    SYSINFO_INTERVAL = float(os.environ.get("SYSINFO_INTERVAL", 1))
+    sysinfo_sampler.interval = SYSINFO_INTERVAL
@@ -0,0 +1,295 @@
+import os
+import json
+import time
+import queue
+import random
+import asyncio
+import logging
+import functools
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+import requests
+from dotenv import load_dotenv
+# 加载.env文件中的环境变量
+load_dotenv()
+
+logger = logging.getLogger("my_logger")
+
+SERVICE_NAME = "hagemi"
+# 导出队列长度，队列满时丢弃新的追踪数据
+EXPORT_QUEUE_SIZE = 10000
+# 单次导出的最大追踪数量
+EXPORT_BATCH_SIZE = 200
+
+
+def _load_settings():
+    global TRACING_ENABLED, TRACE_SAMPLE_RATE, TRACE_EXPORT_FILE, TRACE_EXPORT_ENDPOINT
+    # 是否开启请求耗时追踪
+    TRACING_ENABLED = os.environ.get("TRACING_ENABLED", "false").lower() == "true"
+    # 追踪采样比例(0-1)
+    TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", 1))
+    # 追踪数据写入的本地文件(每行一个OTLP JSON)
+    TRACE_EXPORT_FILE = os.environ.get("TRACE_EXPORT_FILE", "")
+    # OTLP/HTTP JSON 收集器地址，例如 http://127.0.0.1:4318/v1/traces
+    TRACE_EXPORT_ENDPOINT = os.environ.get("TRACE_EXPORT_ENDPOINT", "")
+
+
+_load_settings()
+
+_current_trace: ContextVar[Optional["Trace"]] = ContextVar("hagemi_trace", default=None)
+
+
+class Span:
+    __slots__ = ('name', 'span_id', 'parent_id', 'start_ns', 'end_ns', 'attributes')
+
+    def __init__(self, name: str, span_id: str, parent_id: Optional[str], start_ns: int, attributes: Optional[dict] = None):
+        self.name = name
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.start_ns = start_ns
+        self.end_ns: Optional[int] = None
+        self.attributes = attributes or {}
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end_ns or self.start_ns) - self.start_ns) / 1e6
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+
+def _attribute_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class Trace:
+    """单个请求的追踪数据
+
+    根span覆盖整个请求，各处理阶段的span默认挂在根span下。时间使用 perf_counter_ns 计算，
+    再换算为以请求开始时刻为基准的Unix纳秒时间戳。
+    """
+
+    def __init__(self, name: str, attributes: Optional[dict] = None):
+        self.trace_id = os.urandom(16).hex()
+        self._epoch_ns = time.time_ns()
+        self._perf_ns = time.perf_counter_ns()
+        self.root = Span(name, os.urandom(8).hex(), None, self._epoch_ns, attributes)
+        self.spans: List[Span] = []
+        self._lock = threading.Lock()
+
+    def now_ns(self) -> int:
+        return self._epoch_ns + time.perf_counter_ns() - self._perf_ns
+
+    def start_span(self, name: str, parent: Optional[Span] = None, attributes: Optional[dict] = None) -> Span:
+        span = Span(name, os.urandom(8).hex(), (parent or self.root).span_id, self.now_ns(), attributes)
+        with self._lock:
+            self.spans.append(span)
+        return span
+
+    def finish(self):
+        self.root.end_ns = self.now_ns()
+
+    def server_timing(self) -> str:
+        """已结束的span的 Server-Timing 响应头，同名span的耗时累加"""
+        durations: Dict[str, float] = {}
+        with self._lock:
+            for span in self.spans:
+                if span.end_ns is not None:
+                    durations[span.name] = durations.get(span.name, 0.0) + span.duration_ms
+        durations["total"] = (self.now_ns() - self.root.start_ns) / 1e6
+        return ", ".join(f"{name};dur={duration:.1f}" for name, duration in durations.items())
+
+    def to_otlp_spans(self) -> List[dict]:
+        with self._lock:
+            spans = [self.root] + self.spans
+        result = []
+        for span in spans:
+            item = {
+                "traceId": self.trace_id,
+                "spanId": span.span_id,
+                "name": span.name,
+                "kind": 2 if span is self.root else 1,  # SERVER / INTERNAL
+                "startTimeUnixNano": str(span.start_ns),
+                "endTimeUnixNano": str(span.end_ns or self.root.end_ns or span.start_ns),
+                "attributes": [{"key": key, "value": _attribute_value(value)} for key, value in span.attributes.items()],
+            }
+            if span.parent_id:
+                item["parentSpanId"] = span.parent_id
+            result.append(item)
+        return result
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+@contextmanager
+def span(name: str, parent: Optional[Span] = None, **attributes):
+    """记录一个处理阶段；当前请求未被追踪时没有任何开销"""
+    trace = _current_trace.get()
+    if trace is None:
+        yield None
+        return
+    current = trace.start_span(name, parent, attributes)
+    try:
+        yield current
+    finally:
+        current.end_ns = trace.now_ns()
+
+
+def record_span(name: str, start_ns: int, end_ns: Optional[int] = None, **attributes) -> Optional[Span]:
+    """记录起止时间已知的阶段(例如首字节耗时)，start_ns 由 now_ns() 获得"""
+    trace = _current_trace.get()
+    if trace is None:
+        return None
+    current = trace.start_span(name, attributes=attributes)
+    current.start_ns = start_ns
+    current.end_ns = end_ns or trace.now_ns()
+    return current
+
+
+def now_ns() -> int:
+    trace = _current_trace.get()
+    return trace.now_ns() if trace is not None else 0
+
+
+def traced(name: str):
+    """把整个函数记录为一个阶段，支持同步与异步函数"""
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class TraceExporter:
+    """后台导出线程，把追踪数据以 OTLP/JSON 格式批量写入文件或发送到收集器"""
+
+    def __init__(self):
+        self.queue: queue.Queue = queue.Queue(maxsize=EXPORT_QUEUE_SIZE)
+        self.dropped = 0
+        self.exported = 0
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(TRACE_EXPORT_FILE or TRACE_EXPORT_ENDPOINT)
+
+    def submit(self, trace: Trace):
+        if not self.enabled:
+            return
+        try:
+            self.queue.put_nowait(trace)
+        except queue.Full:
+            self.dropped += 1
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < EXPORT_BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._export(batch)
+                self.exported += len(batch)
+            except Exception as e:
+                self.dropped += len(batch)
+                logger.warning(f"追踪数据导出失败: {e}")
+
+    @staticmethod
+    def build_payload(traces: List[Trace]) -> dict:
+        spans = [item for trace in traces for item in trace.to_otlp_spans()]
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+                "scopeSpans": [{"scope": {"name": "app.tracing"}, "spans": spans}],
+            }]
+        }
+
+    def _export(self, traces: List[Trace]):
+        payload = self.build_payload(traces)
+        if TRACE_EXPORT_FILE:
+            with open(TRACE_EXPORT_FILE, "a", encoding="utf-8") as f:
+                f.write(json.dumps(payload, ensure_ascii=False) + "\n")
+        if TRACE_EXPORT_ENDPOINT:
+            response = requests.post(TRACE_EXPORT_ENDPOINT, json=payload, timeout=10)
+            response.raise_for_status()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": TRACING_ENABLED,
+            "export_enabled": self.enabled,
+            "queued": self.queue.qsize(),
+            "exported": self.exported,
+            "dropped": self.dropped,
+        }
+
+
+# 全局追踪导出器
+trace_exporter = TraceExporter()
+
+
+class TracingMiddleware:
+    """为每个HTTP请求创建追踪，在响应头中附加 Server-Timing 并在请求结束后导出
+
+    流式响应的响应头在上游返回数据之前发送，Server-Timing 中只包含此前完成的阶段，
+    完整的耗时分解见导出的追踪数据。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not TRACING_ENABLED or random.random() >= TRACE_SAMPLE_RATE:
+            await self.app(scope, receive, send)
+            return
+
+        # 只记录路径，查询参数中可能包含密钥
+        trace = Trace(f"{scope['method']} {scope['path']}", {"http.method": scope["method"], "http.target": scope["path"]})
+        token = _current_trace.set(trace)
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                trace.root.set_attribute("http.status_code", message["status"])
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", trace.server_timing().encode("latin-1")))
+                message = dict(message, headers=headers)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current_trace.reset(token)
+            trace.finish()
+            trace_exporter.submit(trace)
+
+
+def reload_tracing():
+    """根据环境变量重新加载追踪配置"""
+    _load_settings()
@@ -0,0 +1,372 @@
+import os
+import re
+import json
+import time
+import asyncio
+import logging
+from datetime import date, datetime
+from typing import Dict, List, Optional
+
+from . import metrics
+from .utils import format_log_message
+from dotenv import load_dotenv
+# 加载.env文件中的环境变量
+load_dotenv()
+
+logger = logging.getLogger("my_logger")
+
+# 每个计数的字段
+FIELDS = ("requests", "prompt_tokens", "completion_tokens", "total_tokens")
+# 统计维度: 访问密钥、Gemini密钥、模型
+DIMENSIONS = ("access_key", "api_key", "model")
+# 本地估算: ASCII文本约4个字符1个token，中日韩等非ASCII字符约1个字符1个token
+CHARS_PER_TOKEN = 4
+# 每张图片/文件按固定token数估算
+MEDIA_TOKENS = 258
+# 模型消息中的Markdown图片，请求上游前会由 filter_markdown_images_async 替换为图片(或占位图)
+MARKDOWN_IMAGE = re.compile(r'!\[.*?\]\(.*?\)')
+
+
+def _load_settings():
+    global USAGE_FILE, USAGE_BUCKET_SECONDS, USAGE_RETENTION_DAYS, USAGE_FLUSH_INTERVAL
+    # 用量统计的保存文件
+    USAGE_FILE = os.environ.get("USAGE_FILE", "app/usage.json")
+    # 时间桶大小(秒)，查询的最小时间粒度
+    USAGE_BUCKET_SECONDS = max(60, int(os.environ.get("USAGE_BUCKET_SECONDS", 3600)))
+    # 保留的天数，更早的时间桶会被清理
+    USAGE_RETENTION_DAYS = max(1, int(os.environ.get("USAGE_RETENTION_DAYS", 30)))
+    # 写入文件的间隔(秒)
+    USAGE_FLUSH_INTERVAL = max(5, int(os.environ.get("USAGE_FLUSH_INTERVAL", 60)))
+
+
+_load_settings()
+
+
+def estimate_tokens(text: str) -> int:
+    """按字符类别估算token数，Gemini各模型使用相同的分词表，无需按模型区分"""
+    if not text:
+        return 0
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return (ascii_chars + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN + len(text) - ascii_chars
+
+
+def estimate_content_tokens(content) -> int:
+    """估算单条content的token数，图片等媒体按固定数量计"""
+    tokens = 0
+    history_images = isinstance(content, dict) and "model" in (content.get("role") or "")
+    for part in content.get("parts", []) if isinstance(content, dict) else []:
+        if "text" in part:
+            tokens += estimate_tokens(part["text"])
+            if history_images and part["text"] and "![" in part["text"]:
+                # 每张历史图片在发送前都会附加一个图片part，按图片计
+                tokens += MEDIA_TOKENS * len(MARKDOWN_IMAGE.findall(part["text"]))
+        elif "inline_data" in part or "inlineData" in part or "fileData" in part:
+            tokens += MEDIA_TOKENS
+    return tokens
+
+
+def estimate_prompt_tokens(contents, system_instruction=None) -> int:
+    """估算输入token数"""
+    return sum(estimate_content_tokens(content)
+               for content in list(contents or []) + ([system_instruction] if system_instruction else []))
+
+
+def api_key_label(api_key: Optional[str]) -> Optional[str]:
+    """Gemini密钥只保存前后几位，统计文件中不出现完整密钥"""
+    return f"{api_key[:10]}...{api_key[-4:]}" if api_key else None
+
+
+class UsageEvent:
+    """上游调用的用量事件
+
+    合并的流式请求中，上游任务只发布事件，由每个订阅者自己的 UsageMeter 记账与判断额度:
+    api_key 表示开始一次新的上游调用，usage_metadata 为上游返回的累计用量。
+    """
+
+    __slots__ = ('api_key', 'usage_metadata')
+
+    def __init__(self, api_key: Optional[str] = None, usage_metadata: Optional[dict] = None):
+        self.api_key = api_key
+        self.usage_metadata = usage_metadata
+
+
+class UsageMeter:
+    """一次请求的实时用量计量
+
+    上游数据块带有 usageMetadata 时按其累计值记账；没有时按输出文本长度本地估算，
+    收到真实用量后以差值校正。每次变化立即记入统计，因此流式输出过程中就能判断是否超出额度。
+    """
+
+    def __init__(self, ledger: "UsageLedger", access_key: Optional[str], model: str,
+                 prompt_estimate: int = 0, token_limit: Optional[int] = None, daily: bool = False):
+        self._ledger = ledger
+        self.access_key = access_key
+        self.model = model
+        self.prompt_estimate = prompt_estimate
+        self.token_limit = token_limit
+        self.daily = daily
+        self.api_key: Optional[str] = None
+        self.tokens = 0
+        self.finished = False
+        self._reset_attempt()
+
+    def _reset_attempt(self):
+        # 本次尝试已记入的 [输入, 输出, 总计]
+        self._charged = [0, 0, 0]
+        self._estimated_output = 0
+        self._estimated_thoughts = 0
+        self._reported = False
+
+    def attempt(self, api_key: Optional[str]):
+        """开始新的一次上游调用(重试时会更换密钥)，之前调用已消耗的用量保留"""
+        self.api_key = api_key
+        self._reset_attempt()
+
+    def _charge(self, prompt: int, completion: int, total: int):
+        delta = [prompt - self._charged[0], completion - self._charged[1], total - self._charged[2]]
+        if not any(delta):
+            return
+        self._charged = [prompt, completion, total]
+        self.tokens += delta[2]
+        self._ledger.add(self.access_key, self.api_key, self.model, 0, *delta)
+
+    def on_text(self, text: str, thought: bool = False):
+        """收到输出文本，上游尚未返回用量时按长度估算"""
+        if self._reported:
+            return
+        if thought:
+            self._estimated_thoughts += estimate_tokens(text)
+        else:
+            self._estimated_output += estimate_tokens(text)
+        self._charge(self.prompt_estimate, self._estimated_output,
+                     self.prompt_estimate + self._estimated_output + self._estimated_thoughts)
+
+    def on_usage(self, usage_metadata: dict):
+        """收到上游的 usageMetadata(累计值)"""
+        if not usage_metadata:
+            return
+        self._reported = True
+        prompt = usage_metadata.get("promptTokenCount") or 0
+        completion = usage_metadata.get("candidatesTokenCount") or 0
+        total = usage_metadata.get("totalTokenCount") or prompt + completion
+        self._charge(prompt, completion, total)
+
+    def apply(self, event: UsageEvent, upstream: bool = True):
+        """记入一个用量事件；upstream 为 False 时(合并到他人发起的调用)不计入Gemini密钥的用量"""
+        if event.api_key is not None:
+            self.attempt(event.api_key if upstream else None)
+        if event.usage_metadata:
+            self.on_usage(event.usage_metadata)
+
+    def over_budget(self) -> bool:
+        """访问密钥的token额度是否已用完(包括同一密钥的其他进行中请求)"""
+        if not self.token_limit or not self.access_key:
+            return False
+        return self._ledger.tokens_used(self.access_key, self.daily) >= self.token_limit
+
+    def finish(self):
+        """请求成功完成，计入一次请求"""
+        if self.finished:
+            return
+        self.finished = True
+        self._ledger.add(self.access_key, self.api_key, self.model, 1, 0, 0, 0)
+
+
+class TokenBudgetExceeded(Exception):
+    """访问密钥的token额度在输出过程中用完"""
+
+    def __init__(self, message: str = "访问密钥的Token额度已用完"):
+        super().__init__(message)
+        self.message = message
+
+
+class UsageLedger:
+    """按时间桶统计的用量计数
+
+    计数按 维度 → 时间桶 → 名称 组织，值为 [请求数, 输入Token, 输出Token, 总Token]，
+    查询时只需遍历时间范围内的桶。访问密钥另外维护累计与当日总量，用于额度判断。
+    所有方法都在事件循环中调用，定期在线程中写入 USAGE_FILE。
+    """
+
+    def __init__(self):
+        self._buckets: Dict[str, Dict[int, Dict[str, List[int]]]] = {dimension: {} for dimension in DIMENSIONS}
+        self._lifetime: Dict[str, int] = {}
+        self._today: Dict[str, int] = {}
+        self._today_date: Optional[date] = None
+        self._dirty = False
+        self._flush_task: Optional[asyncio.Task] = None
+
+    def meter(self, access_key: Optional[str], model: str, prompt_estimate: int = 0,
+              token_limit: Optional[int] = None, daily: bool = False) -> UsageMeter:
+        return UsageMeter(self, access_key, model, prompt_estimate, token_limit, daily)
+
+    @staticmethod
+    def _bucket(timestamp: float) -> int:
+        return int(timestamp // USAGE_BUCKET_SECONDS) * USAGE_BUCKET_SECONDS
+
+    def _roll_day(self):
+        today = date.today()
+        if self._today_date != today:
+            self._today_date = today
+            self._today = {}
+
+    def add(self, access_key: Optional[str], api_key: Optional[str], model: Optional[str],
+            requests: int = 0, prompt_tokens: int = 0, completion_tokens: int = 0, total_tokens: int = 0,
+            timestamp: Optional[float] = None):
+        bucket = self._bucket(timestamp if timestamp is not None else time.time())
+        delta = (requests, prompt_tokens, completion_tokens, total_tokens)
+        for dimension, name in (("access_key", access_key), ("api_key", api_key_label(api_key)), ("model", model)):
+            if not name:
+                continue
+            names = self._buckets[dimension].setdefault(bucket, {})
+            counter = names.get(name)
+            if counter is None:
+                counter = names[name] = [0, 0, 0, 0]
+            for index, value in enumerate(delta):
+                counter[index] += value
+        if access_key and total_tokens:
+            self._roll_day()
+            self._lifetime[access_key] = self._lifetime.get(access_key, 0) + total_tokens
+            self._today[access_key] = self._today.get(access_key, 0) + total_tokens
+        if model:
+            # 计数器只增不减，估算偏高时的向下校正不反映到指标中
+            for kind, value in (("prompt", prompt_tokens), ("completion", completion_tokens), ("total", total_tokens)):
+                if value > 0:
+                    metrics.tokens_total.inc(model, kind, amount=value)
+        self._dirty = True
+
+    def tokens_used(self, access_key: str, daily: bool = False) -> int:
+        """访问密钥已使用的总token数，daily 为 True 时只统计当日"""
+        if daily:
+            self._roll_day()
+            return self._today.get(access_key, 0)
+        return self._lifetime.get(access_key, 0)
+
+    def query(self, group_by: str = "model", since: Optional[float] = None, until: Optional[float] = None,
+              name: Optional[str] = None, series: bool = False) -> dict:
+        """按维度汇总时间范围内的用量；series 为 True 时同时返回每个时间桶的数据"""
+        if group_by not in DIMENSIONS:
+            raise ValueError(f"group_by 只能是 {', '.join(DIMENSIONS)}")
+        now = time.time()
+        start = self._bucket(since if since is not None else now - 86400)
+        end = until if until is not None else now
+        totals: Dict[str, List[int]] = {}
+        points = []
+        for bucket in sorted(self._buckets[group_by]):
+            if bucket < start or bucket >= end:
+                continue
+            point = [0, 0, 0, 0]
+            for key, counter in self._buckets[group_by][bucket].items():
+                if name is not None and key != name:
+                    continue
+                total = totals.setdefault(key, [0, 0, 0, 0])
+                for index, value in enumerate(counter):
+                    total[index] += value
+                    point[index] += value
+            if series and any(point):
+                points.append(dict(zip(FIELDS, point), bucket=datetime.fromtimestamp(bucket).isoformat()))
+        rows = [dict(zip(FIELDS, counter), name=key) for key, counter in totals.items()]
+        rows.sort(key=lambda row: row["total_tokens"], reverse=True)
+        result = {
+            "group_by": group_by,
+            "since": datetime.fromtimestamp(start).isoformat(),
+            "until": datetime.fromtimestamp(end).isoformat(),
+            "bucket_seconds": USAGE_BUCKET_SECONDS,
+            "totals": dict(zip(FIELDS, [sum(row[field] for row in rows) for field in FIELDS])),
+            "data": rows,
+        }
+        if series:
+            result["series"] = points
+        return result
+
+    def _prune(self):
+        cutoff = self._bucket(time.time() - USAGE_RETENTION_DAYS * 86400)
+        for buckets in self._buckets.values():
+            for bucket in [bucket for bucket in buckets if bucket < cutoff]:
+                del buckets[bucket]
+
+    def _snapshot(self) -> dict:
+        return {
+            "bucket_seconds": USAGE_BUCKET_SECONDS,
+            "buckets": {dimension: {str(bucket): names for bucket, names in buckets.items()}
+                        for dimension, buckets in self._buckets.items()},
+            "lifetime": self._lifetime,
+        }
+
+    def load(self):
+        """从 USAGE_FILE 加载统计，时间桶大小变化时合并到新的时间桶"""
+        try:
+            with open(USAGE_FILE, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, json.JSONDecodeError) as e:
+            logger.warning(format_log_message('WARNING', f"无法读取用量统计文件 {USAGE_FILE}: {e}", extra={'request_type': 'usage'}))
+            return
+        for dimension, buckets in data.get("buckets", {}).items():
+            if dimension not in self._buckets:
+                continue
+            for bucket, names in buckets.items():
+                target = self._buckets[dimension].setdefault(self._bucket(int(bucket)), {})
+                for name, counter in names.items():
+                    total = target.setdefault(name, [0, 0, 0, 0])
+                    for index, value in enumerate(counter[:len(FIELDS)]):
+                        total[index] += value
+        self._lifetime = {key: int(value) for key, value in data.get("lifetime", {}).items()}
+        # 根据当日的时间桶恢复当日用量
+        self._roll_day()
+        midnight = datetime.combine(self._today_date, datetime.min.time()).timestamp()
+        for bucket, names in self._buckets["access_key"].items():
+            if bucket >= self._bucket(midnight):
+                for name, counter in names.items():
+                    self._today[name] = self._today.get(name, 0) + counter[3]
+        self._prune()
+
+    def _write(self, snapshot: dict):
+        temp_file = f"{USAGE_FILE}.tmp"
+        with open(temp_file, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f, separators=(",", ":"))
+        os.replace(temp_file, USAGE_FILE)
+
+    async def flush(self):
+        """有变化时在线程中写入文件"""
+        if not self._dirty:
+            return
+        self._dirty = False
+        self._prune()
+        snapshot = json.loads(json.dumps(self._snapshot()))
+        try:
+            await asyncio.to_thread(self._write, snapshot)
+        except OSError as e:
+            self._dirty = True
+            logger.error(format_log_message('ERROR', f"保存用量统计失败: {e}", extra={'request_type': 'usage'}))
+
+    def start(self):
+        """加载历史统计并在事件循环中定期保存"""
+        if self._flush_task is not None and not self._flush_task.done():
+            return
+        self.load()
+
+        async def run():
+            while True:
+                await asyncio.sleep(USAGE_FLUSH_INTERVAL)
+                await self.flush()
+
+        self._flush_task = asyncio.create_task(run())
+
+    def stats(self) -> dict:
+        return {
+            "bucket_seconds": USAGE_BUCKET_SECONDS,
+            "retention_days": USAGE_RETENTION_DAYS,
+            "buckets": sum(len(buckets) for buckets in self._buckets.values()),
+            "access_keys": len(self._lifetime),
+        }
+
+
+# 全局用量统计
+usage_ledger = UsageLedger()
+
+
+def reload_usage_settings():
+    """根据环境变量重新加载用量统计配置"""
+    _load_settings()
@@ -13,7 +13,8 @@ import logging
 import sys
 import base64
 from typing import Tuple, Optional
-from collections import deque
+from . import metrics
+from .log_pipeline import LogEvent, setup_log_pipeline
 
 
 class GeminiServiceUnavailableError(Exception):
@@ -36,24 +37,17 @@ class GeminiAPIError(Exception):
         self.message = message
         self.extra = extra
 
-# 用于存储日志的全局变量
-log_records = deque(maxlen=1000) # 最多存储1000条日志
-log_new_lock = Lock() # 用于保护标识新日志的锁
-log_new = False # 标识是否有新日志
-
-
-class WebSocketLogHandler(logging.Handler):
-    def emit(self, record):
-        log_entry = self.format(record)
-        set_log_new(True)
-        log_records.append(log_entry)
+def _image_response_to_base64(response) -> Tuple[Optional[str], Optional[str]]:
+    """校验响应是否为图片并编码为base64，同步(requests)与异步(httpx)下载共用"""
+    # 验证是否为图片
+    content_type = response.headers.get('Content-Type', '')
+    if not content_type.startswith('image/'):
+        logger.warning(f"非图片内容类型: {content_type}")
+        return None, None
 
-def set_log_new(new: bool):
-    with log_new_lock:
-        global log_new
-        log_new = new
-def get_log_new():
-        return log_new
+    # 获取图片数据并编码为base64
+    base64_data = base64.b64encode(response.content).decode('utf-8')
+    return content_type, base64_data
 
 def download_image_to_base64(url: str) -> Tuple[Optional[str], Optional[str]]:
     """
@@ -68,21 +62,30 @@ def download_image_to_base64(url: str) -> Tuple[Optional[str], Optional[str]]:
     try:
         response = requests.get(url, timeout=5)
         response.raise_for_status()
-        
-        # 验证是否为图片
-        content_type = response.headers.get('Content-Type', '')
-        if not content_type.startswith('image/'):
-            logger.warning(f"非图片内容类型: {content_type}")
-            return None, None
-            
-        # 获取图片数据并编码为base64
-        image_data = response.content
-        base64_data = base64.b64encode(image_data).decode('utf-8')
-        
-        return content_type, base64_data
+        return _image_response_to_base64(response)
     except Exception as e:
         logger.error(f"下载图片失败: {e}")
         return None, None
+
+async def download_image_to_base64_async(client: httpx.AsyncClient, url: str) -> Tuple[Optional[str], Optional[str]]:
+    """
+    使用异步客户端从HTTP URL下载图片并转换为base64格式
+
+    Args:
+        client: httpx异步客户端
+        url: 图片URL
+
+    Returns:
+        tuple: (mime_type, base64_data) 或 (None, None) 如果失败
+    """
+    try:
+        response = await client.get(url, timeout=5)
+        response.raise_for_status()
+        return _image_response_to_base64(response)
+    except Exception as e:
+        logger.error(f"下载图片失败: {e}")
+        return None, None
+
 def download_video_to_base64(url: str) -> Tuple[Optional[str], Optional[str]]:
     """
     从HTTP URL下载视频并转换为base64格式
@@ -112,39 +115,14 @@ def download_video_to_base64(url: str) -> Tuple[Optional[str], Optional[str]]:
         logger.error(f"下载视频失败: {e}")
         return None, None
 
-DEBUG = os.environ.get("DEBUG", "false").lower() == "true"
-LOG_FORMAT_DEBUG = '%(asctime)s-%(levelname)s-[%(ip)s]-[%(key)s]-%(request_type)s-[%(model)s]-%(status_code)s: %(message)s-%(error_message)s'
-LOG_FORMAT_NORMAL = '%(asctime)s-%(levelname)s-[%(ip)s]-[%(key)s]-%(request_type)s-[%(model)s]-%(status_code)s: %(message)s'
-
 # 配置 logger
 logger = logging.getLogger("my_logger")
-logger.setLevel(logging.DEBUG)
-
-handler = logging.StreamHandler()
-# formatter = logging.Formatter('%(message)s')
-# handler.setFormatter(formatter)
-logger.addHandler(handler)
-
-# 添加WebSocket日志处理器
-websocket_handler = WebSocketLogHandler()
-websocket_handler.setFormatter(logging.Formatter('%(message)s'))
-logger.addHandler(websocket_handler)
+# 日志放入队列后由后台线程批量写出，同时发布到日志总线供 /ws/logs 使用
+log_listener = setup_log_pipeline(logger)
 
 def format_log_message(level, message, extra=None):
-    extra = extra or {}
-    log_values = {
-        'asctime': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        'levelname': level,
-        'ip': extra.get('ip', 'N/A'),
-        'key': extra.get('key', 'N/A'),
-        'request_type': extra.get('request_type', 'N/A'),
-        'model': extra.get('model', 'N/A'),
-        'status_code': extra.get('status_code', 'N/A'),
-        'error_message': extra.get('error_message', ''),
-        'message': message
-    }
-    log_format = LOG_FORMAT_DEBUG if DEBUG else LOG_FORMAT_NORMAL
-    return log_format % log_values
+    # 返回结构化日志事件，文本在后台线程写出时才格式化
+    return LogEvent(level, message, extra)
 
 
 class APIKeyManager:
@@ -193,9 +171,23 @@ class APIKeyManager:
                 self.tried_keys_for_request.add(key)
                 return key
 
+        metrics.api_key_exhausted_total.inc()
         return None
 
 
+    def lease_keys(self, count: int) -> list:
+        """从栈中轮流取出最多 count 个不同的密钥，供并发的子请求使用，不影响 tried_keys"""
+        # 配置中可能有重复的密钥，按去重后的数量计算，否则永远取不满
+        count = min(count, len(set(self.api_keys)))
+        leased = []
+        while len(leased) < count:
+            if not self.key_stack:
+                self._reset_key_stack()
+            key = self.key_stack.pop()
+            if key not in leased:
+                leased.append(key)
+        return leased
+
     def show_all_keys(self):
         log_msg = format_log_message('INFO', f"当前可用API key个数: {len(self.api_keys)} ")
         logger.info(log_msg)
@@ -226,7 +218,7 @@ def handle_gemini_error(error, current_api_key, key_manager, client_ip="N/A") ->
         log_msg = format_log_message('WARNING', f"Gemini服务不可用[{error.status_code}]: {error_message}", extra=error.extra)
         logger.warning(log_msg)
         return error_message
-    elif isinstance(error, requests.exceptions.HTTPError):
+    elif isinstance(error, (requests.exceptions.HTTPError, httpx.HTTPStatusError)):
         status_code = error.response.status_code
         if status_code == 400:
             try:
@@ -293,13 +285,13 @@ def handle_gemini_error(error, current_api_key, key_manager, client_ip="N/A") ->
             
             return f"未知错误/模型不可用: {status_code}"
 
-    elif isinstance(error, requests.exceptions.ConnectionError):
+    elif isinstance(error, (requests.exceptions.ConnectionError, httpx.ConnectError)):
         error_message = "连接错误"
         log_msg = format_log_message('WARNING', error_message, extra={'ip': client_ip, 'key': current_api_key[:10], 'status_code': 'N/A', 'error_message': error_message})
         logger.warning(log_msg)
         return error_message
 
-    elif isinstance(error, requests.exceptions.Timeout):
+    elif isinstance(error, (requests.exceptions.Timeout, httpx.TimeoutException)):
         error_message = "请求超时"
         log_msg = format_log_message('WARNING', error_message, extra={'ip': client_ip, 'key': current_api_key[:10], 'status_code': 'N/A', 'error_message': error_message})
         logger.warning(log_msg)
@@ -355,9 +347,11 @@ def protect_from_abuse(request: Request, max_requests_per_minute: int = 30, max_
         rate_limit_data[day_key] = (day_count, day_timestamp)
 
     if minute_count > max_requests_per_minute:
+        metrics.rate_limit_rejections.inc("minute")
         raise HTTPException(status_code=429, detail={
             "message": "Too many requests per minute", "limit": max_requests_per_minute})
     if day_count > max_requests_per_day_per_ip:
+        metrics.rate_limit_rejections.inc("day")
         raise HTTPException(status_code=429, detail={"message": "Too many requests per day from this IP", "limit": max_requests_per_day_per_ip})
 def generate_random_alphanumeric(length: int) -> str:
     """
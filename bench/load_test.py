@@ -0,0 +1,224 @@
+"""代理服务的端到端压测脚本
+
+配合 bench/mock_gemini.py 使用，统计吞吐量、延迟与首字耗时(TTFT)的 p50/p99，
+以及每个并发流占用的内存:
+
+    python bench/mock_gemini.py --port 8000
+    PROXY_URL=http://127.0.0.1:8000 GEMINI_API_KEYS=AIzaSy... uvicorn app.main:app --port 7860
+    python bench/load_test.py --target http://127.0.0.1:7860 --password 123 \\
+        --scenario all --concurrency 50 --requests 500 --server-pid <uvicorn进程ID>
+
+proxy 场景请求 /gemini 前缀的通用代理，需要先在管理界面中将 /gemini 的目标地址改为模拟服务地址。
+disconnect 场景在收到 --disconnect-after 个数据块后断开连接，配合 --mock-url 统计断开后上游仍多发送的数据块。
+context-cache 场景发送共享长历史(--cache-prefix-chars)、最后一问各不相同的多轮对话，需要代理开启
+CONTEXT_CACHE_ENABLED，配合 --mock-url 对比使用上下文缓存前后发送给上游的输入token数。
+"""
+import json
+import math
+import time
+import uuid
+import asyncio
+import argparse
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+import httpx
+
+SCENARIOS = ("stream", "non-stream", "image", "proxy", "embeddings", "disconnect", "context-cache")
+
+
+@dataclass
+class ScenarioResult:
+    name: str
+    latencies: List[float] = field(default_factory=list)
+    ttfts: List[float] = field(default_factory=list)
+    errors: int = 0
+    wall_time: float = 0.0
+    baseline_rss: Optional[int] = None
+    peak_rss: Optional[int] = None
+    chunks_received: int = 0
+    # 客户端断开后上游仍发送的数据块数量(需要 --mock-url)
+    wasted_chunks: Optional[int] = None
+    # 实际发送给上游的输入token数与命中上下文缓存的token数(需要 --mock-url)
+    prompt_tokens_sent: Optional[int] = None
+    prompt_tokens_cached: Optional[int] = None
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    # 最近秩法
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def build_request(args, scenario: str):
+    """返回 (url, headers, json_body, 是否流式)"""
+    prompt = ("压测提示词。" * (args.prompt_chars // 6 + 1))[:args.prompt_chars]
+    messages = [{"role": "user", "content": prompt}]
+    headers = {"Authorization": f"Bearer {args.password}"}
+    if scenario == "proxy":
+        url = f"{args.target}{args.proxy_prefix}/v1beta/models/{args.model}:generateContent?key={args.api_key}"
+        return url, {}, {"contents": [{"role": "user", "parts": [{"text": prompt}]}]}, False
+    if scenario == "embeddings":
+        return f"{args.target}/v1/embeddings", headers, {"model": args.embedding_model, "input": [prompt] * args.embedding_inputs}, False
+    if scenario == "context-cache":
+        # 历史部分相同，只有最后一问不同，重复出现的历史由代理创建上游缓存
+        history = ("共享的长文档内容。" * (args.cache_prefix_chars // 9 + 1))[:args.cache_prefix_chars]
+        messages = [
+            {"role": "user", "content": history},
+            {"role": "assistant", "content": "已阅读文档。"},
+            {"role": "user", "content": f"问题 {uuid.uuid4().hex[:8]}: {prompt}"},
+        ]
+    model = args.image_model if scenario == "image" else args.model
+    stream = scenario in ("stream", "image", "disconnect")
+    body = {"model": model, "messages": messages, "stream": stream, "temperature": args.temperature}
+    return f"{args.target}/v1/chat/completions", headers, body, stream
+
+
+async def run_one(client: httpx.AsyncClient, args, scenario: str, result: ScenarioResult):
+    url, headers, body, stream = build_request(args, scenario)
+    start = time.perf_counter()
+    try:
+        if stream:
+            async with client.stream("POST", url, headers=headers, json=body) as response:
+                if response.status_code != 200:
+                    await response.aread()
+                    result.errors += 1
+                    return
+                first = None
+                received = 0
+                async for line in response.aiter_lines():
+                    if not line.startswith("data: ") or line == "data: [DONE]":
+                        continue
+                    payload = json.loads(line[len("data: "):])
+                    if 'error' in payload:
+                        result.errors += 1
+                        return
+                    if first is None:
+                        first = time.perf_counter()
+                        result.ttfts.append(first - start)
+                    received += 1
+                    result.chunks_received += 1
+                    if scenario == "disconnect" and received >= args.disconnect_after:
+                        # 离开 async with 时关闭连接，模拟客户端中途断开
+                        break
+        else:
+            response = await client.post(url, headers=headers, json=body)
+            if response.status_code != 200:
+                result.errors += 1
+                return
+        result.latencies.append(time.perf_counter() - start)
+    except Exception:
+        result.errors += 1
+
+
+async def sample_rss(pid: int, result: ScenarioResult, stop: asyncio.Event):
+    import psutil
+    process = psutil.Process(pid)
+    result.baseline_rss = process.memory_info().rss
+    result.peak_rss = result.baseline_rss
+    while not stop.is_set():
+        result.peak_rss = max(result.peak_rss, process.memory_info().rss)
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=0.1)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def run_scenario(args, scenario: str) -> ScenarioResult:
+    result = ScenarioResult(scenario)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    stop = asyncio.Event()
+    sampler = asyncio.create_task(sample_rss(args.server_pid, result, stop)) if args.server_pid else None
+
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        async def worker():
+            async with semaphore:
+                await run_one(client, args, scenario, result)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.requests)))
+        result.wall_time = time.perf_counter() - start
+
+    stop.set()
+    if sampler:
+        await sampler
+    return result
+
+
+def _ms(value: Optional[float]) -> str:
+    return f"{value * 1000:.1f}ms" if value is not None else "-"
+
+
+def report(result: ScenarioResult, concurrency: int):
+    ok = len(result.latencies)
+    throughput = ok / result.wall_time if result.wall_time else 0
+    print(f"[{result.name}] 成功: {ok} 失败: {result.errors} 吞吐量: {throughput:.1f} req/s 总耗时: {result.wall_time:.2f}s")
+    print(f"    延迟 p50: {_ms(percentile(result.latencies, 50))} p99: {_ms(percentile(result.latencies, 99))}")
+    if result.ttfts:
+        print(f"    TTFT p50: {_ms(percentile(result.ttfts, 50))} p99: {_ms(percentile(result.ttfts, 99))}")
+    if result.peak_rss is not None:
+        per_stream = (result.peak_rss - result.baseline_rss) / concurrency / 1024
+        print(f"    内存 基线: {result.baseline_rss / 1024 / 1024:.1f}MB 峰值: {result.peak_rss / 1024 / 1024:.1f}MB 每个并发: {per_stream:.1f}KB")
+    if result.wasted_chunks is not None:
+        print(f"    断开后上游多发送: {result.wasted_chunks} 个数据块 平均每个请求: {result.wasted_chunks / max(ok, 1):.2f}")
+    if result.prompt_tokens_sent is not None:
+        total = result.prompt_tokens_sent + result.prompt_tokens_cached
+        saved = result.prompt_tokens_cached / total if total else 0
+        print(f"    输入token 不使用缓存: {total} 实际发送: {result.prompt_tokens_sent} 命中缓存: {result.prompt_tokens_cached} 减少: {saved:.1%}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="代理服务压测")
+    parser.add_argument('--target', default='http://127.0.0.1:7860', help='代理服务地址')
+    parser.add_argument('--password', default='123', help='访问密码或sk-访问密钥')
+    parser.add_argument('--scenario', default='all', choices=SCENARIOS + ('all',))
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--requests', type=int, default=200, help='每个场景的请求总数')
+    parser.add_argument('--model', default='gemini-2.5-flash')
+    parser.add_argument('--image-model', default='gemini-2.0-flash-exp-image-generation')
+    parser.add_argument('--embedding-model', default='text-embedding-3-small')
+    parser.add_argument('--embedding-inputs', type=int, default=256, help='embeddings场景每个请求的输入数量')
+    parser.add_argument('--temperature', type=float, default=1.0)
+    parser.add_argument('--prompt-chars', type=int, default=200, help='每个请求的提示词长度')
+    parser.add_argument('--proxy-prefix', default='/gemini', help='proxy场景使用的代理前缀')
+    parser.add_argument('--api-key', default='mock-key', help='proxy场景透传给上游的key')
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--server-pid', type=int, default=None, help='代理服务进程ID，用于统计内存')
+    parser.add_argument('--mock-url', default=None, help='模拟上游地址，压测结束后输出其统计信息')
+    parser.add_argument('--disconnect-after', type=int, default=1, help='disconnect场景收到多少个数据块后断开')
+    parser.add_argument('--cache-prefix-chars', type=int, default=20000, help='context-cache场景共享历史的长度，需大于 CONTEXT_CACHE_MIN_CHARS')
+    args = parser.parse_args()
+
+    scenarios = SCENARIOS if args.scenario == 'all' else (args.scenario,)
+    async with httpx.AsyncClient() as client:
+        if args.mock_url:
+            await client.post(f"{args.mock_url}/mock/reset")
+        for scenario in scenarios:
+            sent_before = 0
+            mock_before = {}
+            if args.mock_url:
+                mock_before = (await client.get(f"{args.mock_url}/mock/stats")).json()
+                sent_before = mock_before.get('chunks_sent', 0)
+            result = await run_scenario(args, scenario)
+            if scenario == "context-cache" and args.mock_url:
+                mock_after = (await client.get(f"{args.mock_url}/mock/stats")).json()
+                # 模拟上游按4个字符约1个token计算输入用量
+                result.prompt_tokens_sent = (mock_after.get('prompt_chars_received', 0) - mock_before.get('prompt_chars_received', 0)) // 4
+                result.prompt_tokens_cached = mock_after.get('cached_tokens', 0) - mock_before.get('cached_tokens', 0)
+            if scenario == "disconnect" and args.mock_url:
+                # 等待代理取消上游连接后再统计
+                await asyncio.sleep(1)
+                sent = (await client.get(f"{args.mock_url}/mock/stats")).json().get('chunks_sent', 0) - sent_before
+                result.wasted_chunks = max(0, sent - result.chunks_received)
+            report(result, args.concurrency)
+        if args.mock_url:
+            response = await client.get(f"{args.mock_url}/mock/stats")
+            print(f"模拟上游统计: {json.dumps(response.json(), ensure_ascii=False)}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,284 @@
+"""本地模拟的Gemini上游服务，用于压测与性能对比
+
+将代理的 PROXY_URL 指向本服务即可，不会消耗真实的API额度:
+
+    python bench/mock_gemini.py --port 8000 --latency-ms 200 --chunks 20
+    PROXY_URL=http://127.0.0.1:8000 uvicorn app.main:app --port 7860
+
+支持 generateContent、streamGenerateContent、batchEmbedContents、models、predict、predictLongRunning、
+operations 与 cachedContents 接口，可配置延迟、分块数量、429/503错误注入与图片数据大小。
+GET /mock/stats 返回收到的请求数、输入字符数、上下文缓存命中与客户端中途断开的统计。
+"""
+import os
+import json
+import time
+import uuid
+import base64
+import random
+import asyncio
+import argparse
+from collections import defaultdict
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse, Response
+
+
+class MockConfig:
+    latency_ms = float(os.environ.get('MOCK_LATENCY_MS', 200))
+    chunks = int(os.environ.get('MOCK_CHUNKS', 20))
+    chunk_delay_ms = float(os.environ.get('MOCK_CHUNK_DELAY_MS', 20))
+    chunk_text = os.environ.get('MOCK_CHUNK_TEXT', '模拟输出文本。')
+    error_429_rate = float(os.environ.get('MOCK_ERROR_429_RATE', 0))
+    error_503_rate = float(os.environ.get('MOCK_ERROR_503_RATE', 0))
+    image_kb = int(os.environ.get('MOCK_IMAGE_KB', 256))
+    video_kb = int(os.environ.get('MOCK_VIDEO_KB', 512))
+    operation_seconds = float(os.environ.get('MOCK_OPERATION_SECONDS', 2))
+
+
+config = MockConfig()
+stats = defaultdict(int)
+operations = {}
+cached_contents = {}
+_payload_cache = {}
+
+MODELS = [
+    "gemini-2.5-pro", "gemini-2.5-flash", "gemini-2.0-flash", "gemini-embedding-001",
+    "gemini-2.0-flash-exp-image-generation", "imagen-3.0-generate-002", "veo-2.0-generate-001",
+]
+
+app = FastAPI(title="Mock Gemini")
+
+
+def _random_base64(size_kb: int) -> str:
+    """生成指定大小的随机数据(按KB缓存，避免每次请求重新生成)"""
+    data = _payload_cache.get(size_kb)
+    if data is None:
+        data = base64.b64encode(os.urandom(size_kb * 1024)).decode('utf-8')
+        _payload_cache[size_kb] = data
+    return data
+
+
+def _count_chars(contents) -> int:
+    total = 0
+    for content in contents or []:
+        for part in content.get('parts', []):
+            total += len(part.get('text') or '')
+            total += len(part.get('inline_data', part.get('inlineData', {})).get('data', ''))
+    return total
+
+
+def _injected_error():
+    """按配置的概率返回429/503错误响应"""
+    roll = random.random()
+    if roll < config.error_429_rate:
+        stats['injected_429'] += 1
+        return 429, {"error": {"code": 429, "message": "Resource has been exhausted (mock)", "status": "RESOURCE_EXHAUSTED"}}
+    if roll < config.error_429_rate + config.error_503_rate:
+        stats['injected_503'] += 1
+        return 503, {"error": {"code": 503, "message": "The model is overloaded (mock)", "status": "UNAVAILABLE"}}
+    return None
+
+
+def _usage(body: dict, completion_chars: int) -> dict:
+    """按4个字符约等于1个token估算用量，并统计上下文缓存节省的部分"""
+    prompt_chars = _count_chars(body.get('contents')) + _count_chars([body.get('system_instruction') or {}])
+    cached_tokens = 0
+    cached = cached_contents.get(body.get('cachedContent'))
+    if cached is not None:
+        cached_tokens = cached['tokens']
+        stats['cached_content_hits'] += 1
+        stats['cached_tokens'] += cached_tokens
+    prompt_tokens = prompt_chars // 4 + cached_tokens
+    completion_tokens = max(completion_chars // 4, 1)
+    stats['prompt_chars_received'] += prompt_chars
+    usage = {
+        "promptTokenCount": prompt_tokens,
+        "candidatesTokenCount": completion_tokens,
+        "totalTokenCount": prompt_tokens + completion_tokens,
+    }
+    if cached_tokens:
+        usage["cachedContentTokenCount"] = cached_tokens
+    return usage
+
+
+def _response_parts(model: str, text: str) -> list:
+    parts = [{"text": text}]
+    if 'image' in model:
+        parts.append({"inlineData": {"mimeType": "image/png", "data": _random_base64(config.image_kb)}})
+    return parts
+
+
+def _chunk(parts, finish_reason=None, usage=None) -> dict:
+    candidate = {"content": {"role": "model", "parts": parts}, "index": 0}
+    if finish_reason:
+        candidate["finishReason"] = finish_reason
+    chunk = {"candidates": [candidate]}
+    if usage:
+        chunk["usageMetadata"] = usage
+    return chunk
+
+
+async def _generate_content(model: str, body: dict):
+    stats['generate_content'] += 1
+    await asyncio.sleep(config.latency_ms / 1000)
+    error = _injected_error()
+    if error:
+        return JSONResponse(status_code=error[0], content=error[1])
+    text = config.chunk_text * config.chunks
+    return JSONResponse(content=_chunk(_response_parts(model, text), "STOP", _usage(body, len(text))))
+
+
+async def _stream_generate_content(model: str, body: dict, request: Request):
+    stats['stream_generate_content'] += 1
+    error = _injected_error()
+    if error:
+        await asyncio.sleep(config.latency_ms / 1000)
+        return JSONResponse(status_code=error[0], content=error[1])
+
+    async def event_stream():
+        sent = 0
+        try:
+            await asyncio.sleep(config.latency_ms / 1000)
+            for index in range(config.chunks):
+                last = index == config.chunks - 1
+                parts = _response_parts(model, config.chunk_text) if last else [{"text": config.chunk_text}]
+                usage = _usage(body, len(config.chunk_text) * config.chunks) if last else None
+                yield f"data: {json.dumps(_chunk(parts, 'STOP' if last else None, usage), ensure_ascii=False)}\r\n\r\n"
+                sent += 1
+                stats['chunks_sent'] += 1
+                if not last:
+                    await asyncio.sleep(config.chunk_delay_ms / 1000)
+        finally:
+            # 客户端中途断开时记录未发送的数据块数量，用于衡量断开后上游是否被及时取消
+            if sent < config.chunks:
+                stats['streams_aborted'] += 1
+                stats['chunks_not_sent'] += config.chunks - sent
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+
+async def _batch_embed_contents(model: str, body: dict):
+    stats['batch_embed_contents'] += 1
+    await asyncio.sleep(config.latency_ms / 1000)
+    error = _injected_error()
+    if error:
+        return JSONResponse(status_code=error[0], content=error[1])
+    requests_data = body.get('requests', [])
+    stats['embedded_inputs'] += len(requests_data)
+    embeddings = []
+    for item in requests_data:
+        dimensions = item.get('outputDimensionality') or 768
+        embeddings.append({"values": [random.uniform(-1, 1) for _ in range(dimensions)]})
+    return JSONResponse(content={"embeddings": embeddings})
+
+
+async def _predict(model: str, body: dict):
+    stats['predict'] += 1
+    await asyncio.sleep(config.latency_ms / 1000)
+    error = _injected_error()
+    if error:
+        return JSONResponse(status_code=error[0], content=error[1])
+    count = body.get('parameters', {}).get('sampleCount', 1)
+    prompt = (body.get('instances') or [{}])[0].get('prompt', '')
+    predictions = [{"mimeType": "image/png", "bytesBase64Encoded": _random_base64(config.image_kb), "prompt": prompt} for _ in range(count)]
+    return JSONResponse(content={"predictions": predictions})
+
+
+async def _predict_long_running(model: str, request: Request):
+    stats['predict_long_running'] += 1
+    error = _injected_error()
+    if error:
+        return JSONResponse(status_code=error[0], content=error[1])
+    name = f"models/{model}/operations/{uuid.uuid4().hex[:12]}"
+    operations[name] = {"created_at": time.time(), "base_url": str(request.base_url).rstrip('/')}
+    return JSONResponse(content={"name": name})
+
+
+@app.get("/v1beta/models")
+async def list_models():
+    return {"models": [{"name": f"models/{model}"} for model in MODELS]}
+
+
+@app.post("/v1beta/models/{model_action}")
+async def model_action(model_action: str, request: Request):
+    model, _, action = model_action.partition(':')
+    body = await request.json()
+    if action == 'generateContent':
+        return await _generate_content(model, body)
+    if action == 'streamGenerateContent':
+        return await _stream_generate_content(model, body, request)
+    if action == 'batchEmbedContents':
+        return await _batch_embed_contents(model, body)
+    if action == 'predict':
+        return await _predict(model, body)
+    if action == 'predictLongRunning':
+        return await _predict_long_running(model, request)
+    return JSONResponse(status_code=404, content={"error": {"code": 404, "message": f"Unknown action: {action}"}})
+
+
+@app.get("/v1beta/models/{model}/operations/{operation_id}")
+async def get_operation(model: str, operation_id: str):
+    name = f"models/{model}/operations/{operation_id}"
+    operation = operations.get(name)
+    if operation is None:
+        return JSONResponse(status_code=404, content={"error": {"code": 404, "message": "Operation not found"}})
+    if time.time() - operation['created_at'] < config.operation_seconds:
+        return {"name": name, "done": False}
+    uri = f"{operation['base_url']}/v1beta/files/{operation_id}:download?alt=media"
+    return {"name": name, "done": True, "response": {"generateVideoResponse": {"generatedSamples": [{"video": {"uri": uri}}]}}}
+
+
+@app.get("/v1beta/files/{file_action}")
+async def download_file(file_action: str):
+    stats['file_downloads'] += 1
+    return Response(content=base64.b64decode(_random_base64(config.video_kb)), media_type="video/mp4")
+
+
+@app.post("/v1beta/cachedContents")
+async def create_cached_content(request: Request):
+    body = await request.json()
+    stats['cached_contents_created'] += 1
+    name = f"cachedContents/{uuid.uuid4().hex[:12]}"
+    tokens = (_count_chars(body.get('contents')) + _count_chars([body.get('systemInstruction') or {}])) // 4
+    cached_contents[name] = {"tokens": tokens, "model": body.get('model')}
+    return {"name": name, "model": body.get('model'), "usageMetadata": {"totalTokenCount": tokens}}
+
+
+@app.get("/mock/stats")
+async def get_stats():
+    return dict(stats)
+
+
+@app.post("/mock/reset")
+async def reset_stats():
+    stats.clear()
+    return {"ok": True}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="模拟的Gemini上游服务")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency-ms', type=float, default=config.latency_ms, help='首个数据块前的延迟')
+    parser.add_argument('--chunks', type=int, default=config.chunks, help='流式响应的数据块数量')
+    parser.add_argument('--chunk-delay-ms', type=float, default=config.chunk_delay_ms, help='数据块之间的间隔')
+    parser.add_argument('--error-429-rate', type=float, default=config.error_429_rate, help='返回429的概率(0-1)')
+    parser.add_argument('--error-503-rate', type=float, default=config.error_503_rate, help='返回503的概率(0-1)')
+    parser.add_argument('--image-kb', type=int, default=config.image_kb, help='图片模型返回的图片大小')
+    parser.add_argument('--video-kb', type=int, default=config.video_kb, help='视频文件大小')
+    parser.add_argument('--operation-seconds', type=float, default=config.operation_seconds, help='长时任务完成所需时间')
+    args = parser.parse_args()
+    config.latency_ms = args.latency_ms
+    config.chunks = max(1, args.chunks)
+    config.chunk_delay_ms = args.chunk_delay_ms
+    config.error_429_rate = args.error_429_rate
+    config.error_503_rate = args.error_503_rate
+    config.image_kb = args.image_kb
+    config.video_kb = args.video_kb
+    config.operation_seconds = args.operation_seconds
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+import asyncio
+
+from app import request_coalescer
+from app.request_coalescer import RequestCoalescer
+
+# 最后一个订阅者离开后，上游最多还能再读取的数据块数量
+MAX_CHUNKS_AFTER_DISCONNECT = 1
+
+
+class FakeUpstream:
+    """模拟的上游流，记录被读取的数据块数量"""
+
+    def __init__(self):
+        self.pulled = 0
+
+    async def stream(self):
+        while True:
+            await asyncio.sleep(0)
+            self.pulled += 1
+            yield f"chunk-{self.pulled}"
+
+
+async def _stream_task(flight, upstream):
+    try:
+        async for chunk in upstream.stream():
+            await flight.send(chunk)
+    finally:
+        flight.publish(None)
+
+
+async def _read(subscription, count):
+    for _ in range(count):
+        await subscription.get()
+
+
+async def _settle():
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+def test_last_subscriber_disconnect_cancels_upstream(monkeypatch):
+    monkeypatch.setattr(request_coalescer, "STREAM_BUFFER_CHUNKS", 4)
+
+    async def scenario():
+        coalescer = RequestCoalescer()
+        upstream = FakeUpstream()
+        flight, is_leader = coalescer.join("stream:key")
+        assert is_leader
+        task = flight.start(_stream_task(flight, upstream))
+        subscription = flight.subscribe()
+        await _read(subscription, 3)
+        await _settle()
+        # 客户端读取较慢时上游被背压暂停，不会无限读取
+        assert upstream.pulled <= 3 + request_coalescer.STREAM_BUFFER_CHUNKS + 1
+
+        subscription.close()
+        pulled_at_disconnect = upstream.pulled
+        await _settle()
+        assert task.cancelled()
+        assert upstream.pulled - pulled_at_disconnect <= MAX_CHUNKS_AFTER_DISCONNECT
+        assert coalescer.stats()["in_flight"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_upstream_runs_until_every_follower_leaves(monkeypatch):
+    monkeypatch.setattr(request_coalescer, "STREAM_BUFFER_CHUNKS", 4)
+
+    async def scenario():
+        coalescer = RequestCoalescer()
+        upstream = FakeUpstream()
+        flight, _ = coalescer.join("stream:key")
+        task = flight.start(_stream_task(flight, upstream))
+        leader = flight.subscribe()
+        follower_flight, is_leader = coalescer.join("stream:key")
+        assert follower_flight is flight and not is_leader
+        follower = flight.subscribe()
+
+        await asyncio.gather(_read(leader, 2), _read(follower, 2))
+        leader.close()
+        await _settle()
+        assert not task.done()
+
+        await _read(follower, 2)
+        follower.close()
+        pulled_at_disconnect = upstream.pulled
+        await _settle()
+        assert task.cancelled()
+        assert upstream.pulled - pulled_at_disconnect <= MAX_CHUNKS_AFTER_DISCONNECT
+
+    asyncio.run(scenario())
+
+
+def test_slow_follower_is_dropped_without_stalling_others(monkeypatch):
+    monkeypatch.setattr(request_coalescer, "STREAM_BUFFER_CHUNKS", 4)
+
+    async def scenario():
+        coalescer = RequestCoalescer()
+        upstream = FakeUpstream()
+        flight, _ = coalescer.join("stream:key")
+        task = flight.start(_stream_task(flight, upstream))
+        fast = flight.subscribe()
+        slow = flight.subscribe()
+
+        await _read(fast, 20)
+        try:
+            await slow.get()
+        except request_coalescer.SubscriberTooSlow:
+            pass
+        else:
+            raise AssertionError("slow subscriber was not dropped")
+        assert coalescer.stats()["slow_dropped"] == 1
+
+        fast.close()
+        await _settle()
+        assert task.cancelled()
+
+    asyncio.run(scenario())
+
+
+def test_non_stream_waiter_disconnect_cancels_upstream():
+    async def scenario():
+        coalescer = RequestCoalescer()
+        started = asyncio.Event()
+
+        async def upstream_call():
+            started.set()
+            await asyncio.sleep(3600)
+
+        flight, _ = coalescer.join("non-stream:key")
+        task = flight.start(upstream_call())
+        waiter = asyncio.create_task(flight.result())
+        await started.wait()
+        waiter.cancel()
+        await _settle()
+        assert task.cancelled()
+
+    asyncio.run(scenario())